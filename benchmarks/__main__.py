@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Runs the benchmarks (all offline, fixtures are synthetic and served
+# locally) and appends the results to a json lines history keyed by git
+# commit, then prints how each throughput moved against the last run
+# recorded for a different commit. The history is kept in --results-dir,
+# $BENCHMARK_RESULTS_DIR or ~/.cache/weather-pipeline/benchmarks, outside
+# the checkout.
+#   python -m benchmarks
+#   python -m benchmarks pipeline timestamps --no-history
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+BENCHMARKS = (
+    'pipeline',
+    'shape',
+    'query',
+    'timestamps',
+    'memory',
+    'compression',
+    'listing',
+    'download',
+    'stream',
+    'realtime',
+)
+DEFAULT_RESULTS_DIR = os.environ.get(
+    'BENCHMARK_RESULTS_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'weather-pipeline', 'benchmarks'),
+)
+HISTORY_FILENAME = 'history.jsonl'
+
+
+def git_revision() -> Dict[str, Any]:
+    def git(*args):
+        return subprocess.run(
+            ['git', *args],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    try:
+        return {
+            'commit': git('rev-parse', 'HEAD') or None,
+            'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        }
+    except OSError:
+        return {'commit': None, 'dirty': None}
+
+
+def result_key(result: Dict[str, Any]) -> str:
+    # What a result measured, everything that isn't a timing or a rate
+    return json.dumps({
+        key: value for key, value in result.items()
+        if not isinstance(value, float) and not key.endswith('_per_second')
+    }, sort_keys=True)
+
+
+def load_history(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as history_file:
+        return [json.loads(line) for line in history_file if line.strip()]
+
+
+def previous_run(history: List[Dict[str, Any]], commit: Optional[str]) -> Optional[Dict[str, Any]]:
+    for run in reversed(history):
+        if run['commit'] != commit:
+            return run
+    return None
+
+
+def compare(results: List[Dict[str, Any]], previous: Dict[str, Any]):
+    previous_results = {result_key(result): result for result in previous['results']}
+    print(f"vs {(previous['commit'] or 'unknown')[:10]} ({previous['recorded_at']}):")
+    for result in results:
+        before = previous_results.get(result_key(result))
+        if not before:
+            continue
+        for key, value in result.items():
+            if key.endswith('_per_second') and before.get(key):
+                change = (value / before[key] - 1) * 100
+                name = result.get('case') or result['benchmark']
+                print(f'  {name} {key}: {before[key]} -> {value} ({change:+.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', help=f'any of {", ".join(BENCHMARKS)} (default all)')
+    parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR)
+    parser.add_argument('--history', help=f'history file (default {HISTORY_FILENAME} in --results-dir)')
+    parser.add_argument('--no-history', action='store_true')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks {sorted(unknown)}')
+
+    results = []
+    for name in args.benchmarks or BENCHMARKS:
+        print(f'Running {name}')
+        module = importlib.import_module(f'benchmarks.bench_{name}')
+        results.extend(module.run())
+
+    run = {
+        **git_revision(),
+        'recorded_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    for result in results:
+        print(json.dumps(result))
+    if args.no_history:
+        return
+    history_path = args.history or os.path.join(args.results_dir, HISTORY_FILENAME)
+    os.makedirs(os.path.dirname(os.path.abspath(history_path)), exist_ok=True)
+    previous = previous_run(load_history(history_path), run['commit'])
+    if previous:
+        compare(results, previous)
+    with open(history_path, 'a') as history_file:
+        history_file.write(json.dumps(run) + '\n')
+    print(f'Recorded in {history_path}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Throughput vs ratio of each compression backend on melted json output.
+#   python -m benchmarks.bench_compression
+import argparse
+import io
+import logging
+import os
+import tempfile
+import time
+
+from typing import Any, Dict, List
+
+from benchmarks.synthetic import write_stdmet_file
+from compression import (
+    CompressionOptions,
+    get_extension,
+    open_reader,
+    open_writer,
+    pigz_available,
+)
+from prefect_pipeline.noaa_ndbc.models import StandardMeteorologicalDataNullValues
+from prefect_pipeline.noaa_ndbc.process_historical_data import process_file
+
+
+def melted_output(fixture_dir: str, rows: int) -> bytes:
+    # Real processed rows, serialized exactly like the json sink does
+    fixture_path = os.path.join(fixture_dir, '41001h2010.txt.gz')
+    write_stdmet_file(fixture_path, 2010, rows)
+    data_df = process_file(
+        ('41001', fixture_path),
+        0,
+        '2010',
+        StandardMeteorologicalDataNullValues,
+        1,
+        logging.getLogger(__name__),
+    )
+    output = io.StringIO()
+    data_df.to_json(output, orient='records', date_format='iso')
+    return output.getvalue().encode('utf-8')
+
+
+def available_backends() -> List[str]:
+    backends = ['gzip', 'parallel']
+    if pigz_available():
+        backends.append('pigz')
+    try:
+        import zstandard
+        backends.append('zstd')
+    except ImportError:
+        pass
+    return backends
+
+
+def run(
+    rows: int = 100000,
+    levels: List[int] = (1, 6, 9),
+    threads: int = None,
+) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        data = melted_output(fixture_dir, rows)
+        megabytes = len(data) / (1024 * 1024)
+        for backend in available_backends():
+            for level in levels:
+                options = CompressionOptions(backend, level, threads)
+                output_path = os.path.join(fixture_dir, f'output.{backend}.{level}{get_extension(options)}')
+                start = time.perf_counter()
+                with open_writer(output_path, options) as output_file:
+                    # Written in pieces like the sinks do, one station at a time
+                    for offset in range(0, len(data), 256 * 1024):
+                        output_file.write(data[offset:offset + 256 * 1024])
+                write_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                with open_reader(output_path) as input_file:
+                    assert input_file.read() == data
+                read_seconds = time.perf_counter() - start
+                results.append({
+                    'benchmark': 'compression',
+                    'backend': backend,
+                    'level': level,
+                    'input_mb': round(megabytes, 2),
+                    'ratio': round(len(data) / os.path.getsize(output_path), 2),
+                    'write_mb_per_second': round(megabytes / write_seconds, 1),
+                    'read_mb_per_second': round(megabytes / read_seconds, 1),
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--threads', type=int)
+    args = parser.parse_args()
+    for result in run(args.rows, threads=args.threads):
+        print(
+            f"{result['backend']:>8} -{result['level']} "
+            f"ratio {result['ratio']:>6.2f} "
+            f"write {result['write_mb_per_second']:>7.1f} MB/s "
+            f"read {result['read_mb_per_second']:>7.1f} MB/s"
+        )
+
+
+if __name__ == '__main__':
+    main()
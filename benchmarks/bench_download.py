@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Throughput of the download stage against a local stand-in for NDBC.
+#   python -m benchmarks.bench_download
+import argparse
+import os
+import tempfile
+
+from typing import Any, Dict, List
+
+from benchmarks.fixtures import serve_directory
+from prefect_pipeline.noaa_ndbc.download import download_files
+
+
+def write_fixture_files(directory: str, num_files: int, file_size: int) -> List[str]:
+    filenames = []
+    for i in range(num_files):
+        filename = f'{41000 + i}h2010.txt.gz'
+        with open(os.path.join(directory, filename), 'wb') as fixture_file:
+            fixture_file.write(os.urandom(file_size))
+        filenames.append(filename)
+    return filenames
+
+
+def run(
+    num_files: int = 200,
+    file_size: int = 64 * 1024,
+    latency: float = 0.02,
+    worker_counts: List[int] = (1, 4, 16),
+) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as fixture_dir, \
+            tempfile.TemporaryDirectory() as output_dir:
+        filenames = write_fixture_files(fixture_dir, num_files, file_size)
+        with serve_directory(fixture_dir, latency=latency) as base_url:
+            for max_workers in worker_counts:
+                downloads = {
+                    f'{base_url}/{filename}': os.path.join(output_dir, str(max_workers), filename)
+                    for filename in filenames
+                }
+                stats = download_files(
+                    downloads,
+                    max_workers=max_workers,
+                    requests_per_second=None,
+                )
+                results.append({
+                    'benchmark': 'download',
+                    'max_workers': max_workers,
+                    **stats.as_dict(),
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+    for result in run(args.files, args.file_size, args.latency):
+        print(
+            f"workers={result['max_workers']:>3} "
+            f"{result['files_per_second']:>8.1f} files/s "
+            f"{result['mb_per_second']:>8.2f} MB/s "
+            f"failed={result['failed']}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Parse time of the historical stdmet index, BeautifulSoup vs the regex
+# fast path in discovery.
+#   python -m benchmarks.bench_listing [--page saved_stdmet_index.html]
+# Save a copy of https://www.ndbc.noaa.gov/data/historical/stdmet/ to run it
+# on the real thing, otherwise a synthetic index of the same shape is used.
+import argparse
+import re
+import time
+
+from typing import Any, Dict, List, Optional
+
+from prefect_pipeline.noaa_ndbc.discovery import parse_listing_links
+
+
+def synthetic_index(num_links: int = 20000) -> str:
+    # Same markup as the apache index NDBC serves
+    rows = []
+    for i in range(num_links):
+        filename = f'{41000 + i // 40}h{1970 + i % 40}.txt.gz'
+        rows.append(
+            '<tr><td valign="top"><img src="/icons/compressed.gif" alt="[   ]"></td>'
+            f'<td><a href="{filename}">{filename}</a></td>'
+            '<td align="right">2021-03-09 12:26  </td><td align="right"> 27K</td>'
+            '<td>&nbsp;</td></tr>'
+        )
+    return (
+        '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN"><html><head>'
+        '<title>Index of /data/historical/stdmet</title></head><body>'
+        '<h1>Index of /data/historical/stdmet</h1><table>'
+        '<tr><th><a href="?C=N;O=D">Name</a></th></tr>'
+        + '\n'.join(rows)
+        + '</table></body></html>'
+    )
+
+
+def soup_links(html: str) -> List[str]:
+    # What discovery did before
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    return [
+        link.get('href')
+        for link in soup.find_all('a', attrs={'href': re.compile(r'^.*\.txt(\.gz)')})
+    ]
+
+
+def run(page: Optional[str] = None, repeat: int = 1) -> List[Dict[str, Any]]:
+    if page:
+        with open(page, 'r') as page_file:
+            html = page_file.read()
+    else:
+        html = synthetic_index()
+    timings = {}
+    for name, parse in (('soup', soup_links), ('regex', parse_listing_links)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            links = parse(html)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = (best, len(links))
+    return [{
+        'benchmark': 'listing_parse',
+        'page_bytes': len(html),
+        'links': timings['regex'][1],
+        'soup_links': timings['soup'][1],
+        'soup_seconds': round(timings['soup'][0], 4),
+        'regex_seconds': round(timings['regex'][0], 4),
+        'speedup': round(timings['soup'][0] / timings['regex'][0], 1),
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--page')
+    args = parser.parse_args()
+    for result in run(args.page):
+        print(
+            f"{result['links']} links ({result['page_bytes'] / 1024:.0f} kb): "
+            f"soup {result['soup_seconds']:.3f}s "
+            f"regex {result['regex_seconds']:.4f}s "
+            f"({result['speedup']}x)"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Peak RSS of processing one large station file, whole file vs chunked.
+#   python -m benchmarks.bench_memory
+# Each measurement runs in a fresh interpreter so the peaks don't bleed
+# into each other.
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Any, Dict, List, Optional
+
+from benchmarks.synthetic import write_stdmet_file
+
+# ~100mb uncompressed, about the size of the largest historical files
+LARGE_FILE_ROWS = 1200000
+
+
+def measure(fixture_path: str, output_dir: str, chunksize: Optional[int]) -> Dict[str, Any]:
+    # Runs in the child process
+    from prefect_pipeline.noaa_ndbc.process_historical_data import process_and_write_files
+
+    start = time.perf_counter()
+    process_and_write_files(
+        {'2010': set([('41001', fixture_path)])},
+        {},
+        output_dir,
+        logging.getLogger(__name__),
+        chunksize=chunksize,
+    )
+    return {
+        'seconds': round(time.perf_counter() - start, 2),
+        # ru_maxrss is kilobytes on linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run(
+    rows: int = LARGE_FILE_ROWS,
+    chunksizes: List[Optional[int]] = (None, 100000),
+) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        fixture_path = os.path.join(fixture_dir, '41001h2010.txt.gz')
+        write_stdmet_file(fixture_path, 2010, rows)
+        for chunksize in chunksizes:
+            output = subprocess.run(
+                [
+                    sys.executable, '-m', 'benchmarks.bench_memory',
+                    '--child', fixture_path,
+                    '--output-dir', fixture_dir,
+                    '--chunksize', str(chunksize or 0),
+                ],
+                check=True,
+                stdout=subprocess.PIPE,
+                text=True,
+            ).stdout
+            results.append({
+                'benchmark': 'process_file_memory',
+                'rows': rows,
+                'chunksize': chunksize,
+                **json.loads(output.strip().splitlines()[-1]),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=LARGE_FILE_ROWS)
+    parser.add_argument('--child')
+    parser.add_argument('--output-dir')
+    parser.add_argument('--chunksize', type=int, default=0)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(measure(args.child, args.output_dir, args.chunksize or None)))
+        return
+    for result in run(args.rows):
+        print(
+            f"chunksize={str(result['chunksize']):>7} "
+            f"peak rss {result['peak_rss_mb']:>8.1f} MB "
+            f"{result['seconds']:>6.2f}s"
+        )
+
+
+if __name__ == '__main__':
+    main()
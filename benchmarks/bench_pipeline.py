@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# Throughput of the processing path on synthetic files in every layout:
+# file name parsing (one at a time and as a catalog), grouping, process_file per layout and
+# process_and_write_files end to end. Serial and parallel output have to
+# come out byte for byte the same, checkpointed or not.
+#   python -m benchmarks.bench_pipeline
+import argparse
+import gzip
+import logging
+import os
+import tempfile
+import time
+
+from typing import Any, Callable, Dict, List, Tuple
+
+from benchmarks.fixtures import output_digest
+from benchmarks.synthetic import (
+    LAYOUT_YEARS,
+    fixture_stations,
+    write_fixture_set,
+    write_stdmet_file,
+)
+from prefect_pipeline.noaa_ndbc.catalog import build_catalog
+from prefect_pipeline.noaa_ndbc.models import StandardMeteorologicalDataNullValues
+from prefect_pipeline.noaa_ndbc.process_historical_data import (
+    ParseStats,
+    extract_filename_info,
+    group_files,
+    process_and_write_files,
+    process_file,
+)
+from prefect_pipeline.noaa_ndbc.stations import StationTable
+
+MB = 1024 * 1024
+logger = logging.getLogger(__name__)
+
+
+def best_of(repeat: int, function: Callable[[], Any]) -> Tuple[float, Any]:
+    # Fastest of repeat runs, the rest is noise from whatever else the
+    # machine was doing.
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def uncompressed_size(filepath: str) -> int:
+    with gzip.open(filepath, 'rb') as input_file:
+        return sum(len(block) for block in iter(lambda: input_file.read(MB), b''))
+
+
+def result(case: str, seconds: float, items: int, item_name: str, num_bytes: int = None) -> Dict[str, Any]:
+    output = {
+        'benchmark': 'pipeline',
+        'case': case,
+        item_name: items,
+        'seconds': round(seconds, 4),
+        f'{item_name}_per_second': round(items / seconds, 1),
+    }
+    if num_bytes is not None:
+        output['mb'] = round(num_bytes / MB, 2)
+        output['mb_per_second'] = round(num_bytes / MB / seconds, 2)
+    return output
+
+
+def run(
+    stations: int = 4,
+    rows: int = 20000,
+    names: int = 100000,
+    workers: int = 1,
+    repeat: int = 3,
+) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        files = write_fixture_set(os.path.join(fixture_dir, 'feed'), stations, LAYOUT_YEARS, rows)
+        station_ids = sorted(set(file_info['station_id'] for file_info in files.values()))
+        station_lookup = StationTable.from_records(fixture_stations(station_ids))
+
+        # Distinct names, a real listing has no repeats
+        filenames = [f'{41001 + i % 1000}h{1900 + i // 1000}.txt.gz' for i in range(names)]
+        seconds, _ = best_of(repeat, lambda: [
+            extract_filename_info(filename, logger) for filename in filenames
+        ])
+        results.append(result('extract_filename_info', seconds, names, 'names'))
+        seconds, _ = best_of(repeat, lambda: build_catalog(filenames, 'https://example.com/stdmet'))
+        results.append(result('build_catalog', seconds, names, 'names'))
+
+        # Same files over and over, group_files only looks at the info
+        many_files = {
+            f'{path}.{i}': file_info
+            for i in range(max(1, names // len(files)))
+            for path, file_info in files.items()
+        }
+        seconds, _ = best_of(repeat, lambda: group_files(many_files, station_lookup, logger))
+        results.append(result('group_files', seconds, len(many_files), 'files'))
+
+        for year in LAYOUT_YEARS:
+            filepath = next(
+                path for path, file_info in files.items()
+                if file_info['year'] == str(year)
+            )
+            station_id = files[filepath]['station_id']
+            seconds, data_df = best_of(repeat, lambda: process_file(
+                (station_id, filepath),
+                0,
+                str(year),
+                StandardMeteorologicalDataNullValues,
+                1,
+                logger,
+            ))
+            file_result = result(f'process_file_{year}', seconds, rows, 'rows', uncompressed_size(filepath))
+            file_result['observations'] = len(data_df)
+            results.append(file_result)
+
+        stations_by_year = group_files(files, station_lookup, logger)
+        total_rows = rows * len(files)
+        total_bytes = sum(uncompressed_size(path) for path in files)
+        output_dir = os.path.join(fixture_dir, 'output')
+        os.makedirs(output_dir, exist_ok=True)
+        parse_stats = ParseStats()
+        seconds, _ = best_of(repeat, lambda: process_and_write_files(
+            stations_by_year,
+            station_lookup,
+            output_dir,
+            logger,
+            workers,
+            parse_stats=parse_stats,
+        ))
+        results.append({
+            **result('process_and_write_files', seconds, total_rows, 'rows', total_bytes),
+            'files': len(files),
+            'workers': workers,
+        })
+
+        # A file that is all nulls melts to an empty frame (written as []),
+        # an empty one to nothing at all, both paths have to agree on that.
+        parity_files = dict(files)
+        null_path = os.path.join(fixture_dir, 'feed', '41000h2010.txt.gz')
+        write_stdmet_file(null_path, 2010, rows, missing_rate=1.0)
+        parity_files[null_path] = {'station_id': '41000', 'year': '2010', 'month': None}
+        empty_path = os.path.join(fixture_dir, 'feed', '41900h2010.txt.gz')
+        gzip.open(empty_path, 'wb').close()
+        parity_files[empty_path] = {'station_id': '41900', 'year': '2010', 'month': None}
+        parity_lookup = StationTable.from_records(fixture_stations(station_ids + ['41000', '41900']))
+        for checkpoint in (False, True):
+            digests = []
+            for parity_workers in (1, max(2, workers)):
+                output_dir = os.path.join(fixture_dir, f'parity_{checkpoint}_{parity_workers}')
+                os.makedirs(output_dir)
+                digests.append(output_digest(process_and_write_files(
+                    group_files(parity_files, parity_lookup, logger),
+                    parity_lookup,
+                    output_dir,
+                    logger,
+                    parity_workers,
+                    checkpoint=checkpoint,
+                )))
+            if digests[0] != digests[1]:
+                raise AssertionError(f'Serial and parallel output differ (checkpoint={checkpoint})')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stations', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    for output in run(args.stations, args.rows, workers=args.workers, repeat=args.repeat):
+        rates = ', '.join(
+            f'{key} {value}' for key, value in output.items()
+            if key.endswith('_per_second')
+        )
+        print(f"{output['case']}: {output['seconds']:.4f}s ({rates})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Reading one station/field/month out of a processed year: a scan of the
+# json output against a lookup in the memory mapped query index. Both have
+# to find the same observations, and some.
+#   python -m benchmarks.bench_query
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from typing import Any, Dict, List
+
+from benchmarks.synthetic import fixture_stations, rows_per_year, write_fixture_set
+from prefect_pipeline.noaa_ndbc.process_historical_data import group_files, process_and_write_files
+from prefect_pipeline.noaa_ndbc.query_index import QueryIndex, build_query_index, iter_output_frames
+from prefect_pipeline.noaa_ndbc.stations import StationTable
+
+YEAR = 2010
+FIELD = 'wind_speed'
+logger = logging.getLogger(__name__)
+
+
+def scan(path: str, station_id: str, start: pd.Timestamp, end: pd.Timestamp) -> pd.Series:
+    # Same shape as QueryIndex.query, values by time
+    for frame_station_id, data_df in iter_output_frames(path):
+        if frame_station_id != station_id:
+            continue
+        data_df = data_df[data_df['field'] == FIELD]
+        timestamps = pd.to_datetime(data_df['datetime_utc'], utc=True)
+        in_range = (timestamps >= start) & (timestamps < end)
+        return pd.Series(
+            data_df['val'][in_range].to_numpy(dtype='float32'),
+            index=pd.DatetimeIndex(timestamps[in_range], name='datetime_utc'),
+        ).sort_index(kind='stable')
+    return pd.Series([], index=pd.DatetimeIndex([], tz='UTC'), dtype='float32')
+
+
+def run(stations: int = 20, rows: int = None, repeat: int = 20) -> List[Dict[str, Any]]:
+    # rows defaults to a whole year, the queried month has to be in there
+    rows = rows or rows_per_year(YEAR)
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        files = write_fixture_set(os.path.join(fixture_dir, 'feed'), stations, (YEAR,), rows)
+        station_ids = sorted(set(file_info['station_id'] for file_info in files.values()))
+        station_lookup = StationTable.from_records(fixture_stations(station_ids))
+        output_dir = os.path.join(fixture_dir, 'output')
+        os.makedirs(output_dir)
+        output_files = process_and_write_files(
+            group_files(files, station_lookup, logger),
+            station_lookup,
+            output_dir,
+            logger,
+        )
+        start = time.perf_counter()
+        build_query_index(output_files, output_dir)
+        build_seconds = time.perf_counter() - start
+
+        # The last station, a scan has to get through every other one first
+        station_id = station_ids[-1]
+        range_start = pd.Timestamp(f'{YEAR}-06-01', tz='UTC')
+        range_end = pd.Timestamp(f'{YEAR}-07-01', tz='UTC')
+        start = time.perf_counter()
+        scanned = scan(output_files[str(YEAR)], station_id, range_start, range_end)
+        scan_seconds = time.perf_counter() - start
+
+        index = QueryIndex(output_dir)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            series = index.query(station_id, FIELD, range_start, range_end)
+            timings.append(time.perf_counter() - start)
+        if scanned.empty:
+            raise AssertionError(f'No {FIELD} observations for {station_id} in {range_start:%Y-%m}, check rows')
+        if len(series) != len(scanned):
+            raise AssertionError(f'Index returned {len(series)} observations, scan found {len(scanned)}')
+        if not series.index.equals(scanned.index) or not np.array_equal(series.to_numpy(), scanned.to_numpy()):
+            raise AssertionError('Index and scan found different observations')
+        lookup_seconds = min(timings)
+    return [{
+        'benchmark': 'query_index',
+        'stations': stations,
+        'rows': rows,
+        'observations': len(series),
+        'build_seconds': round(build_seconds, 4),
+        'scan_seconds': round(scan_seconds, 4),
+        'lookup_seconds': round(lookup_seconds, 6),
+        'lookups_per_second': round(1 / lookup_seconds, 1),
+        'speedup': round(scan_seconds / lookup_seconds, 1),
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stations', type=int, default=20)
+    parser.add_argument('--rows', type=int, help='rows per station (default a whole year)')
+    args = parser.parse_args()
+    for result in run(args.stations, args.rows):
+        print(
+            f"{result['stations']} stations x {result['rows']} rows: index built in "
+            f"{result['build_seconds']:.2f}s, scan {result['scan_seconds'] * 1000:.0f}ms, "
+            f"lookup {result['lookup_seconds'] * 1000:.2f}ms ({result['speedup']:.0f}x)"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# A realtime refresh against a local stand-in for realtime2: the first
+# pass emits each station's whole 45 days, the second (files rewritten an
+# hour later) only the new rows. A few stations have no file and 404.
+#   python -m benchmarks.bench_realtime
+import argparse
+import logging
+import os
+import tempfile
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from benchmarks.fixtures import serve_directory
+from benchmarks.synthetic import write_realtime_file
+from prefect_pipeline.noaa_ndbc.merge import iter_json_arrays
+from prefect_pipeline.noaa_ndbc.realtime import refresh_realtime
+
+END = datetime(2026, 1, 1, 12, 0)
+logger = logging.getLogger(__name__)
+
+
+def write_feed(feed_dir: str, station_ids: List[str], end: datetime, days: int) -> int:
+    return sum(
+        write_realtime_file(os.path.join(feed_dir, f'{station_id.upper()}.txt'), end, days, seed=i)
+        for i, station_id in enumerate(station_ids)
+    )
+
+
+def run(stations: int = 100, days: int = 45, missing: int = 5, latency: float = 0.02) -> List[Dict[str, Any]]:
+    station_ids = [f'{41000 + i}' for i in range(stations)]
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        feed_dir = os.path.join(fixture_dir, 'realtime2')
+        output_dir = os.path.join(fixture_dir, 'realtime')
+        os.makedirs(feed_dir)
+        with serve_directory(feed_dir, latency=latency) as base_url:
+            write_feed(feed_dir, station_ids[missing:], END, days)
+            first = refresh_realtime(station_ids, output_dir, logger, base_url, requests_per_second=None)
+
+            # An hour on, six new rows per station
+            write_feed(feed_dir, station_ids[missing:], END + timedelta(hours=1), days)
+            second = refresh_realtime(station_ids, output_dir, logger, base_url, requests_per_second=None)
+
+        rows = 0
+        for path in os.listdir(output_dir):
+            if path.startswith('processed_rows.'):
+                rows += sum(len(records) for records in iter_json_arrays(os.path.join(output_dir, path)))
+        if len(first.missing) != missing or first.failed:
+            raise AssertionError(f'Expected {missing} missing stations, got {first.as_dict()}')
+        if second.updated != stations - missing:
+            raise AssertionError(f'Expected every station to have new rows, got {second.as_dict()}')
+        if rows != first.observations + second.observations:
+            raise AssertionError(f'{rows} observations written, {first.observations + second.observations} emitted')
+    return [{
+        'benchmark': 'realtime',
+        'stations': stations,
+        'days': days,
+        'latency': latency,
+        'first_seconds': round(first.seconds, 4),
+        'first_observations': first.observations,
+        'second_seconds': round(second.seconds, 4),
+        'second_observations': second.observations,
+        'stations_per_second': round(stations / second.seconds, 2),
+        'bytes': second.bytes,
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stations', type=int, default=100)
+    parser.add_argument('--days', type=int, default=45)
+    parser.add_argument('--missing', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+    for result in run(args.stations, args.days, args.missing, args.latency):
+        print(
+            f"{result['stations']} stations: first refresh {result['first_seconds']:.2f}s "
+            f"({result['first_observations']} observations), next {result['second_seconds']:.2f}s "
+            f"({result['second_observations']} new, {result['stations_per_second']:.0f} stations/s)"
+        )
+
+
+if __name__ == '__main__':
+    main()
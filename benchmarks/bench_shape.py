@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Long (melted) vs wide output: time and bytes written for a full year of
+# one station in each layout, json and parquet.
+#   python -m benchmarks.bench_shape
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from typing import Any, Dict, List
+
+from benchmarks.synthetic import LAYOUT_YEARS, write_stdmet_file
+from prefect_pipeline.noaa_ndbc.metrics import path_size
+from prefect_pipeline.noaa_ndbc.process_historical_data import process_and_write_files
+
+logger = logging.getLogger(__name__)
+
+
+def run(
+    years: List[int] = LAYOUT_YEARS,
+    output_formats: List[str] = ('json', 'parquet'),
+    rows: int = None,
+) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        for year in years:
+            filepath = os.path.join(fixture_dir, f'41001h{year}.txt.gz')
+            written_rows = write_stdmet_file(filepath, year, rows)
+            for output_format in output_formats:
+                timings = {}
+                sizes = {}
+                for output_shape in ('long', 'wide'):
+                    output_dir = os.path.join(fixture_dir, f'{year}-{output_format}-{output_shape}')
+                    os.makedirs(output_dir)
+                    start = time.perf_counter()
+                    output_files = process_and_write_files(
+                        {str(year): {('41001', filepath)}},
+                        {},
+                        output_dir,
+                        logger,
+                        output_format=output_format,
+                        output_shape=output_shape,
+                    )
+                    timings[output_shape] = time.perf_counter() - start
+                    sizes[output_shape] = path_size(output_files[str(year)])
+                results.append({
+                    'benchmark': 'output_shape',
+                    'year': year,
+                    'format': output_format,
+                    'rows': written_rows,
+                    'long_seconds': round(timings['long'], 4),
+                    'wide_seconds': round(timings['wide'], 4),
+                    'long_bytes': sizes['long'],
+                    'wide_bytes': sizes['wide'],
+                    'time_saved': round(1 - timings['wide'] / timings['long'], 3),
+                    'bytes_saved': round(1 - sizes['wide'] / sizes['long'], 3),
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=None, help='rows per file (default a full year)')
+    parser.add_argument('--format', action='append', dest='formats', choices=('json', 'parquet'))
+    args = parser.parse_args()
+    for result in run(output_formats=args.formats or ('json', 'parquet'), rows=args.rows):
+        print(
+            f"{result['year']} {result['format']}: {result['rows']} rows "
+            f"long {result['long_seconds']:.2f}s {result['long_bytes'] / 1024:.0f}KB, "
+            f"wide {result['wide_seconds']:.2f}s {result['wide_bytes'] / 1024:.0f}KB "
+            f"({result['time_saved']:.0%} time, {result['bytes_saved']:.0%} bytes saved)"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# End to end time for a refresh from a local stand-in for NDBC: download
+# every file to disk and then process it, against streaming the responses
+# straight into the parser. Both go through the default rate limit.
+# The two have to write the same output, and a stream that breaks off (the
+# connection dropped, or a gzip cut short) only loses that one file.
+#   python -m benchmarks.bench_stream
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from typing import Any, Dict, List
+
+from benchmarks.fixtures import output_digest, serve_directory
+from benchmarks.synthetic import fixture_stations, write_fixture_set
+from prefect_pipeline.noaa_ndbc.download import download_files
+from prefect_pipeline.noaa_ndbc.metrics import path_size
+from prefect_pipeline.noaa_ndbc.process_historical_data import group_files, process_and_write_files
+from prefect_pipeline.noaa_ndbc.stations import StationTable
+
+YEARS = (2010,)
+logger = logging.getLogger(__name__)
+
+
+def run(stations: int = 16, rows: int = 5000, latency: float = 0.02) -> List[Dict[str, Any]]:
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        feed_dir = os.path.join(fixture_dir, 'feed')
+        files = write_fixture_set(feed_dir, stations, YEARS, rows)
+        station_ids = sorted(set(file_info['station_id'] for file_info in files.values()))
+        station_lookup = StationTable.from_records(fixture_stations(station_ids))
+        with serve_directory(feed_dir, latency=latency) as base_url:
+            urls = {f'{base_url}/{os.path.basename(path)}': file_info for path, file_info in files.items()}
+
+            download_dir = os.path.join(fixture_dir, 'downloaded')
+            output_dir = os.path.join(fixture_dir, 'two_step')
+            os.makedirs(output_dir)
+            start = time.perf_counter()
+            download_files({url: os.path.join(download_dir, url.rsplit('/', 1)[-1]) for url in urls})
+            downloaded = {
+                os.path.join(download_dir, url.rsplit('/', 1)[-1]): file_info
+                for url, file_info in urls.items()
+            }
+            two_step_files = process_and_write_files(
+                group_files(downloaded, station_lookup, logger), station_lookup, output_dir, logger)
+            two_step_seconds = time.perf_counter() - start
+            disk_bytes = path_size(download_dir)
+
+            output_dir = os.path.join(fixture_dir, 'streamed')
+            os.makedirs(output_dir)
+            start = time.perf_counter()
+            streamed_files = process_and_write_files(
+                group_files(urls, station_lookup, logger), station_lookup, output_dir, logger)
+            streamed_seconds = time.perf_counter() - start
+        if output_digest(streamed_files) != output_digest(two_step_files):
+            raise AssertionError('Streamed output differs from the downloaded then processed output')
+
+        # One file's connection drops half way through, another is half a
+        # gzip. Everything else should come out as if they weren't listed.
+        truncated = dict(zip(sorted(os.path.basename(path) for path in files), ('connection', 'file')))
+        with serve_directory(feed_dir, latency=latency, truncate=truncated) as base_url:
+            urls = {f'{base_url}/{os.path.basename(path)}': file_info for path, file_info in files.items()}
+            output_dir = os.path.join(fixture_dir, 'truncated')
+            os.makedirs(output_dir)
+            truncated_files = process_and_write_files(
+                group_files(urls, station_lookup, logger), station_lookup, output_dir, logger)
+        output_dir = os.path.join(fixture_dir, 'intact')
+        os.makedirs(output_dir)
+        intact_files = process_and_write_files(
+            group_files(
+                {path: file_info for path, file_info in downloaded.items() if os.path.basename(path) not in truncated},
+                station_lookup,
+                logger,
+            ),
+            station_lookup,
+            output_dir,
+            logger,
+        )
+        if output_digest(truncated_files) != output_digest(intact_files):
+            raise AssertionError(f'Truncating {", ".join(truncated)} changed the output of the other files')
+    return [{
+        'benchmark': 'stream',
+        'files': len(files),
+        'rows': rows,
+        'latency': latency,
+        'two_step_seconds': round(two_step_seconds, 4),
+        'streamed_seconds': round(streamed_seconds, 4),
+        'two_step_files_per_second': round(len(files) / two_step_seconds, 2),
+        'streamed_files_per_second': round(len(files) / streamed_seconds, 2),
+        'feed_bytes_avoided': disk_bytes,
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stations', type=int, default=16)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+    for result in run(args.stations, args.rows, args.latency):
+        print(
+            f"{result['files']} files: download then process {result['two_step_seconds']:.2f}s, "
+            f"streamed {result['streamed_seconds']:.2f}s, "
+            f"{result['feed_bytes_avoided'] / 1024:.0f}KB not written to the feed"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Old strptime-per-row timestamp parsing vs the vectorized build_timestamps.
+#   python -m benchmarks.bench_timestamps
+import argparse
+import os
+import tempfile
+import time
+import pandas as pd
+
+from datetime import datetime
+from typing import Any, Dict, List
+
+from benchmarks.synthetic import rows_per_year, write_stdmet_file
+from prefect_pipeline.noaa_ndbc.process_historical_data import (
+    build_timestamps,
+    get_year_specific_parsing,
+)
+
+def old_timestamps(data_df: pd.DataFrame, date_columns: List[str]) -> pd.Series:
+    # What parse_dates + date_parser did: join the date columns with spaces
+    # and call the strptime lambda once per row.
+    date_format = ' '.join(
+        ['%y' if date_columns[0] == 'YY' else '%Y', '%m', '%d', '%H', '%M'][:len(date_columns)]
+    )
+    joined = data_df[date_columns].astype(str).agg(' '.join, axis=1)
+    return joined.map(lambda x: datetime.strptime(x, date_format))
+
+
+def run(years: List[int] = (1995, 2010), rows: int = 6 * 24 * 365) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        for year in years:
+            # An hourly year is 8760 rows, any more and a two digit year
+            # file runs on into 1900
+            year_rows = min(rows, rows_per_year(year))
+            filepath = os.path.join(fixture_dir, f'41001h{year}.txt.gz')
+            write_stdmet_file(filepath, year, year_rows)
+            date_columns, _ = get_year_specific_parsing(year)
+            data_df = pd.read_csv(
+                filepath,
+                compression='gzip',
+                delimiter=r'\s+',
+                skiprows=[1] if year >= 2007 else None,
+            )
+            timings = {}
+            for name, parse in (('strptime', old_timestamps), ('vectorized', build_timestamps)):
+                start = time.perf_counter()
+                parsed = parse(data_df, date_columns)
+                timings[name] = time.perf_counter() - start
+            old = old_timestamps(data_df, date_columns).dt.tz_localize('UTC')
+            assert (old.astype('datetime64[ns, UTC]') == parsed).all()
+            results.append({
+                'benchmark': 'timestamps',
+                'year': year,
+                'rows': year_rows,
+                'strptime_seconds': round(timings['strptime'], 4),
+                'vectorized_seconds': round(timings['vectorized'], 4),
+                'speedup': round(timings['strptime'] / timings['vectorized'], 1),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=6 * 24 * 365)
+    args = parser.parse_args()
+    for result in run(rows=args.rows):
+        print(
+            f"{result['year']}: {result['rows']} rows "
+            f"strptime {result['strptime_seconds']:.3f}s "
+            f"vectorized {result['vectorized_seconds']:.3f}s "
+            f"({result['speedup']}x)"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import contextlib
+import functools
+import hashlib
+import http.server
+import os
+import threading
+import time
+
+from typing import Dict, Iterator
+from urllib.parse import urlparse
+
+from compression import open_reader
+
+# How a file in truncate is cut short: connection drops the connection half
+# way through a body whose Content-Length is the whole file, file serves the
+# first half of the file as if that was all there was (a truncated gzip).
+TRUNCATE_MODES = ('connection', 'file')
+
+
+class FixtureRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # Serves files out of a fixture directory. latency is added to every
+    # request to stand in for the round trip to www.ndbc.noaa.gov.
+    # truncate is file name -> one of TRUNCATE_MODES.
+    latency = 0.0
+    truncate: Dict[str, str] = {}
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        mode = self.truncate.get(os.path.basename(urlparse(self.path).path))
+        if mode is None:
+            super().do_GET()
+            return
+        with open(self.translate_path(self.path), 'rb') as fixture_file:
+            data = fixture_file.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data) if mode == 'connection' else len(data) // 2))
+        self.end_headers()
+        self.wfile.write(data[:len(data) // 2])
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(http.server.ThreadingHTTPServer):
+    # The default backlog of 5 resets connections once a download pool
+    # opens more sockets than that at once.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+@contextlib.contextmanager
+def serve_directory(
+    directory: str,
+    latency: float = 0.0,
+    truncate: Dict[str, str] = None,
+) -> Iterator[str]:
+    for mode in (truncate or {}).values():
+        if mode not in TRUNCATE_MODES:
+            raise ValueError(f'Unknown truncate mode {mode}, expected one of {", ".join(TRUNCATE_MODES)}')
+    handler_class = type(
+        'LatencyFixtureRequestHandler',
+        (FixtureRequestHandler,),
+        {'latency': latency, 'truncate': dict(truncate or {})},
+    )
+    handler = functools.partial(handler_class, directory=directory)
+    server = FixtureServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def output_digest(output_files: Dict[str, str]) -> Dict[str, str]:
+    # Of the decompressed output, the compressed bytes can differ between
+    # runs with the parallel backends
+    digests = {}
+    for year, path in output_files.items():
+        content_hash = hashlib.sha256()
+        with open_reader(path) as input_file:
+            for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+                content_hash.update(chunk)
+        digests[year] = content_hash.hexdigest()
+    return digests
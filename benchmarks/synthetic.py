@@ -0,0 +1,163 @@
+import gzip
+import os
+import random
+
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+# (column, format, low, high, missing sentinel) for each stdmet field in the
+# order NDBC writes them. WDIR/PRES are WD/BAR before 2007.
+FIELDS = [
+    ('WDIR', '{:.0f}', 0, 360, '999'),
+    ('WSPD', '{:.1f}', 0, 25, '99.0'),
+    ('GST', '{:.1f}', 0, 35, '99.0'),
+    ('WVHT', '{:.2f}', 0, 8, '99.00'),
+    ('DPD', '{:.2f}', 2, 20, '99.00'),
+    ('APD', '{:.2f}', 2, 12, '99.00'),
+    ('MWD', '{:.0f}', 0, 360, '999'),
+    ('PRES', '{:.1f}', 980, 1040, '9999.0'),
+    ('ATMP', '{:.1f}', -10, 35, '999.0'),
+    ('WTMP', '{:.1f}', 0, 32, '999.0'),
+    ('DEWP', '{:.1f}', -15, 28, '999.0'),
+    ('VIS', '{:.1f}', 0, 11, '99.0'),
+    ('TIDE', '{:.2f}', -3, 3, '99.00'),
+]
+UNITS = {
+    '#YY': '#yr', 'MM': 'mo', 'DD': 'dy', 'hh': 'hr', 'mm': 'mn',
+    'WDIR': 'degT', 'WSPD': 'm/s', 'GST': 'm/s', 'WVHT': 'm', 'DPD': 'sec',
+    'APD': 'sec', 'MWD': 'degT', 'PRES': 'hPa', 'ATMP': 'degC', 'WTMP': 'degC',
+    'DEWP': 'degC', 'VIS': 'nmi', 'TIDE': 'ft',
+}
+# One year from each layout get_year_specific_parsing knows about
+LAYOUT_YEARS = (1995, 2003, 2006, 2010)
+
+
+def get_layout(year: int) -> Tuple[List[str], List[str], bool, int]:
+    # Returns the date columns, field columns, whether there is a units row
+    # and the observation interval in minutes, as NDBC wrote them that year.
+    field_columns = [f[0] for f in FIELDS]
+    if year < 2007:
+        field_columns = ['WD' if c == 'WDIR' else 'BAR' if c == 'PRES' else c for c in field_columns]
+    if year < 1999:
+        return ['YY', 'MM', 'DD', 'hh'], field_columns[:-1], False, 60
+    if year < 2005:
+        return ['YYYY', 'MM', 'DD', 'hh'], field_columns, False, 60
+    if year < 2007:
+        return ['YYYY', 'MM', 'DD', 'hh', 'mm'], field_columns, False, 10
+    return ['#YY', 'MM', 'DD', 'hh', 'mm'], field_columns, True, 10
+
+
+def rows_per_year(year: int) -> int:
+    return 365 * 24 * 60 // get_layout(year)[3]
+
+
+def write_stdmet_file(
+    filepath: str,
+    year: int,
+    rows: int = None,
+    missing_rate: float = 0.1,
+    seed: int = 0,
+    missing_marker: str = None,
+) -> int:
+    # Writes a synthetic {station}h{year}.txt.gz in that year's layout and
+    # returns the number of observation rows. missing_rate of the values are
+    # replaced with the field's missing sentinel, or with missing_marker
+    # ('MM', like the realtime and monthly files) when it is given.
+    date_columns, field_columns, units_row, interval = get_layout(year)
+    rows = rows or rows_per_year(year)
+    fields = FIELDS[:len(field_columns)]
+    rng = random.Random(seed)
+    start = datetime(year, 1, 1)
+    step = timedelta(minutes=interval)
+    with gzip.open(filepath, 'wt') as year_file:
+        header = date_columns + field_columns
+        year_file.write(' '.join(header) + '\n')
+        if units_row:
+            year_file.write(' '.join(UNITS[c] for c in header) + '\n')
+        for i in range(rows):
+            ts = start + i * step
+            values = [
+                ts.strftime('%y') if date_columns[0] == 'YY' else str(ts.year),
+                f'{ts.month:02d}',
+                f'{ts.day:02d}',
+                f'{ts.hour:02d}',
+                f'{ts.minute:02d}',
+            ][:len(date_columns)]
+            for _, value_format, low, high, sentinel in fields:
+                if rng.random() < missing_rate:
+                    values.append(missing_marker or sentinel)
+                else:
+                    values.append(value_format.format(rng.uniform(low, high)))
+            year_file.write(' '.join(values) + '\n')
+    return rows
+
+
+def write_realtime_file(
+    filepath: str,
+    end: datetime,
+    days: int = 45,
+    interval: int = 10,
+    missing_rate: float = 0.1,
+    seed: int = 0,
+) -> int:
+    # A realtime2 {STATION}.txt: plain text, the 2007+ layout plus PTDY,
+    # newest row first, ending at end. Values are seeded by timestamp so a
+    # later file repeats the rows an earlier one had. Returns the rows.
+    header = ['#YY', 'MM', 'DD', 'hh', 'mm'] + [f[0] for f in FIELDS[:-1]] + ['PTDY', 'TIDE']
+    units = [UNITS[c] if c != 'PTDY' else 'hPa' for c in header]
+    step = timedelta(minutes=interval)
+    rows = days * 24 * 60 // interval
+    with open(filepath, 'w') as realtime_file:
+        realtime_file.write(' '.join(header) + '\n')
+        realtime_file.write(' '.join(units) + '\n')
+        for i in range(rows):
+            ts = end - i * step
+            rng = random.Random(f'{seed}-{ts.isoformat()}')
+            values = [str(ts.year), f'{ts.month:02d}', f'{ts.day:02d}', f'{ts.hour:02d}', f'{ts.minute:02d}']
+            for column, value_format, low, high, _ in FIELDS[:-1]:
+                values.append('MM' if rng.random() < missing_rate else value_format.format(rng.uniform(low, high)))
+            values.append('MM' if rng.random() < missing_rate else f'{rng.uniform(-3, 3):+.1f}')
+            values.append('MM')
+            realtime_file.write(' '.join(values) + '\n')
+    return rows
+
+
+def write_fixture_set(
+    directory: str,
+    stations: int = 4,
+    years: Tuple[int, ...] = LAYOUT_YEARS,
+    rows: int = None,
+    missing_rate: float = 0.1,
+    seed: int = 0,
+) -> Dict[str, Dict[str, str]]:
+    # A file per station per year, named like NDBC's historical files.
+    # Returns them keyed by path with the file info group_files expects.
+    os.makedirs(directory, exist_ok=True)
+    files = {}
+    for station_number in range(stations):
+        station_id = f'{41001 + station_number}'
+        for year in years:
+            filepath = os.path.join(directory, f'{station_id}h{year}.txt.gz')
+            write_stdmet_file(filepath, year, rows, missing_rate, seed + station_number)
+            files[filepath] = {'station_id': station_id, 'year': str(year), 'month': None}
+    return files
+
+
+def fixture_stations(station_ids: List[str]) -> List[Dict[str, str]]:
+    # Station records for the fixture ids, in the shape of a station csv row
+    return [
+        {
+            'id': station_id,
+            'latitude': f'{30 + i * 0.5:.3f}',
+            'longitude': f'{-75 - i * 0.5:.3f}',
+            'name': f'Synthetic buoy {station_id}',
+            'owner': 'NDBC',
+            'program': 'NDBC Meteorological/Ocean',
+            'type': 'buoy',
+            'met': 'y',
+            'currents': 'n',
+            'water_quality': 'n',
+            'dart': 'n',
+        }
+        for i, station_id in enumerate(station_ids)
+    ]
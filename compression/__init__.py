@@ -0,0 +1,31 @@
+from compression.pigz import PigzReader, PigzWriter, pigz_available
+from compression.readers import open_reader
+from compression.writers import (
+    CompressedWriter,
+    CompressionOptions,
+    GzipWriter,
+    ParallelGzipWriter,
+    ZstdWriter,
+)
+
+BACKENDS = ('auto', 'pigz', 'parallel', 'gzip', 'zstd')
+
+
+def get_extension(options: CompressionOptions) -> str:
+    return '.zst' if options.backend == 'zstd' else '.gz'
+
+
+def open_writer(path: str, options: CompressionOptions = CompressionOptions()) -> CompressedWriter:
+    # auto uses pigz when it is installed and block parallel zlib otherwise.
+    backend = options.backend
+    if backend == 'auto':
+        backend = 'pigz' if pigz_available() else 'parallel'
+    if backend == 'pigz':
+        return PigzWriter(path, options.level, options.threads)
+    if backend == 'parallel':
+        return ParallelGzipWriter(path, options.level, options.threads)
+    if backend == 'gzip':
+        return GzipWriter(path, options.level)
+    if backend == 'zstd':
+        return ZstdWriter(path, options.level, options.threads)
+    raise ValueError(f'Unknown compression backend {backend}, expected one of {BACKENDS}')
@@ -0,0 +1,67 @@
+import shutil
+import subprocess
+
+from typing import Optional
+
+from compression.writers import DEFAULT_LEVEL, CompressedWriter
+
+
+def pigz_available() -> bool:
+    return shutil.which('pigz') is not None
+
+
+class PigzWriter(CompressedWriter):
+    # Pipes everything through a pigz subprocess, which compresses on all
+    # cores and keeps the work off of our GIL entirely.
+    def __init__(self, path: str, level: int = DEFAULT_LEVEL, threads: Optional[int] = None):
+        self.path = path
+        self._file = open(path, 'wb')
+        command = ['pigz', '-c', f'-{level}']
+        if threads:
+            command += ['-p', str(threads)]
+        try:
+            self._process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=self._file,
+            )
+        except OSError:
+            self._file.close()
+            raise
+
+    def _write(self, data: bytes):
+        self._process.stdin.write(data)
+
+    def close(self):
+        if not self.closed:
+            self._process.stdin.close()
+            returncode = self._process.wait()
+            self._file.close()
+            if returncode:
+                raise OSError(f'pigz exited with {returncode} writing {self.path}')
+        super().close()
+
+
+class PigzReader:
+    # Decompresses with a pigz subprocess. pigz inflates on one core but does
+    # the reading, writing and crc on others, and it keeps the work off of
+    # our process. Use as a context manager, the result is a binary stream.
+    def __init__(self, path: str, threads: Optional[int] = None):
+        self.path = path
+        command = ['pigz', '-d', '-c']
+        if threads:
+            command += ['-p', str(threads)]
+        self._process = subprocess.Popen(
+            command + [path],
+            stdout=subprocess.PIPE,
+        )
+
+    def __enter__(self):
+        return self._process.stdout
+
+    def __exit__(self, *exc_info):
+        self._process.stdout.close()
+        returncode = self._process.wait()
+        if returncode and not exc_info[0]:
+            raise OSError(f'pigz exited with {returncode} reading {self.path}')
+        return False
@@ -0,0 +1,32 @@
+import contextlib
+import gzip
+import os
+
+from typing import IO, Iterator, Optional
+
+from compression.pigz import PigzReader, pigz_available
+
+# Below this the cost of starting a pigz process is more than it saves.
+# Most of the NDBC station files are a few kb.
+PIGZ_MIN_BYTES = 8 * 1024 * 1024
+
+
+@contextlib.contextmanager
+def open_reader(path: str, threads: Optional[int] = None) -> Iterator[IO[bytes]]:
+    # Binary stream of the decompressed contents, picked by file extension.
+    # pandas can read it directly: pd.read_csv(input_file, ...)
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError('zstandard is required for zstd compression') from e
+        with open(path, 'rb') as compressed_file:
+            with zstandard.ZstdDecompressor().stream_reader(compressed_file) as input_file:
+                yield input_file
+        return
+    if pigz_available() and os.path.getsize(path) >= PIGZ_MIN_BYTES:
+        with PigzReader(path, threads) as input_file:
+            yield input_file
+        return
+    with gzip.open(path, 'rb') as input_file:
+        yield input_file
@@ -0,0 +1,129 @@
+import gzip
+import io
+import os
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional, Union
+
+DEFAULT_LEVEL = 6
+# Each block is compressed on its own and written as a separate gzip member.
+# Concatenated members are still one valid .gz file (gzip -d, zcat and
+# pandas all read it) at the cost of a slightly worse ratio than a single
+# stream.
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+
+class CompressionOptions(NamedTuple):
+    # backend is one of BACKENDS, threads=None means one per core.
+    backend: str = 'auto'
+    level: int = DEFAULT_LEVEL
+    threads: Optional[int] = None
+
+
+class CompressedWriter(io.IOBase):
+    # Base for the output writers. They take str or bytes (pandas' to_json
+    # hands us str) and are used as context managers:
+    #   with open_writer(path) as output_file:
+    #       data_df.to_json(output_file, orient='records')
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Union[str, bytes]) -> int:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._write(data)
+        return len(data)
+
+    def _write(self, data: bytes):
+        raise NotImplementedError
+
+
+class GzipWriter(CompressedWriter):
+    # stdlib gzip, single threaded. Always available.
+    def __init__(self, path: str, level: int = DEFAULT_LEVEL, threads: Optional[int] = None):
+        self.path = path
+        self._file = gzip.open(path, 'wb', compresslevel=level)
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def _compress_member(block: bytes, level: int) -> bytes:
+    # zlib drops the GIL while it compresses so these run in parallel threads
+    return gzip.compress(block, compresslevel=level, mtime=0)
+
+
+class ParallelGzipWriter(CompressedWriter):
+    # Block parallel gzip on a thread pool, for when pigz isn't installed.
+    # Blocks are written back in order with a bounded number in flight.
+    def __init__(
+        self,
+        path: str,
+        level: int = DEFAULT_LEVEL,
+        threads: Optional[int] = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+    ):
+        self.path = path
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self._file = open(path, 'wb')
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._members = 0
+
+    def _write(self, data: bytes):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+
+    def _submit(self, block: bytes):
+        self._pending.append(self._executor.submit(_compress_member, block, self.level))
+        self._members += 1
+        while len(self._pending) > self.threads * 2:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._buffer or not self._members:
+                    # An empty file still has to be a valid gzip file
+                    self._submit(bytes(self._buffer))
+                    self._buffer = bytearray()
+                while self._pending:
+                    self._file.write(self._pending.popleft().result())
+            finally:
+                self._executor.shutdown()
+                self._file.close()
+        super().close()
+
+
+class ZstdWriter(CompressedWriter):
+    # zstd via the optional zstandard package, multi threaded in libzstd.
+    def __init__(self, path: str, level: int = 3, threads: Optional[int] = None):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError('zstandard is required for zstd compression') from e
+        self.path = path
+        self._file = open(path, 'wb')
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads or -1)
+        self._stream = compressor.stream_writer(self._file)
+
+    def _write(self, data: bytes):
+        self._stream.write(data)
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+            self._file.close()
+        super().close()
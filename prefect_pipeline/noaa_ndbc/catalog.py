@@ -0,0 +1,158 @@
+import functools
+import re
+
+import os
+
+import pandas as pd
+
+from typing import Any, Dict, Iterable, Mapping, Optional, Pattern, Set, Tuple
+
+from prefect_pipeline.noaa_ndbc.discovery import ListingCache, fetch_listings
+
+HISTORICAL_STDMET_URL = 'https://www.ndbc.noaa.gov/data/historical/stdmet'
+RECENT_STDMET_URL = 'https://www.ndbc.noaa.gov/data/stdmet/%s'
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+# Every stdmet file name is {station_id}{separator}{year}.txt.gz, where the
+# separator is 'h' for the yearly archive and the month for the monthly
+# files: 1-9, then a, b and c for October to December.
+MONTH_SEPARATORS = ['1', '2', '3', '4', '5', '6', '7', '8', '9', 'a', 'b', 'c']
+CATALOG_COLUMNS = ['station_id', 'year', 'month']
+# Station ids listed by name in the unmatched summary, the rest are counted
+UNMATCHED_SAMPLE = 20
+
+
+@functools.lru_cache(maxsize=None)
+def filename_pattern(separator: str) -> Pattern:
+    # A listing only has the one separator, so it is part of the pattern
+    # and a station id ending in a digit can't be mistaken for the month.
+    return re.compile(
+        rf'^((?P<station_id>[^\n]+){re.escape(separator)}(?P<year>\d{{4}})\.txt\.gz)$',
+        re.MULTILINE,
+    )
+
+
+def build_catalog(
+    links: Iterable[str],
+    base_url: str,
+    separator: str = 'h',
+    month: str = None,
+    logger: Any = None,
+) -> pd.DataFrame:
+    # One listing's links as a table indexed by url, with the station_id,
+    # year and month (None for the archive) of each file. The links are
+    # joined into one string and the pattern run over it once, rather than
+    # once per link. Links that aren't stdmet file names are dropped and
+    # counted.
+    links = list(dict.fromkeys(links))
+    catalog = pd.DataFrame(
+        filename_pattern(separator).findall('\n'.join(links)),
+        columns=['filename', 'station_id', 'year'],
+    )
+    catalog.index = base_url + '/' + catalog.pop('filename')
+    catalog['month'] = month
+    if logger and len(catalog) < len(links):
+        matched = set(catalog.index)
+        invalid = [link for link in links if f'{base_url}/{link}' not in matched]
+        logger.warning(
+            f'Skipped {len(invalid)} links in {base_url} that are not '
+            f'stdmet file names, e.g. {invalid[0]}'
+        )
+    return catalog
+
+
+def fetch_historical_catalog(
+    cache: Optional[ListingCache] = None,
+    logger: Any = None,
+    offline: bool = False,
+) -> pd.DataFrame:
+    # The NOAA historical data is a vastly unorganized, and sharded by station id
+    # and year. The historical stdmet url has a list of these files in html.
+    # offline only reads the cache, see fetch_listings.
+    links = fetch_listings([HISTORICAL_STDMET_URL], cache, offline=offline)[HISTORICAL_STDMET_URL]
+    return build_catalog(links, HISTORICAL_STDMET_URL, separator='h', logger=logger)
+
+
+def fetch_recent_catalog(
+    cache: Optional[ListingCache] = None,
+    logger: Any = None,
+    offline: bool = False,
+) -> pd.DataFrame:
+    # All 12 month listings are fetched at once. Monthly file names have the
+    # month where the archive has 'h'.
+    month_urls = [RECENT_STDMET_URL % month for month in MONTHS]
+    listings = fetch_listings(month_urls, cache, offline=offline)
+    return pd.concat([
+        build_catalog(listings[url], url, separator=MONTH_SEPARATORS[i], month=str(i + 1), logger=logger)
+        for i, url in enumerate(month_urls)
+    ])
+
+
+def filter_catalog(
+    catalog: pd.DataFrame,
+    years: Optional[Iterable[str]] = None,
+    station_ids: Optional[Iterable[str]] = None,
+) -> pd.DataFrame:
+    # None keeps everything
+    if years is not None:
+        catalog = catalog[catalog['year'].isin(pd.Index(list(years)))]
+    if station_ids is not None:
+        catalog = catalog[catalog['station_id'].isin(pd.Index(list(station_ids)))]
+    return catalog
+
+
+def feed_filename(url: str, file_info: Dict[str, str]) -> str:
+    # Where a listed file is kept in the feed. The archive's own names are
+    # unique, a monthly file's name is the same every year so it gets one
+    # with the year in it.
+    if file_info['month'] is None:
+        return url.rsplit('/', 1)[-1]
+    return f"{file_info['station_id']}_{file_info['year']}_{file_info['month']}.txt.gz"
+
+
+def url_month(url: str) -> Optional[str]:
+    # The catalog month of a listed url, from the monthly listing it sits
+    # in, None for the archive
+    listing = url.rsplit('/', 2)[-2] if url.count('/') >= 2 else ''
+    return str(MONTHS.index(listing) + 1) if listing in MONTHS else None
+
+
+def feed_files(urls: Mapping[str, Dict[str, str]], feed_dir: str) -> Dict[str, str]:
+    # url -> path in feed_dir
+    return {url: os.path.join(feed_dir, feed_filename(url, file_info)) for url, file_info in urls.items()}
+
+
+def catalog_from_files(files: Mapping[str, Dict[str, str]]) -> pd.DataFrame:
+    # The {path: file_info} dicts the download tasks return, as a catalog
+    return pd.DataFrame(list(files.values()), index=list(files), columns=CATALOG_COLUMNS)
+
+
+def catalog_to_files(catalog: pd.DataFrame) -> Dict[str, Dict[str, str]]:
+    return catalog[CATALOG_COLUMNS].astype(object).where(catalog.notna(), None).to_dict('index')
+
+
+def select_known_stations(
+    catalog: pd.DataFrame,
+    station_lookup: Mapping[str, Any],
+    logger: Any = None,
+) -> pd.DataFrame:
+    # Semi-join on the station lookup. A half data point isn't useful,
+    # without a location it's just non-sense, so files for stations we have
+    # no metadata for are dropped, with one line saying which.
+    known = catalog['station_id'].isin(pd.Index(list(station_lookup)))
+    if logger and not known.all():
+        unmatched = catalog.loc[~known, 'station_id'].value_counts()
+        station_ids = ', '.join(sorted(unmatched.index[:UNMATCHED_SAMPLE]))
+        more = f' (+{len(unmatched) - UNMATCHED_SAMPLE} more)' if len(unmatched) > UNMATCHED_SAMPLE else ''
+        logger.warning(
+            f'Skipped {int(unmatched.sum())} files for {len(unmatched)} stations '
+            f'not in the station list: {station_ids}{more}'
+        )
+    return catalog[known]
+
+
+def group_catalog(catalog: pd.DataFrame) -> Dict[str, Set[Tuple[str, str]]]:
+    # year -> {(station_id, path)}
+    return {
+        year: set(zip(year_catalog['station_id'].tolist(), year_catalog.index.tolist()))
+        for year, year_catalog in catalog.groupby('year', sort=True)
+    }
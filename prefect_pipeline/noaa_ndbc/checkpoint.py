@@ -0,0 +1,228 @@
+import glob
+import json
+import os
+import shutil
+import threading
+
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple, TypedDict
+
+from compression import CompressionOptions, get_extension
+from prefect_pipeline.noaa_ndbc.download import is_url
+
+SEGMENTS_DIRNAME = 'segments'
+LEDGER_FILENAME = 'ledger.jsonl'
+
+
+# One line per finished segment: the processed output of one station file
+# for one year. Like the download manifest it is append only and the last
+# line for a segment wins. A station file that produced no rows is finished
+# too, with no segment (None) to show for it.
+class SegmentEntry(TypedDict):
+    year: str
+    station_id: str
+    source: str
+    source_size: Optional[int]
+    source_mtime: Optional[float]
+    segment: Optional[str]
+    size: int
+    completed_at: str
+
+
+def segment_key(year: str, source: str) -> str:
+    return f'{year}/{os.path.basename(source)}'
+
+
+def source_signature(source: str) -> Tuple[Optional[int], Optional[float]]:
+    # Monthly files get rewritten by NDBC, a segment made from an older
+    # copy of its source is not complete any more. A streamed source (a
+    # url) has no local copy to compare, it has none.
+    if is_url(source):
+        return None, None
+    stat = os.stat(source)
+    return stat.st_size, stat.st_mtime
+
+
+class SegmentLedger:
+    # Writes go to path, reads also take in read_paths (the ledgers of other
+    # shards) so a file done by any shard counts as done.
+    def __init__(self, path: str, read_paths: Iterable[str] = ()):
+        self.path = path
+        self.entries: Dict[str, SegmentEntry] = {}
+        self._lock = threading.Lock()
+        for ledger_path in [p for p in read_paths if p != path] + [path]:
+            if not os.path.exists(ledger_path):
+                continue
+            with open(ledger_path, 'r') as ledger_file:
+                for line in ledger_file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A run killed mid-write can leave a partial last line
+                        continue
+                    self.entries[segment_key(entry['year'], entry['source'])] = entry
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, year: str, source: str) -> Optional[SegmentEntry]:
+        return self.entries.get(segment_key(year, source))
+
+    def is_complete(self, year: str, source: str) -> bool:
+        entry = self.get(year, source)
+        if not entry:
+            return False
+        try:
+            size, mtime = source_signature(source)
+            return (
+                size == entry['source_size']
+                and mtime == entry['source_mtime']
+                and (entry['segment'] is None or os.path.getsize(entry['segment']) == entry['size'])
+            )
+        except OSError:
+            return False
+
+    def segment_paths(self, year: str, sources: Iterable[str]) -> List[str]:
+        # The completed segments for sources, in that order, skipping the
+        # ones that had no rows.
+        return [
+            self.get(year, source)['segment']
+            for source in sources
+            if self.is_complete(year, source) and self.get(year, source)['segment'] is not None
+        ]
+
+    def record(self, entry: SegmentEntry):
+        # fsync'd so a completed segment survives the machine going away
+        # right after, not just the process.
+        with self._lock:
+            self.entries[segment_key(entry['year'], entry['source'])] = entry
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a') as ledger_file:
+                ledger_file.write(json.dumps(entry) + '\n')
+                ledger_file.flush()
+                os.fsync(ledger_file.fileno())
+
+
+def load_ledger(output_directory: str, shard_name: Optional[str] = None) -> SegmentLedger:
+    # Shards that may run at the same time (on different machines even) each
+    # append to their own ledger.{shard_name}.jsonl.
+    segments_directory = os.path.join(output_directory, SEGMENTS_DIRNAME)
+    filename = f'ledger.{shard_name}.jsonl' if shard_name else LEDGER_FILENAME
+    return SegmentLedger(
+        os.path.join(segments_directory, filename),
+        sorted(glob.glob(os.path.join(segments_directory, 'ledger*.jsonl'))),
+    )
+
+
+def segment_directory(output_directory: str, year: str) -> str:
+    return os.path.join(output_directory, SEGMENTS_DIRNAME, f'year={year}')
+
+
+def year_segment_paths(directory: str) -> List[str]:
+    # The segments a year left uncompacted (its segment_directory, which is
+    # what stands in for the year file then) is made of, by the ledgers of
+    # every shard, in station file order. Segments left half written or
+    # replaced since they were recorded aren't part of it.
+    segments_directory, year_dirname = os.path.split(os.path.normpath(directory))
+    year = year_dirname[len('year='):]
+    ledger = SegmentLedger(
+        os.path.join(segments_directory, LEDGER_FILENAME),
+        sorted(glob.glob(os.path.join(segments_directory, 'ledger*.jsonl'))),
+    )
+    return sorted(
+        entry['segment'] for entry in ledger.entries.values()
+        if entry['year'] == year
+        and entry['segment'] is not None
+        and os.path.exists(entry['segment'])
+        and os.path.getsize(entry['segment']) == entry['size']
+    )
+
+
+def output_paths(path: str) -> List[str]:
+    # A json year output is one file, or a segment directory when
+    # compaction is off.
+    return year_segment_paths(path) if os.path.isdir(path) else [path]
+
+
+def segment_path(
+    output_directory: str,
+    year: str,
+    source: str,
+    compression: CompressionOptions = CompressionOptions(),
+) -> str:
+    # segments/year={year}/{source file name}.json.gz, the source name
+    # already has the station id in it.
+    source_name = os.path.basename(source)
+    for suffix in ('.gz', '.txt'):
+        if source_name.endswith(suffix):
+            source_name = source_name[:-len(suffix)]
+    return os.path.join(
+        segment_directory(output_directory, year),
+        f'{source_name}.json{get_extension(compression)}',
+    )
+
+
+def complete_segment(
+    ledger: SegmentLedger,
+    year: str,
+    station_id: str,
+    source: str,
+    partial_path: str,
+    path: str,
+):
+    # The segment was written to partial_path, it only becomes visible (and
+    # complete in the ledger) once it is all there.
+    os.replace(partial_path, path)
+    record_segment(ledger, year, station_id, source, path)
+
+
+def record_segment(
+    ledger: SegmentLedger,
+    year: str,
+    station_id: str,
+    source: str,
+    path: Optional[str] = None,
+):
+    # No path for a source that produced no rows, it is still done and a
+    # resume shouldn't parse it again.
+    source_size, source_mtime = source_signature(source)
+    ledger.record({
+        'year': year,
+        'station_id': station_id,
+        'source': source,
+        'source_size': source_size,
+        'source_mtime': source_mtime,
+        'segment': path,
+        'size': os.path.getsize(path) if path is not None else 0,
+        'completed_at': datetime.now(timezone.utc).isoformat(),
+    })
+
+
+def compact_segments(segment_paths: Iterable[str], output_path: str) -> str:
+    # Gzip members (and zstd frames) can simply be concatenated, so the year
+    # file is the segments back to back, byte for byte, in station order.
+    # That decompresses to exactly what a single pass would have written.
+    partial_path = output_path + '.part'
+    with open(partial_path, 'wb') as output_file:
+        for path in segment_paths:
+            with open(path, 'rb') as segment_file:
+                shutil.copyfileobj(segment_file, output_file, 1024 * 1024)
+    os.replace(partial_path, output_path)
+    return output_path
+
+
+def pending_stations(
+    ledger: SegmentLedger,
+    year: str,
+    stations: List[Tuple[str, str]],
+) -> List[Tuple[str, str]]:
+    # Streamed sources can't be checked for changes so they are always
+    # fetched again, their segments only carry a shard from processing to
+    # compaction.
+    return [
+        station for station in stations
+        if is_url(station[1]) or not ledger.is_complete(year, station[1])
+    ]
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# Runs the flows with settings from a json config file and the command line
+# (which wins), see config.PipelineConfig for what each one does.
+#   python -m prefect_pipeline.noaa_ndbc.cli --years 2020 2021 --pull incremental
+#   python -m prefect_pipeline.noaa_ndbc.cli --config ndbc.json --dry-run
+#   python -m prefect_pipeline.noaa_ndbc.cli realtime --once
+# prefect, pandas and the rest are only imported once there's a run to do,
+# --help and a bad option come back straight away.
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+
+from typing import Any, Dict, List, Optional
+
+from compression import BACKENDS
+from prefect_pipeline.noaa_ndbc.config import (
+    EXECUTORS,
+    OUTPUT_FORMATS,
+    OUTPUT_SHAPES,
+    PULL_MODES,
+    PipelineConfig,
+    load_config,
+)
+
+COMMANDS = ('run', 'realtime')
+
+
+def build_parser() -> argparse.ArgumentParser:
+    # Every option defaults to None (not given) so the config file's value
+    # stands unless it's set here. dest is the PipelineConfig field.
+    parser = argparse.ArgumentParser(
+        prog='python -m prefect_pipeline.noaa_ndbc.cli',
+        description='NOAA NDBC standard meteorological data pipeline',
+    )
+    parser.add_argument('command', nargs='?', choices=COMMANDS, default='run',
+                        help='run (historical and recent, the default) or realtime')
+    parser.add_argument('--config', help='json file of {setting: value}, see config.PipelineConfig')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list and plan the work from the listing and station caches, however old, without downloading or processing anything')
+    parser.add_argument('--show-config', action='store_true', help='print the settings the run would use and exit')
+
+    paths = parser.add_argument_group('paths')
+    paths.add_argument('--feed-dir', dest='feed_dir', help='downloaded files and caches (default $NDBC_FEED_DIR)')
+    paths.add_argument('--output-dir', dest='tmp_dir', help='processed output (default $NDBC_TMP_DIR)')
+
+    selection = parser.add_argument_group('selection')
+    selection.add_argument('--years', nargs='+', help='only these years')
+    selection.add_argument('--stations', nargs='+', help='only these station ids')
+    selection.add_argument('--pull', choices=PULL_MODES,
+                           help='cached: use the feed as it is, full: download everything, incremental: only new or changed files')
+    selection.add_argument('--stream-recent', dest='stream_recent', action='store_const', const=True,
+                           help='stream the monthly files into the parser instead of downloading them first')
+    selection.add_argument('--no-stream-recent', dest='stream_recent', action='store_const', const=False)
+
+    workers = parser.add_argument_group('workers')
+    workers.add_argument('--download-workers', type=int, help='concurrent downloads')
+    workers.add_argument('--executor', choices=EXECUTORS)
+    workers.add_argument('--workers', dest='executor_workers', type=int, help='executor processes')
+    workers.add_argument('--dask-address')
+    workers.add_argument('--shard-size', type=int, help='stations per work unit')
+    workers.add_argument('--shard-workers', type=int, help='processes per work unit')
+    workers.add_argument('--shard-inflight-bytes', type=int)
+    workers.add_argument('--realtime-workers', type=int, help='concurrent realtime fetches')
+
+    output = parser.add_argument_group('output')
+    output.add_argument('--output-format', choices=OUTPUT_FORMATS)
+    output.add_argument('--output-shape', choices=OUTPUT_SHAPES)
+    output.add_argument('--compression', dest='compression_backend', choices=BACKENDS)
+    output.add_argument('--compression-level', type=int)
+    output.add_argument('--compression-threads', type=int)
+    output.add_argument('--no-query-index', dest='build_query_index', action='store_const', const=False)
+    output.add_argument('--prometheus-textfile')
+
+    realtime = parser.add_argument_group('realtime')
+    realtime.add_argument('--realtime-interval', type=float, help='seconds between refreshes')
+    realtime.add_argument('--once', dest='realtime_interval', action='store_const', const=0,
+                          help='refresh once and exit')
+    return parser
+
+
+def plan_stages(config: PipelineConfig, logger: Any) -> List[Dict[str, Any]]:
+    # What a run with config would process: per stage the files, work units
+    # and their bytes, from the feed where a file is there already and the
+    # download manifest's record of it where it isn't. Only ever reads the
+    # listing and station caches, a missing one is a FileNotFoundError.
+    from prefect_pipeline.noaa_ndbc.catalog import (
+        catalog_to_files,
+        feed_files,
+        fetch_historical_catalog,
+        fetch_recent_catalog,
+        filter_catalog,
+    )
+    from prefect_pipeline.noaa_ndbc.discovery import ListingCache
+    from prefect_pipeline.noaa_ndbc.manifest import load_manifest
+    from prefect_pipeline.noaa_ndbc.process_historical_data import group_files, plan_work_units
+    from prefect_pipeline.noaa_ndbc.scheduler import file_size
+    from prefect_pipeline.noaa_ndbc.stations import DEFAULT_STATION_TTL, load_station_table
+
+    station_lookup = load_station_table(
+        config.station_cache_dir,
+        config.station_cache_ttl or DEFAULT_STATION_TTL,
+        logger,
+        offline=True,
+    )
+    cache = ListingCache(config.listing_cache_dir, math.inf)
+    feed_dir = os.path.join(config.feed_dir, 'historical')
+    manifest = load_manifest(feed_dir) if os.path.isdir(feed_dir) else None
+    plans = []
+    for stage, fetch_catalog in (
+        ('recent', fetch_recent_catalog),
+        ('historical', fetch_historical_catalog),
+    ):
+        urls = catalog_to_files(filter_catalog(
+            fetch_catalog(cache, logger, offline=True),
+            config.years,
+            config.stations,
+        ))
+        streamed = stage == 'recent' and config.stream_recent
+        # path -> url, a streamed file's path is its url
+        if streamed:
+            sources = {url: url for url in urls}
+        else:
+            sources = {path: url for url, path in feed_files(urls, feed_dir).items()}
+        files = {path: urls[url] for path, url in sources.items()}
+        work_units = plan_work_units(group_files(files, station_lookup, logger), config.shard_size)
+        sizes = {}
+        missing = 0
+        for unit in work_units:
+            for _, path in unit.stations:
+                size = 0 if streamed else file_size(path)
+                if not size:
+                    missing += 1
+                    entry = manifest.get(sources[path]) if manifest is not None else None
+                    size = entry['size'] if entry else 0
+                sizes[unit.year] = sizes.get(unit.year, 0) + size
+        plans.append({
+            'stage': stage,
+            'files': sum(len(unit.stations) for unit in work_units),
+            'not_in_feed': missing,
+            'streamed': streamed,
+            'work_units': len(work_units),
+            'stations': len(set(station[0] for unit in work_units for station in unit.stations)),
+            'bytes': sum(sizes.values()),
+            'years': {
+                year: {
+                    'work_units': sum(1 for unit in work_units if unit.year == year),
+                    'bytes': sizes.get(year, 0),
+                }
+                for year in sorted(set(unit.year for unit in work_units))
+            },
+        })
+    return plans
+
+
+def print_plan(config: PipelineConfig, command: str, logger: Any):
+    if command == 'realtime':
+        from prefect_pipeline.noaa_ndbc.realtime import REALTIME_BASE_URL
+        from prefect_pipeline.noaa_ndbc.stations import DEFAULT_STATION_TTL, load_station_table
+        station_lookup = load_station_table(
+            config.station_cache_dir,
+            config.station_cache_ttl or DEFAULT_STATION_TTL,
+            logger,
+            offline=True,
+        )
+        station_ids = list(station_lookup)
+        if config.stations is not None:
+            station_ids = [station_id for station_id in config.stations if station_id in station_lookup]
+        every = f'every {config.realtime_interval:g}s' if config.realtime_interval else 'once'
+        print(f'realtime: {len(station_ids)} stations from {REALTIME_BASE_URL} into {config.realtime_dir}, {every}')
+        return
+    for plan in plan_stages(config, logger):
+        source = 'streamed' if plan['streamed'] else f"{plan['not_in_feed']} not in the feed"
+        print(
+            f"{plan['stage']}: {plan['files']} files ({source}) for {plan['stations']} stations, "
+            f"{plan['work_units']} work units, {plan['bytes'] / 1024 / 1024:.1f}MB known"
+        )
+        for year, year_plan in plan['years'].items():
+            print(f"  {year}: {year_plan['work_units']} work units, {year_plan['bytes'] / 1024 / 1024:.1f}MB")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    overrides = {field: getattr(args, field) for field in PipelineConfig._fields if hasattr(args, field)}
+    try:
+        config = load_config(args.config, **overrides)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.show_config:
+        json.dump(config._asdict(), sys.stdout, indent=2)
+        print()
+        return
+    if args.dry_run:
+        logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+        try:
+            print_plan(config, args.command, logging.getLogger('noaa_ndbc'))
+        except FileNotFoundError as e:
+            sys.exit(f'{e}, a run without --dry-run fills the caches')
+        return
+    from prefect_pipeline.noaa_ndbc import prefect_ndbc
+    if args.command == 'realtime':
+        prefect_ndbc.realtime_main(config)
+    else:
+        prefect_ndbc.main(config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import json
+import os
+
+from typing import Any, NamedTuple, Optional, Tuple
+
+from compression import BACKENDS, CompressionOptions
+from prefect_pipeline.noaa_ndbc.scheduler import DEFAULT_MAX_INFLIGHT_BYTES
+
+# Everything a run can be tuned with. This module (and the cli in front of
+# it) keeps to the standard library and the equally light compression and
+# scheduler modules, so --help and config checks don't wait on prefect and
+# pandas. Settings whose default lives in a module that does pull those in
+# are None here, meaning that module's default.
+#
+# feed_dir and tmp_dir default to prefect_pipeline/output/{feed,tmp}/noaa_ndbc
+# beside this checkout, or NDBC_FEED_DIR / NDBC_TMP_DIR when they're set.
+OUTPUT_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'output')
+DEFAULT_FEED_DIR = os.environ.get('NDBC_FEED_DIR', os.path.join(OUTPUT_ROOT, 'feed', 'noaa_ndbc'))
+DEFAULT_TMP_DIR = os.environ.get('NDBC_TMP_DIR', os.path.join(OUTPUT_ROOT, 'tmp', 'noaa_ndbc'))
+OUTPUT_FORMATS = ('json', 'parquet')
+OUTPUT_SHAPES = ('long', 'wide')
+EXECUTORS = ('local', 'local_dask', 'dask')
+# cached processes whatever is in the feed already, full downloads every
+# listed file again and incremental only what's missing or changed.
+PULL_MODES = ('cached', 'full', 'incremental')
+
+
+class PipelineConfig(NamedTuple):
+    # Downloaded files (and the listing / station caches) go in feed_dir,
+    # everything the pipeline writes goes in tmp_dir.
+    feed_dir: str = DEFAULT_FEED_DIR
+    tmp_dir: str = DEFAULT_TMP_DIR
+    # Parsed directory listings and the station list are reused for this
+    # many seconds between runs
+    listing_cache_ttl: Optional[float] = None
+    station_cache_ttl: Optional[float] = None
+    # Only these years / station ids (None for all of them)
+    years: Optional[Tuple[str, ...]] = None
+    stations: Optional[Tuple[str, ...]] = None
+    pull: str = 'cached'
+    download_workers: Optional[int] = None
+    # Stamp observations with the station's position at the time (from the
+    # stationmetadata.xml history) rather than only its current one.
+    position_as_of: bool = True
+    # json (processed_rows.{year}.json.gz) or parquet (partitioned by
+    # year/station). long is a datetime_utc/field/val row per observation,
+    # wide a row per station timestamp with a column per field, written to
+    # its own directories, {stage}_wide.
+    output_format: str = 'json'
+    output_shape: str = 'long'
+    # Put the station dimensions back on every observation row for consumers
+    # that haven't moved to joining against the station table yet.
+    join_station_dimensions: bool = False
+    # backend is auto (pigz if installed, else block parallel zlib), pigz,
+    # parallel, gzip or zstd.
+    compression_backend: str = 'auto'
+    compression_level: int = 6
+    compression_threads: Optional[int] = None
+    # A prometheus textfile for node_exporter's textfile collector, beside
+    # the json run report that is always written.
+    prometheus_textfile: Optional[str] = None
+    # Processing is mapped over shards of up to shard_size stations per
+    # year. Json output is written as per station file segments with a
+    # ledger, so a retried shard or restarted run carries on where the last
+    # one stopped, and each year's segments are then stitched together.
+    shard_size: int = 50
+    compact_segments: bool = True
+    # How the shards run: local (one at a time), local_dask (a process pool
+    # on this machine) or dask (a distributed cluster at dask_address, or a
+    # LocalCluster when that's not set).
+    executor: str = 'local'
+    executor_workers: Optional[int] = os.cpu_count()
+    dask_address: Optional[str] = None
+    # Processes each shard uses for its own files. Worth raising with the
+    # local executor, files are then scheduled by size with at most
+    # shard_inflight_bytes of them in flight.
+    shard_workers: int = 1
+    shard_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES
+    # Stream the monthly files straight from NDBC into the parser instead of
+    # downloading them to the feed first. With retain_streamed the raw files
+    # are still kept in the feed as they go by.
+    stream_recent: bool = False
+    retain_streamed: bool = True
+    # Observations sorted in memory at a time when merging recent into
+    # historical (json output only)
+    merge_run_size: Optional[int] = None
+    # A memory mapped index beside the final output, see query_index
+    build_query_index: bool = True
+    # Realtime mode polls every active station each realtime_interval
+    # seconds (None refreshes once and exits), realtime_workers at a time.
+    realtime_workers: Optional[int] = None
+    realtime_interval: Optional[float] = 600
+
+    @property
+    def listing_cache_dir(self) -> str:
+        return os.path.join(self.feed_dir, 'listings')
+
+    @property
+    def station_cache_dir(self) -> str:
+        # activestations.xml / stationmetadata.xml and the parsed station table
+        return os.path.join(self.feed_dir, 'stations')
+
+    @property
+    def metrics_dir(self) -> str:
+        return os.path.join(self.tmp_dir, 'metrics')
+
+    @property
+    def realtime_dir(self) -> str:
+        return os.path.join(self.tmp_dir, 'realtime')
+
+    @property
+    def compression(self) -> CompressionOptions:
+        return CompressionOptions(
+            backend=self.compression_backend,
+            level=self.compression_level,
+            threads=self.compression_threads,
+        )
+
+    def output_directory(self, stage: str) -> str:
+        return os.path.join(
+            self.tmp_dir,
+            stage if self.output_shape == 'long' else f'{stage}_{self.output_shape}',
+        )
+
+
+def check_choice(name: str, value: Any, choices: Tuple[str, ...]):
+    if value not in choices:
+        raise ValueError(f'Unknown {name} {value}, expected one of {", ".join(choices)}')
+
+
+def load_config(path: Optional[str] = None, **overrides: Any) -> PipelineConfig:
+    # The defaults, then a json file of {setting: value}, then overrides
+    # (the command line, where None is an option that wasn't given).
+    values = {}
+    if path:
+        with open(path, 'r') as config_file:
+            values.update(json.load(config_file))
+    values.update({key: value for key, value in overrides.items() if value is not None})
+    unknown = sorted(set(values) - set(PipelineConfig._fields))
+    if unknown:
+        raise ValueError(f'Unknown settings in {path or "overrides"}: {", ".join(unknown)}')
+    # The defaults too, NDBC_FEED_DIR / NDBC_TMP_DIR can be relative
+    for key in ('feed_dir', 'tmp_dir', 'prometheus_textfile'):
+        value = values.get(key, PipelineConfig._field_defaults[key])
+        if value:
+            values[key] = os.path.abspath(os.path.expanduser(os.path.expandvars(value)))
+    # Catalog years are strings and station ids lower case
+    for key in ('years', 'stations'):
+        if values.get(key) is not None:
+            values[key] = tuple(sorted(set(str(value).lower() for value in values[key])))
+    config = PipelineConfig(**values)
+    check_choice('pull mode', config.pull, PULL_MODES)
+    check_choice('output format', config.output_format, OUTPUT_FORMATS)
+    check_choice('output shape', config.output_shape, OUTPUT_SHAPES)
+    check_choice('executor', config.executor, EXECUTORS)
+    check_choice('compression backend', config.compression_backend, BACKENDS)
+    # Segments are how json output is checkpointed, parquet has none to leave
+    # uncompacted. The merge and the query index read json segments as is.
+    if not config.compact_segments and config.output_format != 'json':
+        raise ValueError(f'compact_segments can only be turned off for json output, not {config.output_format}')
+    return config
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import re
+import time
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from prefect_pipeline.noaa_ndbc.download import build_session
+
+# NDBC's directory listings are plain apache indexes, one anchor per file.
+# Pulling the hrefs out with a regex is all we need from them, building a
+# whole soup tree for the ~20k links on the historical index is not.
+LINK_PATTERN = re.compile(r'<a\s[^>]*?href="([^"?]+\.txt\.gz)"', re.IGNORECASE)
+DEFAULT_LISTING_TTL = 6 * 60 * 60
+
+
+def parse_listing_links(html: str) -> List[str]:
+    links = list(dict.fromkeys(LINK_PATTERN.findall(html)))
+    if links or '.txt.gz' not in html:
+        return links
+    # Fast path found nothing but there are files on the page, the markup
+    # must have changed on us. Fall back to a real parser.
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    return list(dict.fromkeys(
+        link.get('href')
+        for link in soup.find_all('a', attrs={'href': re.compile(r'^.*\.txt(\.gz)')})
+    ))
+
+
+class ListingCache:
+    # Parsed listings on disk, one json file per url. Flow runs within ttl
+    # seconds of each other reuse them and skip discovery entirely.
+    def __init__(self, cache_dir: str, ttl: float = DEFAULT_LISTING_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self, url: str) -> str:
+        return os.path.join(
+            self.cache_dir,
+            hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json',
+        )
+
+    def get(self, url: str) -> Optional[List[str]]:
+        try:
+            with open(self._path(url), 'r') as cache_file:
+                listing = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        if listing.get('url') != url or time.time() - listing['fetched_at'] > self.ttl:
+            return None
+        return listing['links']
+
+    def put(self, url: str, links: List[str]):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(url)
+        with open(path + '.tmp', 'w') as cache_file:
+            json.dump({'url': url, 'fetched_at': time.time(), 'links': links}, cache_file)
+        os.replace(path + '.tmp', path)
+
+
+def fetch_listing(session: requests.Session, url: str) -> List[str]:
+    r = session.get(url, timeout=60)
+    r.raise_for_status()
+    return parse_listing_links(r.text)
+
+
+def fetch_listings(
+    urls: List[str],
+    cache: Optional[ListingCache] = None,
+    max_workers: int = 12,
+    session: Optional[requests.Session] = None,
+    offline: bool = False,
+) -> Dict[str, List[str]]:
+    # Returns url -> file links for every listing url, fetching whatever
+    # isn't fresh in the cache concurrently. offline never fetches, every
+    # listing has to be in the cache (give it a ttl of inf to take stale
+    # ones as well).
+    listings = {}
+    to_fetch = []
+    for url in urls:
+        links = cache.get(url) if cache else None
+        if links is None:
+            to_fetch.append(url)
+        else:
+            listings[url] = links
+    if to_fetch and offline:
+        raise FileNotFoundError(f'No cached listing for {", ".join(to_fetch)}')
+    if to_fetch:
+        session = session or build_session(max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetched = executor.map(lambda url: fetch_listing(session, url), to_fetch)
+            for url, links in zip(to_fetch, fetched):
+                listings[url] = links
+                if cache:
+                    cache.put(url, links)
+    return {url: listings[url] for url in urls}
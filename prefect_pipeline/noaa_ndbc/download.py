@@ -0,0 +1,375 @@
+import contextlib
+import gzip
+import hashlib
+import io
+import os
+import threading
+import time
+import zlib
+import requests
+import urllib3
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from typing import IO, Any, Dict, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+from prefect_pipeline.noaa_ndbc.manifest import DownloadManifest
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_REQUESTS_PER_SECOND = 10.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_TIMEOUT = 60
+CHUNK_SIZE = 1024 * 1024
+# NDBC occasionally throttles or 5xx's under load, these are worth retrying.
+# Anything else (404 for a station that got pulled, etc) is not.
+RETRY_STATUS_CODES = set([429, 500, 502, 503, 504])
+GZIP_MAGIC = b'\x1f\x8b'
+# A streamed file that fails part way through: the connection (TeeReader
+# turns urllib3's errors into requests' ones) or a gzip body cut short.
+STREAM_ERRORS = (requests.exceptions.RequestException, EOFError, gzip.BadGzipFile, zlib.error)
+
+
+def is_url(path: str) -> bool:
+    return path.startswith(('http://', 'https://'))
+
+
+def build_session(max_workers: int = DEFAULT_MAX_WORKERS) -> requests.Session:
+    # One pooled session shared by every download thread so connections to
+    # NDBC get reused instead of paying a new handshake for every file.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class HostRateLimiter:
+    # Spaces out request starts per host. Threads reserve the next free slot
+    # under the lock and then sleep outside of it until their slot comes up.
+    def __init__(self, requests_per_second: Optional[float]):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, url: str):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class RetryableStatusError(requests.exceptions.HTTPError):
+    pass
+
+
+class DownloadStats:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.unchanged = 0
+        self.seconds = 0.0
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def record(self, num_bytes: int):
+        with self._lock:
+            self.files += 1
+            self.bytes += num_bytes
+
+    def record_unchanged(self):
+        with self._lock:
+            self.unchanged += 1
+
+    def record_failure(self, url: str, error: Exception):
+        with self._lock:
+            self.failed[url] = str(error)
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes / (1024 * 1024) / self.seconds if self.seconds else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'unchanged': self.unchanged,
+            'seconds': round(self.seconds, 3),
+            'files_per_second': round(self.files_per_second, 2),
+            'mb_per_second': round(self.mb_per_second, 2),
+            'failed': len(self.failed),
+        }
+
+    def summary(self) -> str:
+        return (
+            f'Downloaded {self.files} files ({self.bytes / (1024 * 1024):.1f} MB) '
+            f'in {self.seconds:.1f}s: {self.files_per_second:.1f} files/s, '
+            f'{self.mb_per_second:.2f} MB/s, {self.unchanged} unchanged, '
+            f'{len(self.failed)} failed'
+        )
+
+
+def download_file(
+    session: requests.Session,
+    url: str,
+    output_path: str,
+    rate_limiter: HostRateLimiter,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    timeout: float = DEFAULT_TIMEOUT,
+    manifest: Optional[DownloadManifest] = None,
+    conditional: bool = False,
+    immutable: bool = False,
+) -> Optional[int]:
+    # Returns the number of bytes written, or None when the copy we already
+    # have is still current and nothing was transferred.
+    headers = {}
+    entry = manifest.get(url) if manifest is not None else None
+    if conditional and entry and entry['path'] == output_path and manifest.is_current(url):
+        if immutable:
+            # Historical years never change once published, no need to ask.
+            return None
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    # Stream the body straight to a .part file and rename it into place once
+    # it is complete, so a killed run never leaves a truncated .txt.gz behind.
+    partial_path = output_path + '.part'
+    for attempt in range(retries + 1):
+        rate_limiter.wait(url)
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                if r.status_code in RETRY_STATUS_CODES:
+                    raise RetryableStatusError(f'{r.status_code} for url: {url}')
+                r.raise_for_status()
+                if r.status_code == 304:
+                    return None
+                num_bytes = 0
+                content_hash = hashlib.sha256()
+                with open(partial_path, 'wb') as output_file:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        output_file.write(chunk)
+                        content_hash.update(chunk)
+                        num_bytes += len(chunk)
+                etag = r.headers.get('ETag')
+                last_modified = r.headers.get('Last-Modified')
+            os.replace(partial_path, output_path)
+            if manifest is not None:
+                manifest.record({
+                    'url': url,
+                    'path': output_path,
+                    'size': num_bytes,
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'sha256': content_hash.hexdigest(),
+                    'fetched_at': datetime.now(timezone.utc).isoformat(),
+                })
+            return num_bytes
+        except (
+            RetryableStatusError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+
+def download_files(
+    downloads: Dict[str, str],
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    requests_per_second: Optional[float] = DEFAULT_REQUESTS_PER_SECOND,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    session: Optional[requests.Session] = None,
+    logger: Any = None,
+    manifest: Optional[DownloadManifest] = None,
+    conditional: bool = False,
+    immutable: bool = False,
+) -> DownloadStats:
+    # downloads is a lookup of url -> local output path.
+    # A full pull is thousands of small files so we are bound by round trip
+    # latency, not bandwidth. Keep a bounded number of requests in flight.
+    # With conditional set, files already in the manifest are only fetched
+    # again if the server says they changed (or never, if immutable).
+    session = session or build_session(max_workers)
+    rate_limiter = HostRateLimiter(requests_per_second)
+    stats = DownloadStats()
+    for output_dir in set(os.path.dirname(path) for path in downloads.values()):
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                download_file,
+                session,
+                url,
+                output_path,
+                rate_limiter,
+                retries,
+                backoff,
+                DEFAULT_TIMEOUT,
+                manifest,
+                conditional,
+                immutable,
+            ): url
+            for url, output_path in downloads.items()
+        }
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                num_bytes = future.result()
+                if num_bytes is None:
+                    stats.record_unchanged()
+                else:
+                    stats.record(num_bytes)
+            except requests.exceptions.RequestException as e:
+                stats.record_failure(url, e)
+                if logger:
+                    logger.warning(f'Failed to download {url}: {e}')
+    # Every incremental run re-records whatever it fetched again, without
+    # this the manifest grows by that many lines each run.
+    if manifest is not None:
+        manifest.compact()
+    stats.seconds = time.monotonic() - start
+    return stats
+
+
+class TeeReader(io.RawIOBase):
+    # The raw (still gzipped) bytes of a response as they are read, counted,
+    # hashed and copied into archive_file when there is one.
+    def __init__(self, response: requests.Response, archive_file: Optional[IO[bytes]] = None):
+        self._raw = response.raw
+        self._archive_file = archive_file
+        self.bytes_read = 0
+        self.content_hash = hashlib.sha256()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        # Reading the raw response skips requests, so its wrapping of
+        # urllib3's errors is done here the way Response.iter_content does.
+        try:
+            data = self._raw.read(len(buffer), decode_content=True)
+        except urllib3.exceptions.ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except urllib3.exceptions.DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except urllib3.exceptions.SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        except urllib3.exceptions.HTTPError as e:
+            # ReadTimeoutError and whatever else the connection can raise
+            raise requests.exceptions.ConnectionError(e)
+        num_bytes = len(data)
+        buffer[:num_bytes] = data
+        self.bytes_read += num_bytes
+        self.content_hash.update(data)
+        if self._archive_file is not None:
+            self._archive_file.write(data)
+        return num_bytes
+
+    def drain(self):
+        # Whatever the reader didn't need (gzip trailers, an empty file)
+        # still belongs in the archive copy.
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+@contextlib.contextmanager
+def open_stream(
+    session: requests.Session,
+    url: str,
+    rate_limiter: HostRateLimiter,
+    archive_path: Optional[str] = None,
+    manifest: Optional[DownloadManifest] = None,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    timeout: float = DEFAULT_TIMEOUT,
+) -> Iterator[Tuple[IO[bytes], TeeReader]]:
+    # The decompressed body of a .txt.gz (or a plain .txt, told apart by a
+    # peek at the first bytes) as a binary stream, inflated as it comes off
+    # the socket so it can go straight into the parser without landing on
+    # disk, along with the TeeReader under it (for its counts). With
+    # archive_path the raw bytes are written there as they go by (.part then
+    # renamed, and recorded in the manifest, exactly like download_file)
+    # once the whole body has been read.
+    # Only getting the response is retried, once the caller has started on
+    # the body a failure is theirs to retry.
+    for attempt in range(retries + 1):
+        rate_limiter.wait(url)
+        response = None
+        try:
+            response = session.get(url, stream=True, timeout=timeout)
+            if response.status_code in RETRY_STATUS_CODES:
+                raise RetryableStatusError(f'{response.status_code} for url: {url}')
+            response.raise_for_status()
+            break
+        except (
+            RetryableStatusError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ):
+            if response is not None:
+                response.close()
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+        except requests.exceptions.RequestException:
+            if response is not None:
+                response.close()
+            raise
+
+    partial_path = archive_path + '.part' if archive_path else None
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(response)
+        archive_file = None
+        if partial_path:
+            os.makedirs(os.path.dirname(partial_path) or '.', exist_ok=True)
+            archive_file = stack.enter_context(open(partial_path, 'wb'))
+        tee = TeeReader(response, archive_file)
+        try:
+            buffered = io.BufferedReader(tee, CHUNK_SIZE)
+            if buffered.peek(2)[:2] == GZIP_MAGIC:
+                with gzip.GzipFile(fileobj=buffered, mode='rb') as input_file:
+                    yield input_file, tee
+            else:
+                # Plain text, the realtime files aren't compressed
+                yield buffered, tee
+            tee.drain()
+        except BaseException:
+            if archive_file is not None:
+                archive_file.close()
+                os.remove(partial_path)
+            raise
+    if archive_path:
+        os.replace(partial_path, archive_path)
+        if manifest is not None:
+            manifest.record({
+                'url': url,
+                'path': archive_path,
+                'size': tee.bytes_read,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'sha256': tee.content_hash.hexdigest(),
+                'fetched_at': datetime.now(timezone.utc).isoformat(),
+            })
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+
+from typing import Dict, Optional, TypedDict
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+
+# One line per fetched file. The manifest is append only, the last line for
+# a url wins when it gets loaded back in.
+class ManifestEntry(TypedDict):
+    url: str
+    path: str
+    size: int
+    etag: Optional[str]
+    last_modified: Optional[str]
+    sha256: str
+    fetched_at: str
+
+
+class DownloadManifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, ManifestEntry] = {}
+        # Lines in the file, more than there are entries once urls get
+        # fetched again
+        self.lines = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as manifest_file:
+                for line in manifest_file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    self.lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A run killed mid-write can leave a partial last line
+                        continue
+                    self.entries[entry['url']] = entry
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, url: str) -> Optional[ManifestEntry]:
+        return self.entries.get(url)
+
+    def is_current(self, url: str) -> bool:
+        # We only trust an entry if the file it points to is still on disk
+        # and hasn't been truncated or replaced behind our back.
+        entry = self.entries.get(url)
+        if not entry:
+            return False
+        try:
+            return os.path.getsize(entry['path']) == entry['size']
+        except OSError:
+            return False
+
+    def record(self, entry: ManifestEntry):
+        with self._lock:
+            self.entries[entry['url']] = entry
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a') as manifest_file:
+                manifest_file.write(json.dumps(entry) + '\n')
+            self.lines += 1
+
+    def compact(self):
+        # Rewrite the manifest with only the latest entry per url, when there
+        # are superseded ones to drop.
+        with self._lock:
+            if self.lines <= len(self.entries):
+                return
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as manifest_file:
+                for entry in self.entries.values():
+                    manifest_file.write(json.dumps(entry) + '\n')
+            os.replace(tmp_path, self.path)
+            self.lines = len(self.entries)
+
+
+def load_manifest(output_dir: str) -> DownloadManifest:
+    return DownloadManifest(os.path.join(output_dir, MANIFEST_FILENAME))
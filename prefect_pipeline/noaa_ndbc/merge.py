@@ -0,0 +1,216 @@
+import heapq
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from contextlib import ExitStack
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from compression import CompressionOptions, get_extension, open_reader, open_writer
+from prefect_pipeline.noaa_ndbc.checkpoint import output_paths
+
+# Observations held in memory per sorted run before it is spilled to disk.
+# ~200 bytes each, so about 200MB.
+DEFAULT_RUN_SIZE = 1000000
+# Most runs merged at once, more than this are merged in passes so we never
+# hold more than this many files open.
+MERGE_FAN_IN = 64
+READ_BLOCK_SIZE = 1024 * 1024
+# Lower sorts first and wins a duplicate key
+HISTORICAL = '0'
+RECENT = '1'
+_decoder = json.JSONDecoder()
+
+
+def _iter_json_values(path: str, separators: str) -> Iterator[Tuple[Any, str]]:
+    # Decodes the json values in path one after another, skipping any of
+    # separators in between, and yields each with its original text.
+    with open_reader(path) as binary_file:
+        input_file = io.TextIOWrapper(binary_file, encoding='utf-8')
+        buffer = ''
+        position = 0
+        end_of_file = False
+        while True:
+            while position < len(buffer) and buffer[position] in separators:
+                position += 1
+            try:
+                value, end = _decoder.raw_decode(buffer, position)
+            except ValueError:
+                # Ran off the end of the buffer part way through a value.
+                # Reading at least as much again as we have keeps a large
+                # value (a whole array) from being re-decoded once per block.
+                if end_of_file:
+                    if position < len(buffer):
+                        raise ValueError(f'Truncated json in {path}')
+                    return
+                block = input_file.read(max(READ_BLOCK_SIZE, len(buffer) - position))
+                end_of_file = not block
+                buffer = buffer[position:] + block
+                position = 0
+                continue
+            yield value, buffer[position:end]
+            position = end
+
+
+def iter_json_records(path: str) -> Iterator[Tuple[dict, str]]:
+    # The json sink writes a json array per station file, back to back. We
+    # walk the objects inside them one at a time instead of loading whole
+    # arrays, yielding each record along with its original text.
+    return _iter_json_values(path, ' \n\r\t[],')
+
+
+def iter_json_arrays(path: str) -> Iterator[List[dict]]:
+    # The same files an array (one station file's records) at a time, which
+    # is a lot faster when the records are going into a frame anyway.
+    for records, _ in _iter_json_values(path, ' \n\r\t'):
+        yield records
+
+
+def sort_line(record: dict, text: str, precedence: str) -> str:
+    # station_id, datetime_utc and field tab separated ahead of the record.
+    # None of them contain tabs (json escapes them) and \t sorts before any
+    # printable character, so plain string order on the lines is the order
+    # of the key tuple. datetime_utc is fixed width iso, so it sorts in time.
+    # Wide shaped records have no field, they key on station and time.
+    station_id = record['station_id'] if 'station_id' in record else record['id']
+    field = record.get('field', '')
+    return f"{station_id}\t{record['datetime_utc']}\t{field}\t{precedence}\t{text}\n"
+
+
+def line_key(line: str) -> str:
+    return line[:line.index('\t', line.index('\t', line.index('\t') + 1) + 1)]
+
+
+def write_run(lines: List[str], directory: str) -> str:
+    lines.sort()
+    handle, path = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(handle, 'w') as run_file:
+        run_file.writelines(lines)
+    return path
+
+
+def merge_runs(run_paths: List[str], directory: str) -> Iterator[str]:
+    # Merge passes of MERGE_FAN_IN runs until one pass can take them all
+    while len(run_paths) > MERGE_FAN_IN:
+        merged_paths = []
+        for start in range(0, len(run_paths), MERGE_FAN_IN):
+            group = run_paths[start:start + MERGE_FAN_IN]
+            handle, path = tempfile.mkstemp(suffix='.run', dir=directory)
+            with os.fdopen(handle, 'w') as run_file, ExitStack() as stack:
+                run_file.writelines(heapq.merge(*[stack.enter_context(open(p, 'r')) for p in group]))
+            for p in group:
+                os.remove(p)
+            merged_paths.append(path)
+        run_paths = merged_paths
+    with ExitStack() as stack:
+        yield from heapq.merge(*[stack.enter_context(open(p, 'r')) for p in run_paths])
+
+
+def sorted_observations(
+    sources: List[Tuple[str, str]],
+    directory: str,
+    run_size: int = DEFAULT_RUN_SIZE,
+) -> Iterator[str]:
+    # External sort of every observation in sources, a list of (path,
+    # precedence), a path being a year file or its segment directory.
+    # Memory is bounded by run_size whatever the input size.
+    run_paths = []
+    lines = []
+    for path, precedence in sources:
+        for file_path in output_paths(path):
+            for record, text in iter_json_records(file_path):
+                lines.append(sort_line(record, text, precedence))
+                if len(lines) >= run_size:
+                    run_paths.append(write_run(lines, directory))
+                    lines = []
+    if lines:
+        run_paths.append(write_run(lines, directory))
+    return merge_runs(run_paths, directory)
+
+
+def merge_year(
+    historical_path: Optional[str],
+    recent_path: Optional[str],
+    output_path: str,
+    compression: CompressionOptions = CompressionOptions(),
+    run_size: int = DEFAULT_RUN_SIZE,
+    tmp_dir: Optional[str] = None,
+) -> Dict[str, int]:
+    # One year of observations from the yearly archive and the monthly
+    # files, deduplicated on (station_id, datetime_utc, field). When a month
+    # has made it into the archive the archive's value is kept. Written as a
+    # json array per station, sorted by time then field.
+    sources = [
+        (path, precedence)
+        for path, precedence in ((historical_path, HISTORICAL), (recent_path, RECENT))
+        if path and os.path.exists(path)
+    ]
+    counts = {'observations': 0, 'duplicates': 0}
+    run_directory = tempfile.mkdtemp(prefix='merge-', dir=tmp_dir or os.path.dirname(output_path))
+    partial_path = output_path + '.part'
+    try:
+        with open_writer(partial_path, compression) as output_file:
+            previous_key = None
+            previous_station_id = None
+            for line in sorted_observations(sources, run_directory, run_size):
+                key = line_key(line)
+                if key == previous_key:
+                    counts['duplicates'] += 1
+                    continue
+                station_id = key[:key.index('\t')]
+                if station_id != previous_station_id:
+                    output_file.write(']' if previous_station_id is not None else '')
+                    output_file.write('[')
+                else:
+                    output_file.write(',')
+                output_file.write(line[line.index('\t', len(key) + 1) + 1:-1])
+                counts['observations'] += 1
+                previous_key = key
+                previous_station_id = station_id
+            if previous_station_id is not None:
+                output_file.write(']')
+        os.replace(partial_path, output_path)
+    finally:
+        shutil.rmtree(run_directory, ignore_errors=True)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return counts
+
+
+def merge_outputs(
+    historical_files: Dict[str, str],
+    recent_files: Dict[str, str],
+    output_directory: str,
+    compression: CompressionOptions = CompressionOptions(),
+    run_size: int = DEFAULT_RUN_SIZE,
+    logger=None,
+) -> Dict[str, str]:
+    # Years with monthly data are merged into output_directory. Years that
+    # only exist in the archive have nothing to dedupe, they are left where
+    # they are and their path is passed through.
+    os.makedirs(output_directory, exist_ok=True)
+    output_files = {}
+    for year in sorted(set(historical_files) | set(recent_files)):
+        if year not in recent_files:
+            output_files[year] = historical_files[year]
+            continue
+        output_path = os.path.join(
+            output_directory,
+            f'processed_rows.{year}.json{get_extension(compression)}',
+        )
+        counts = merge_year(
+            historical_files.get(year),
+            recent_files[year],
+            output_path,
+            compression,
+            run_size,
+        )
+        if logger:
+            logger.info(
+                f'Merged {year}: {counts["observations"]} observations, '
+                f'{counts["duplicates"]} duplicates dropped'
+            )
+        output_files[year] = output_path
+    return output_files
@@ -0,0 +1,144 @@
+import contextlib
+import json
+import os
+import sys
+import time
+
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+METRIC_PREFIX = 'ndbc'
+
+
+def path_size(path: str) -> int:
+    # A json output is one file, parquet output is a directory of parts
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(directory, filename))
+            for directory, _, filenames in os.walk(path)
+            for filename in filenames
+        )
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def peak_rss_bytes() -> Dict[str, Optional[int]]:
+    # High water mark for this process and for the (finished) pool workers.
+    # ru_maxrss is KB on linux and bytes on mac, resource doesn't exist on
+    # windows.
+    try:
+        import resource
+    except ImportError:
+        return {'self': None, 'children': None}
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+class RunMetrics:
+    # Everything a flow run measured, kept in one place so it can be written
+    # out as a json report (and a prometheus textfile) at the end of the run.
+    # Tasks keep their own and hand it back to be merged into the run's, a
+    # task may run in another process (or machine) with a copy of anything
+    # it was passed. The download and parse stats are recorded as is.
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.downloads: Dict[str, Dict[str, Any]] = {}
+        self.parsing: Dict[str, Dict[str, Any]] = {}
+        self.outputs: Dict[str, Dict[str, int]] = {}
+        self.files: List[Dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += time.monotonic() - start
+            stage['calls'] += 1
+
+    def record_download(self, name: str, stats: Any):
+        # stats is a download.DownloadStats
+        self.downloads[name] = stats.as_dict()
+
+    def record_parse(self, name: str, parse_stats: Any):
+        # parse_stats is a process_historical_data.ParseStats
+        self.parsing[name] = parse_stats.as_dict()
+        self.files.extend({'stage': name, **file_metrics} for file_metrics in parse_stats.file_metrics)
+
+    def record_outputs(self, name: str, output_files: Dict[str, str]):
+        self.outputs[name] = {year: path_size(path) for year, path in output_files.items()}
+
+    def merge(self, other: 'RunMetrics'):
+        for name, other_stage in other.stages.items():
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += other_stage['seconds']
+            stage['calls'] += other_stage['calls']
+        self.downloads.update(other.downloads)
+        self.parsing.update(other.parsing)
+        self.outputs.update(other.outputs)
+        self.files.extend(other.files)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'started_at': self.started_at.isoformat(),
+            # Wall clock, this may be written in another process than the
+            # one the run started in
+            'seconds': round((datetime.now(timezone.utc) - self.started_at).total_seconds(), 3),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': {
+                name: {'seconds': round(stage['seconds'], 3), 'calls': stage['calls']}
+                for name, stage in self.stages.items()
+            },
+            'downloads': self.downloads,
+            'parsing': self.parsing,
+            'bytes_written': self.outputs,
+            'files': self.files,
+        }
+
+    def write_json(self, path: str) -> str:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as report_file:
+            json.dump(self.as_dict(), report_file, indent=2)
+        return path
+
+    def prometheus_lines(self) -> List[str]:
+        # Run level totals only, the per file breakdown lives in the json.
+        report = self.as_dict()
+        lines = []
+
+        def gauge(name, value, **labels):
+            if value is None:
+                return
+            label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+            label_text = '{' + label_text + '}' if label_text else ''
+            lines.append(f'{METRIC_PREFIX}_{name}{label_text} {value}')
+
+        gauge('run_seconds', report['seconds'])
+        gauge('run_started_timestamp_seconds', round(self.started_at.timestamp(), 3))
+        for process, rss in report['peak_rss_bytes'].items():
+            gauge('peak_rss_bytes', rss, process=process)
+        for stage, stage_metrics in report['stages'].items():
+            gauge('stage_seconds', stage_metrics['seconds'], stage=stage)
+            gauge('stage_calls', stage_metrics['calls'], stage=stage)
+        for stage, download in report['downloads'].items():
+            for key in ('files', 'bytes', 'unchanged', 'failed', 'seconds'):
+                gauge(f'download_{key}', download[key], stage=stage)
+        for stage, parsing in report['parsing'].items():
+            for key, value in parsing.items():
+                gauge(f'parse_{key}', value, stage=stage)
+        for stage, outputs in report['bytes_written'].items():
+            gauge('bytes_written', sum(outputs.values()), stage=stage)
+        return lines
+
+    def write_prometheus(self, path: str) -> str:
+        # node_exporter's textfile collector can read a half written file,
+        # so write next to it and rename into place.
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write('\n'.join(self.prometheus_lines()) + '\n')
+        os.replace(path + '.tmp', path)
+        return path
@@ -139,4 +139,22 @@ StandardMeteorologicalDataConversionPre2006 = {
     # 'PTDY': 'pressure_tendency',
     # This exists post 2000 but its more annoying to keep.
     # 'TIDE': 'tide',
-}
\ No newline at end of file
+}
+
+# Missing value markers NDBC writes for each field. A sentinel only means
+# missing for its own field (99 is a perfectly good wind direction).
+StandardMeteorologicalDataNullValues = {
+    'wind_direction': 999,
+    'wind_speed': 99,
+    'gust': 99,
+    'wave_height': 99,
+    'dominant_period': 99,
+    'average_period': 99,
+    'dominant_direction': 999,
+    'pressure': 9999,
+    'air_temp': 999,
+    'wave_temp': 999,
+    'dewpoint_temp': 999,
+    'visibility': 99,
+    'tide': 99,
+}
@@ -1,255 +1,581 @@
 import os
 import prefect
-import requests
-import re
-import xmltodict
-
-from bs4 import BeautifulSoup
-from prefect import task, Flow
-from typing import List, Dict, IO, Tuple
-
-from prefect_pipeline.noaa_ndbc.models import (
-    NDBCStation,
-    NDBCSourceStation,
-    SourceStationConversion
+
+from datetime import timedelta
+from prefect import task, unmapped, Flow
+from typing import Any, List, Dict, IO, Tuple
+
+from compression import CompressionOptions
+from prefect_pipeline.noaa_ndbc.catalog import (
+    catalog_to_files,
+    feed_files,
+    fetch_historical_catalog,
+    fetch_recent_catalog,
+    filter_catalog,
+)
+from prefect_pipeline.noaa_ndbc.config import PipelineConfig, load_config
+from prefect_pipeline.noaa_ndbc.discovery import DEFAULT_LISTING_TTL, ListingCache
+from prefect_pipeline.noaa_ndbc.download import (
+    DEFAULT_MAX_WORKERS,
+    download_files,
 )
+from prefect_pipeline.noaa_ndbc.manifest import load_manifest
+from prefect_pipeline.noaa_ndbc.merge import DEFAULT_RUN_SIZE, merge_outputs
+from prefect_pipeline.noaa_ndbc.metrics import RunMetrics
+from prefect_pipeline.noaa_ndbc.models import NDBCStation
 from prefect_pipeline.noaa_ndbc.process_historical_data import (
-    process_and_write_files,
+    ParseStats,
+    WorkUnit,
+    compact_work_units,
     group_files,
-    extract_filename_info
+    plan_work_units,
+    process_work_unit,
+)
+from prefect_pipeline.noaa_ndbc.query_index import build_query_index
+from prefect_pipeline.noaa_ndbc.realtime import (
+    DEFAULT_REALTIME_WORKERS,
+    REALTIME_BASE_URL,
+    refresh_realtime,
+)
+from prefect_pipeline.noaa_ndbc.scheduler import DEFAULT_MAX_INFLIGHT_BYTES
+from prefect_pipeline.noaa_ndbc.sinks import write_station_dimensions
+from prefect_pipeline.noaa_ndbc.stations import (
+    DEFAULT_STATION_TTL,
+    StationPositionIndex,
+    StationTable,
+    load_station_metadata,
+    load_station_table,
 )
 
-FEED_DIR = '/Users/moriah/src/harmony/weather-pipeline/prefect_pipeline/output/feed/noaa_ndbc'
-TMP_DIR =  '/Users/moriah/src/harmony/weather-pipeline/prefect_pipeline/output/tmp/noaa_ndbc'
-FILE_SUFFIX = '.txt.gz'
-
-def fetch_nbdc_url(url: str, parser):
-    try:
-        r = requests.get(url)
-        r.raise_for_status()
-        return dict(parser(r.content))
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-
-
-def convert_row_model(row: NDBCSourceStation) -> NDBCStation:
-    output_row = {}
-    for field, value in row.items():
-        output_field = SourceStationConversion.get(field)
-        if not output_field:
-            continue
-        output_type = NDBCStation.__annotations__[output_field]
-        if output_type is not bool:
-            output_row[output_field] = output_type(value)
-        else:
-            output_row[output_field] = value == 'y'
-    return output_row
-
-
-@task(name='Fetch Station list')
-def fetch_station_list():
+@task(name='Fetch Station list', nout=2)
+def fetch_station_list(
+    cache_dir: str,
+    cache_ttl: float = DEFAULT_STATION_TTL,
+) -> Tuple[StationTable, RunMetrics]:
     # NDBC has data stored without station information
     # in order to get any sort of usefulness out of this data we
     # need a lookup of station id to station info (lat, lon, name, etc)
-    # NOTE/TODO: If we end up  needing to reduce memory pressure
-    # then I will write this to a json, but for now,we will hold it in
-    # memory.
-    endpoint = 'https://www.ndbc.noaa.gov/activestations.xml'
-    active_stations = fetch_nbdc_url(endpoint, xmltodict.parse)
-    return active_stations['stations']['station']
+    # The xml is kept in cache_dir and only re-requested (conditionally)
+    # once cache_ttl has passed, the parsed lookup is saved next to it as
+    # a columnar table and reused as long as the xml hasn't changed.
+    logger = prefect.context.get("logger")
+    metrics = RunMetrics()
+    with metrics.stage('fetch_station_list'):
+        station_table = load_station_table(cache_dir, cache_ttl, logger)
+    logger.info(f'Loaded {len(station_table)} active stations')
+    return station_table, metrics
 
 
-@task(name='Fetch Station metadata')
-def fetch_station_metadata():
+@task(name='Fetch Station metadata', nout=2)
+def fetch_station_metadata(
+    cache_dir: str,
+    cache_ttl: float = DEFAULT_STATION_TTL,
+) -> Tuple[List[Dict[str, Any]], RunMetrics]:
     # NDBC stations have a lot of pertinent metadata that is not stored
     # the main station list. (start data, end date, etc)
-    # NOTE/TODO: If we end up  needing to reduce memory pressure
-    # then I will write this to a json, but for now,we will hold it in
-    # memory.
-    endpoint = 'https://www.ndbc.noaa.gov/metadata/stationmetadata.xml'
-    station_metadata = fetch_nbdc_url(endpoint, xmltodict.parse)
-    return station_metadata['stations']['station']
+    logger = prefect.context.get("logger")
+    metrics = RunMetrics()
+    with metrics.stage('fetch_station_metadata'):
+        station_metadata = load_station_metadata(cache_dir, cache_ttl, logger)
+    return station_metadata, metrics
+
 
+@task(name='Build Station position index')
+def build_station_positions(station_metadata) -> StationPositionIndex:
+    # Buoys get moved, the metadata history has each deployment's start/stop
+    # and lat/lng.
+    logger = prefect.context.get("logger")
+    position_index = StationPositionIndex.from_metadata(station_metadata)
+    logger.info(f'Loaded position history for {len(position_index)} stations')
+    return position_index
 
-@task(name='Fetch List of historical data urls')
-def get_historical_stdmet_urls() -> Dict[Tuple[str, str], str]:
+
+@task(name='Fetch List of historical data urls', nout=2)
+def get_historical_stdmet_urls(
+    cache_dir: str = None,
+    cache_ttl: float = DEFAULT_LISTING_TTL,
+    years: Tuple[str, ...] = None,
+    station_ids: Tuple[str, ...] = None,
+) -> Tuple[Dict[str, Dict[str, str]], RunMetrics]:
     # The NOAA historical data is a vastly unorganized, and sharded by station id
     # and year. The historical_stdmet_url has a list of these files in html.
-    historical_urls = {}
-    historical_stdmet_url = 'https://www.ndbc.noaa.gov/data/historical/stdmet'
-    r = requests.get(historical_stdmet_url)
-    soup = BeautifulSoup(r.text, 'html.parser')
-    for link in soup.find_all('a', attrs={'href': re.compile('^.*\.txt(\.gz)')}):
-        station_link = link.get('href')
-        file_info = extract_filename_info(station_link, separator='h')
-        historical_urls[station_link] = historical_stdmet_url + '/' + station_link
     logger = prefect.context.get("logger")
-    logger.info(f'Found {len(historical_urls)} historical urls to fetch.')
-    return historical_urls
+    cache = ListingCache(cache_dir, cache_ttl) if cache_dir else None
+    metrics = RunMetrics()
+    with metrics.stage('fetch_historical_listing'):
+        catalog = fetch_historical_catalog(cache, logger)
+    catalog = filter_catalog(catalog, years, station_ids)
+    logger.info(f'Found {len(catalog)} historical urls to fetch.')
+    return catalog_to_files(catalog), metrics
 
 
-@task(name='Fetch historical data')
+@task(name='Fetch historical data', nout=2)
 def get_historical_data_by_station(
     output_dir: str,
-    historical_urls: Dict[str, str],
-    full_pull=False
-) -> Dict[str, str]:
+    historical_urls: Dict[str, Dict[str, str]],
+    full_pull=False,
+    max_workers=DEFAULT_MAX_WORKERS,
+    incremental=False,
+) -> Tuple[Dict[str, Dict[str, str]], RunMetrics]:
     # There are thousands of historical files ranging in size from 10kb
     # to 100mb. the structure for file naming is the only way to know what
     # station it belongs to {station_id}h{year}.txt.gz
+    # In incremental mode only files missing from the manifest get pulled,
+    # a historical year never changes once NDBC publishes it.
     logger = prefect.context.get("logger")
+    metrics = RunMetrics()
     historical_files = {}
-    for filename, url in list(historical_urls.items()):
-        logger.info(f'Processing historical file: {filename}, {url}')
-        historical_file = os.path.join(output_dir, filename)
-        if full_pull:
-            r = requests.get(url)        
-            open(historical_file, 'wb').write(r.content)
-        historical_files[filename] = historical_file
-    logger.info(f'Found Historical urls: {historical_files}')
-    return historical_files
-
-
-@task(name='Fetch recent sdmet file urls')
-def get_recent_sdmet_urls() -> Dict[str,Dict[str,str]]:
-    base_url = 'https://www.ndbc.noaa.gov/data/stdmet/%s'
-    months = [
-        'Jan',
-        'Feb',
-        'Mar',
-        'Apr',
-        'May',
-        'Jun',
-        'Jul',
-        'Aug',
-        'Sep',
-        'Oct',
-        'Nov',
-        'Dec'
-    ]
-    output_urls = {}
+    downloads = {}
+    for url, historical_file in feed_files(historical_urls, output_dir).items():
+        if full_pull or incremental:
+            downloads[url] = historical_file
+        historical_files[historical_file] = historical_urls[url]
+    if downloads:
+        stats = download_files(
+            downloads,
+            max_workers=max_workers,
+            logger=logger,
+            manifest=load_manifest(output_dir),
+            conditional=incremental,
+            immutable=True,
+        )
+        logger.info(stats.summary())
+        metrics.record_download('historical', stats)
+        for url in stats.failed:
+            del historical_files[downloads[url]]
+    logger.info(f'Found {len(historical_files)} historical files')
+    return historical_files, metrics
+
+
+@task(name='Fetch recent sdmet file urls', nout=2)
+def get_recent_sdmet_urls(
+    cache_dir: str = None,
+    cache_ttl: float = DEFAULT_LISTING_TTL,
+    years: Tuple[str, ...] = None,
+    station_ids: Tuple[str, ...] = None,
+) -> Tuple[Dict[str,Dict[str,str]], RunMetrics]:
     logger = prefect.context.get("logger")
-    for i, month in enumerate(months):
-        url = base_url % month
-        link_list_html = requests.get(url)
-        soup = BeautifulSoup(link_list_html.text, 'html.parser')
-        for link in soup.find_all('a', attrs={'href': re.compile('^.*\.txt(\.gz)')}):
-            station_link = link.get('href')
-            month_number = str(i + 1)
-            station_id, year = extract_filename_info(
-                station_link,
-                logger,
-                separator=month_number
-            )
-            output_urls[url + '/' + station_link] = {
-                'station_id': station_id,
-                'year': year,
-                'month': month_number,
-            }
-    return output_urls
+    cache = ListingCache(cache_dir, cache_ttl) if cache_dir else None
+    metrics = RunMetrics()
+    with metrics.stage('fetch_recent_listings'):
+        catalog = fetch_recent_catalog(cache, logger)
+    catalog = filter_catalog(catalog, years, station_ids)
+    logger.info(f'Found {len(catalog)} recent urls to fetch.')
+    return catalog_to_files(catalog), metrics
 
 
-@task(name='Fetch recent sdmet file data')
+@task(name='Fetch recent sdmet file data', nout=2)
 def get_recent_sdmet_data(
     output_dir: str,
     recent_urls: Dict[str,Dict[str,str]],
-    full_pull=False
-) -> Dict[str,Dict[str,str]]:
+    full_pull=False,
+    max_workers=DEFAULT_MAX_WORKERS,
+    incremental=False,
+) -> Tuple[Dict[str,Dict[str,str]], RunMetrics]:
+    # Monthly files are rewritten by NDBC until the month lands in the
+    # yearly archive, so incremental mode asks with If-None-Match /
+    # If-Modified-Since and only pulls the ones that changed.
+    logger = prefect.context.get("logger")
+    metrics = RunMetrics()
     recent_files = {}
-    for url, file_info in list(recent_urls.items()):
-        station_id = file_info['station_id']
-        year = file_info['year']
-        month = file_info['month']
-        filename = f'{station_id}_{year}_{month}{FILE_SUFFIX}'
-        recent_file = os.path.join(output_dir, filename)
-        if full_pull:
-            r = requests.get(url)
-            open(recent_file, 'wb').write(r.content)
-        recent_files[recent_file] = file_info
-    return recent_files
-
-
-@task(name='Process Station metadata')
-def process_active_stations(active_stations) -> Dict[str, NDBCStation]:
-    # Clean the station input into the format we want specified in NDBCStation
-    cleaned_stations = {}
-    for station in active_stations:
-        cleaned_station = convert_row_model(station)
-        cleaned_stations[cleaned_station['id']] = cleaned_station
-    return cleaned_stations
-
-
-@task(name='Process Historical Station data')
-def process_historical_data(
-    historical_files: Dict[Tuple[str, str], str],
+    downloads = {}
+    for url, recent_file in feed_files(recent_urls, output_dir).items():
+        if full_pull or incremental:
+            downloads[url] = recent_file
+        recent_files[recent_file] = recent_urls[url]
+    if downloads:
+        stats = download_files(
+            downloads,
+            max_workers=max_workers,
+            logger=logger,
+            manifest=load_manifest(output_dir),
+            conditional=incremental,
+        )
+        logger.info(stats.summary())
+        metrics.record_download('recent', stats)
+        for url in stats.failed:
+            del recent_files[downloads[url]]
+    return recent_files, metrics
+
+
+@task(name='Write Station dimensions')
+def write_station_table(
     processed_station_lookup: Dict[str, NDBCStation],
-    output_dir: str
-):
-    station_files_by_year = group_files(
-        historical_files,
+    output_dir: str,
+    output_format: str = 'json',
+    compression: CompressionOptions = CompressionOptions(),
+) -> str:
+    return write_station_dimensions(
         processed_station_lookup,
+        output_dir,
+        output_format,
+        compression,
     )
+
+
+@task(name='Plan station shards')
+def plan_shards(
+    files: Dict[str, Dict[str, str]],
+    processed_station_lookup: Dict[str, NDBCStation],
+    shard_size: int = 50,
+) -> List[WorkUnit]:
     logger = prefect.context.get("logger")
-    logger.info(f'Found years urls: {station_files_by_year}')
-    output_year_files = process_anwd_write_files(
-        station_files_by_year,
+    station_files_by_year = group_files(
+        files,
         processed_station_lookup,
-        output_dir,
         logger,
     )
-    return output_year_files
+    work_units = plan_work_units(station_files_by_year, shard_size)
+    logger.info(
+        f'Found {sum(len(unit.stations) for unit in work_units)} files across '
+        f'{len(station_files_by_year)} years, {len(work_units)} shards '
+        f'({sum(unit.size for unit in work_units) / 1024 / 1024:.0f}MB)'
+    )
+    return work_units
 
 
-@task(name='Process Recent Station data')
-def process_recent_data(
-    recent_files: Dict[str,Dict[str,str]],
+@task(
+    name='Process station shard',
+    max_retries=2,
+    retry_delay=timedelta(seconds=30),
+)
+def process_shard(
+    work_unit: WorkUnit,
     processed_station_lookup: Dict[str, NDBCStation],
-    output_dir: str
-):
+    output_dir: str,
+    output_format: str = 'json',
+    join_station_dimensions: bool = False,
+    compression: CompressionOptions = CompressionOptions(),
+    position_index: StationPositionIndex = None,
+    output_shape: str = 'long',
+    workers: int = 1,
+    max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES,
+    archive_dir: str = None,
+) -> Tuple[WorkUnit, List[str], ParseStats]:
+    # Runs wherever the executor puts it, so everything it needs comes in
+    # as arguments and everything it measured goes back in the result.
     logger = prefect.context.get("logger")
-    logger.info(f'Found {len(recent_files)} recent files')
-    station_files_by_year = group_files(
-        recent_files,
+    segments, parse_stats = process_work_unit(
+        work_unit,
         processed_station_lookup,
+        output_dir,
         logger,
+        output_format,
+        join_station_dimensions,
+        compression=compression,
+        position_index=position_index,
+        output_shape=output_shape,
+        workers=workers,
+        max_inflight_bytes=max_inflight_bytes,
+        archive_directory=archive_dir,
     )
-    logger.info(f'Found years urls: {station_files_by_year}')
-    output_year_files = process_and_write_files(
-        station_files_by_year,
-        processed_station_lookup,
+    return work_unit, segments, parse_stats
+
+
+@task(name='Compact station shards')
+def compact_shards(
+    shard_results: List[Tuple[WorkUnit, List[str], ParseStats]],
+    output_dir: str,
+    stage: str,
+    output_format: str = 'json',
+    compression: CompressionOptions = CompressionOptions(),
+    compact: bool = True,
+) -> Dict[str, Any]:
+    logger = prefect.context.get("logger")
+    output_year_files = compact_work_units(
+        [(work_unit, segments) for work_unit, segments, _ in shard_results],
+        output_dir,
+        output_format,
+        compression,
+        compact,
+    )
+    parse_stats = ParseStats()
+    for _, _, shard_parse_stats in shard_results:
+        parse_stats.merge(shard_parse_stats)
+    logger.info(parse_stats.summary())
+    return {
+        'stage': stage,
+        'output_files': output_year_files,
+        'parse_stats': parse_stats,
+    }
+
+
+@task(name='Merge recent into historical', nout=2)
+def merge_recent_data(
+    historical_output: Dict[str, Any],
+    recent_output: Dict[str, Any],
+    output_dir: str,
+    compression: CompressionOptions = CompressionOptions(),
+    run_size: int = DEFAULT_RUN_SIZE,
+) -> Tuple[Dict[str, str], RunMetrics]:
+    # Months that have since landed in the yearly archive show up in both,
+    # observations are deduplicated on (station_id, datetime_utc, field).
+    logger = prefect.context.get("logger")
+    metrics = RunMetrics()
+    with metrics.stage('merge_recent_data'):
+        merged_files = merge_outputs(
+            historical_output['output_files'],
+            recent_output['output_files'],
+            output_dir,
+            compression,
+            run_size,
+            logger,
+        )
+    return merged_files, metrics
+
+
+@task(name='Build query index', nout=2)
+def index_outputs(
+    output_files: Dict[str, Any],
+    output_dir: str,
+    output_format: str = 'json',
+) -> Tuple[Dict[str, str], RunMetrics]:
+    # output_files is year -> path, or a stage result from compact_shards
+    logger = prefect.context.get("logger")
+    if 'output_files' in output_files:
+        output_files = output_files['output_files']
+    metrics = RunMetrics()
+    with metrics.stage('build_query_index'):
+        index_files = build_query_index(output_files, output_dir, logger, output_format)
+    return index_files, metrics
+
+
+@task(name='Refresh realtime observations')
+def refresh_realtime_observations(
+    station_lookup: StationTable,
+    output_dir: str,
+    position_index: StationPositionIndex = None,
+    station_ids: Tuple[str, ...] = None,
+    max_workers: int = DEFAULT_REALTIME_WORKERS,
+    output_shape: str = 'long',
+    compression: CompressionOptions = CompressionOptions(),
+) -> Dict[str, Any]:
+    # The returned stats carry the refresh's own timing
+    logger = prefect.context.get("logger")
+    if station_ids is not None:
+        station_ids = [station_id for station_id in station_ids if station_id in station_lookup]
+    stats = refresh_realtime(
+        list(station_lookup) if station_ids is None else station_ids,
         output_dir,
         logger,
+        REALTIME_BASE_URL,
+        max_workers,
+        position_index=position_index,
+        output_shape=output_shape,
+        compression=compression,
     )
-    return output_year_files
+    return stats.as_dict()
 
 
-def main():
+@task(name='Write run report')
+def write_run_report(
+    metrics: RunMetrics,
+    metrics_dir: str,
+    prometheus_textfile: str = None,
+    stage_results: List[Dict[str, Any]] = (),
+    task_metrics: List[RunMetrics] = (),
+) -> str:
+    # Every task (and process, with the dask executors) has its own metrics,
+    # the tasks return theirs and the compact tasks their parse stats, and
+    # they're all put together here.
+    logger = prefect.context.get("logger")
+    for other in task_metrics:
+        metrics.merge(other)
+    for stage_result in stage_results:
+        metrics.record_parse(stage_result['stage'], stage_result['parse_stats'])
+        metrics.record_outputs(stage_result['stage'], stage_result['output_files'])
+    report_path = os.path.join(
+        metrics_dir,
+        f'run.{metrics.started_at.strftime("%Y%m%dT%H%M%SZ")}.json',
+    )
+    metrics.write_json(report_path)
+    if prometheus_textfile:
+        metrics.write_prometheus(prometheus_textfile)
+    logger.info(f'Wrote run report {report_path}')
+    return report_path
+
+
+def build_executor(executor: str, workers: int = None, address: str = None):
+    from prefect.executors import DaskExecutor, LocalDaskExecutor, LocalExecutor
+    if executor == 'local':
+        return LocalExecutor()
+    if executor == 'local_dask':
+        return LocalDaskExecutor(scheduler='processes', num_workers=workers)
+    if executor == 'dask':
+        if address:
+            return DaskExecutor(address=address)
+        return DaskExecutor(cluster_kwargs={'n_workers': workers, 'threads_per_worker': 1})
+    raise ValueError(f'Unknown executor {executor}, expected local, local_dask or dask')
+
+
+def main(config: PipelineConfig = None):
+    # config defaults to load_config(), see cli.py for running this with
+    # one from the command line or a file.
+    config = config or load_config()
+    metrics = RunMetrics()
+    station_cache_ttl = config.station_cache_ttl or DEFAULT_STATION_TTL
+    listing_cache_ttl = config.listing_cache_ttl or DEFAULT_LISTING_TTL
+    download_workers = config.download_workers or DEFAULT_MAX_WORKERS
     with Flow("NOAA NDBC Standard Meteorlogical Data") as flow:
-        active_stations = fetch_station_list()
-        processed_station_lookup = process_active_stations(active_stations)
+        processed_station_lookup, station_metrics = fetch_station_list(
+            config.station_cache_dir,
+            station_cache_ttl,
+        )
+        task_metrics = [station_metrics]
+        position_index = None
+        if config.position_as_of:
+            station_metadata, metadata_metrics = fetch_station_metadata(
+                config.station_cache_dir,
+                station_cache_ttl,
+            )
+            task_metrics.append(metadata_metrics)
+            position_index = build_station_positions(station_metadata)
 
-        historical_urls = get_historical_stdmet_urls()
-        historical_files = get_historical_data_by_station(
-            os.path.join(FEED_DIR, 'historical'),
+        historical_urls, historical_listing_metrics = get_historical_stdmet_urls(
+            config.listing_cache_dir,
+            listing_cache_ttl,
+            config.years,
+            config.stations,
+        )
+        historical_files, historical_download_metrics = get_historical_data_by_station(
+            os.path.join(config.feed_dir, 'historical'),
             historical_urls,
+            full_pull=config.pull == 'full',
+            max_workers=download_workers,
+            incremental=config.pull == 'incremental',
         )
-        recent_sdmet_urls = get_recent_sdmet_urls()
-        recent_sdmet_files = get_recent_sdmet_data(
-            os.path.join(FEED_DIR, 'historical'),
-            recent_sdmet_urls,
+        recent_sdmet_urls, recent_listing_metrics = get_recent_sdmet_urls(
+            config.listing_cache_dir,
+            listing_cache_ttl,
+            config.years,
+            config.stations,
         )
-        process_recent_data(
-            recent_sdmet_files,
-            processed_station_lookup,
-            os.path.join(TMP_DIR, 'historical'),
+        task_metrics.extend([
+            historical_listing_metrics,
+            historical_download_metrics,
+            recent_listing_metrics,
+        ])
+        archive_dirs = {'recent': None, 'historical': None}
+        if config.stream_recent:
+            # The shards take the urls themselves
+            recent_sdmet_files = recent_sdmet_urls
+            if config.retain_streamed:
+                archive_dirs['recent'] = os.path.join(config.feed_dir, 'historical')
+        else:
+            recent_sdmet_files, recent_download_metrics = get_recent_sdmet_data(
+                os.path.join(config.feed_dir, 'historical'),
+                recent_sdmet_urls,
+                full_pull=config.pull == 'full',
+                max_workers=download_workers,
+                incremental=config.pull == 'incremental',
+            )
+            task_metrics.append(recent_download_metrics)
+        processed_outputs = []
+        for stage, files in (
+            ('recent', recent_sdmet_files),
+            ('historical', historical_files),
+        ):
+            work_units = plan_shards(files, processed_station_lookup, config.shard_size)
+            shard_results = process_shard.map(
+                work_units,
+                unmapped(processed_station_lookup),
+                unmapped(config.output_directory(stage)),
+                unmapped(config.output_format),
+                unmapped(config.join_station_dimensions),
+                unmapped(config.compression),
+                unmapped(position_index),
+                unmapped(config.output_shape),
+                unmapped(config.shard_workers),
+                unmapped(config.shard_inflight_bytes),
+                unmapped(archive_dirs[stage]),
+            )
+            processed_outputs.append(compact_shards(
+                shard_results,
+                config.output_directory(stage),
+                stage,
+                config.output_format,
+                config.compression,
+                config.compact_segments,
+            ))
+        recent_output, historical_output = processed_outputs
+        final_outputs = []
+        if config.output_format == 'json':
+            merged_output, merge_metrics = merge_recent_data(
+                historical_output,
+                recent_output,
+                config.output_directory('merged'),
+                config.compression,
+                config.merge_run_size or DEFAULT_RUN_SIZE,
+            )
+            task_metrics.append(merge_metrics)
+            final_outputs.append((config.output_directory('merged'), merged_output))
+        else:
+            # No merge for parquet, each stage is indexed where it is
+            final_outputs.extend([
+                (config.output_directory('recent'), recent_output),
+                (config.output_directory('historical'), historical_output),
+            ])
+        # The station dimensions go beside every output root consumers read:
+        # the final outputs, and for json the historical output too, since
+        # years with no monthly data are left there rather than merged.
+        station_table_directories = [directory for directory, _ in final_outputs]
+        if config.output_format == 'json':
+            station_table_directories.append(config.output_directory('historical'))
+        station_tables = [
+            write_station_table(
+                processed_station_lookup,
+                directory,
+                config.output_format,
+                config.compression,
+            )
+            for directory in station_table_directories
+        ]
+        upstream_tasks = [output for _, output in final_outputs]
+        if config.build_query_index:
+            upstream_tasks = []
+            for directory, output in final_outputs:
+                index_files, index_metrics = index_outputs(output, directory, config.output_format)
+                upstream_tasks.append(index_files)
+                task_metrics.append(index_metrics)
+        write_run_report(
+            metrics,
+            config.metrics_dir,
+            config.prometheus_textfile,
+            processed_outputs,
+            task_metrics,
+            upstream_tasks=upstream_tasks + station_tables,
         )
-        process_historical_data(
-            historical_files,
-            processed_station_lookup,
-            os.path.join(TMP_DIR, 'historical'),
+
+    flow.run(executor=build_executor(config.executor, config.executor_workers, config.dask_address))
+
+
+def realtime_main(config: PipelineConfig = None):
+    # The station list and metadata are cached with their own ttl, so
+    # re-running them every interval only costs a stat or two.
+    from prefect.schedules import IntervalSchedule
+    config = config or load_config()
+    station_cache_ttl = config.station_cache_ttl or DEFAULT_STATION_TTL
+    schedule = None
+    if config.realtime_interval:
+        schedule = IntervalSchedule(interval=timedelta(seconds=config.realtime_interval))
+    with Flow("NOAA NDBC Realtime Meteorlogical Data", schedule=schedule) as flow:
+        station_lookup, _ = fetch_station_list(config.station_cache_dir, station_cache_ttl)
+        position_index = None
+        if config.position_as_of:
+            station_metadata, _ = fetch_station_metadata(config.station_cache_dir, station_cache_ttl)
+            position_index = build_station_positions(station_metadata)
+        refresh_realtime_observations(
+            station_lookup,
+            config.realtime_dir,
+            position_index,
+            config.stations,
+            config.realtime_workers or DEFAULT_REALTIME_WORKERS,
+            config.output_shape,
+            config.compression,
         )
 
     flow.run()
 
 if __name__ == "__main__":
-    main()
+    from prefect_pipeline.noaa_ndbc.cli import main as cli_main
+    cli_main()
@@ -1,18 +1,64 @@
 #!/usr/bin/env python
+import contextlib
 import csv
+import functools
+import io
+import itertools
+import logging
 import sys
 import os
+import time
 import pandas as pd
-from datetime import datetime
-from collections import defaultdict
-from typing import Dict, List, Any, TypedDict, Tuple, Set, Callable
-from bs4 import BeautifulSoup
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, IO, Iterable, List, Any, TypedDict, Tuple, Set, Iterator, Optional, NamedTuple
 
-from compression.pigz import PigzReader, PigzWriter
+from compression import CompressionOptions, open_reader
+from prefect_pipeline.noaa_ndbc.catalog import (
+    catalog_from_files,
+    feed_filename,
+    filename_pattern,
+    group_catalog,
+    select_known_stations,
+    url_month,
+)
 from prefect_pipeline.noaa_ndbc.models import (
     NDBCStation,
     StandardMeteorologicalDataConversionPost2006,
     StandardMeteorologicalDataConversionPre2006,
+    StandardMeteorologicalDataNullValues,
+)
+from prefect_pipeline.noaa_ndbc.checkpoint import (
+    SegmentLedger,
+    compact_segments,
+    complete_segment,
+    record_segment,
+    load_ledger,
+    pending_stations,
+    segment_directory,
+    segment_path,
+)
+from prefect_pipeline.noaa_ndbc.download import (
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_REQUESTS_PER_SECOND,
+    STREAM_ERRORS,
+    HostRateLimiter,
+    build_session,
+    is_url,
+    open_stream,
+)
+from prefect_pipeline.noaa_ndbc.manifest import load_manifest
+from prefect_pipeline.noaa_ndbc.scheduler import (
+    DEFAULT_BATCH_BYTES,
+    DEFAULT_MAX_INFLIGHT_BYTES,
+    SizeAwareScheduler,
+    file_size,
+)
+from prefect_pipeline.noaa_ndbc.sinks import JsonRecordsSink, get_output_sink
+from prefect_pipeline.noaa_ndbc.stations import (
+    StationPositionIndex,
+    StationPositions,
+    StationTable,
 )
 
 # TODO: convert this file into a class!
@@ -22,181 +68,939 @@ def extract_filename_info(
     logger: Any,
     separator='h'
 ) -> Tuple[str, str]:
-    suffix = '.txt.gz'
-    raw_name = filename.replace(suffix, '')
-    # has to be 4 digits
-    year = raw_name[-4:]
-    raw_name = raw_name[:-4]
-    if raw_name.endswith(separator):
-        station_id = raw_name[:-len(separator)]
-        return station_id, year
+    # One name at a time, build_catalog does whole listings
+    match = filename_pattern(separator).match(filename)
+    if match:
+        return match.group('station_id'), match.group('year')
     raise ValueError(f'File name format is invalid {filename}, {separator}')
 
-def build_station_id_list(filepath: str) -> Dict[str, NDBCStation]:
-    # Load the stations into a dictionary lookup of stations id to NDBCStation
-    station_lookup = {}
+def build_station_id_list(filepath: str) -> StationTable:
+    # Load the stations into a lookup of stations id to NDBCStation, either
+    # a saved station table (.json) or a csv with a column per field.
+    if filepath.endswith('.json'):
+        return StationTable.load(filepath)
     with open(filepath, 'r') as input_stations:
-        station_reader = csv.DictReader(input_stations)
-        for station in station_reader:
-            station_lookup[station['id']] = station
-    return station_lookup
+        return StationTable.from_records(csv.DictReader(input_stations))
 
 def get_year_specific_parsing(
     year,
-) -> Tuple[List[List[str]],Callable[[str],datetime],Dict[str,str]]:
+) -> Tuple[List[str],Dict[str,str]]:
+    # Returns the columns the timestamp is assembled from (year, month, day,
+    # hour and optionally minute) and the field name conversion for the year.
     year_number = int(year)
     if year_number < 1999:
         return (
-            [['YY', "MM", 'DD', 'hh']],
-            lambda x: datetime.strptime(x, "%y %m %d %H"),
+            ['YY', 'MM', 'DD', 'hh'],
             StandardMeteorologicalDataConversionPre2006,
         )
     if year_number < 2005:
         return (
-            [['YYYY', "MM", 'DD', 'hh']],
-            lambda x: datetime.strptime(x, "%Y %m %d %H"),
+            ['YYYY', 'MM', 'DD', 'hh'],
             StandardMeteorologicalDataConversionPre2006,
         )
     if year_number < 2007:
         return (
-            [['YYYY', "MM", 'DD', 'hh', 'mm']],
-            lambda x: datetime.strptime(x, "%Y %m %d %H %M"),
+            ['YYYY', 'MM', 'DD', 'hh', 'mm'],
             StandardMeteorologicalDataConversionPre2006,
         )
     if year_number >= 2007:
         return (
-            [['#YY', "MM", 'DD', 'hh', 'mm']],
-            lambda x: datetime.strptime(x, "%Y %m %d %H %M"),
+            ['#YY', 'MM', 'DD', 'hh', 'mm'],
             StandardMeteorologicalDataConversionPost2006,
         )
 
-def process_file(
+HEADER_PEEK_BYTES = 4096
+# long: a (datetime_utc, field, val) row per observation
+# wide: a row per timestamp with a column per field
+OUTPUT_SHAPES = ('long', 'wide')
+
+class FileLayout(NamedTuple):
+    date_columns: Tuple[str, ...]
+    conversion: Dict[str, str]
+    units_row: bool
+
+
+def peek_header_lines(input_file: IO[bytes]) -> Tuple[str, str]:
+    # Only the first two lines, the header and (2007+) the units row. They
+    # are peeked at rather than read so the same stream (a file or an http
+    # response) goes on to read_csv untouched. Both are well under a block,
+    # one peek has them.
+    data = input_file.peek(HEADER_PEEK_BYTES).decode('utf-8', 'replace')
+    lines = data.splitlines(keepends=True) + ['', '']
+    return lines[0], lines[1]
+
+
+def sniff_layout(header_line: str, second_line: str) -> FileLayout:
+    # The year in the file name is only a guess at the layout, NDBC has plenty
+    # of files written in the format of the year before or after. The header
+    # tells us for sure:
+    #   YY   -> two digit year (pre 1999)
+    #   YYYY -> four digit year (1999 - 2006)
+    #   #YY  -> four digit year with a units row after the header (2007+)
+    # mm shows up from 2005, and WDIR/PRES replace WD/BAR from 2007.
+    columns = header_line.split()
+    if not columns or columns[0] not in ('YY', 'YYYY', '#YY'):
+        raise ValueError(f'Unrecognized stdmet header: {header_line.strip()}')
+    date_columns = [columns[0], 'MM', 'DD', 'hh']
+    if 'mm' in columns:
+        date_columns.append('mm')
+    if 'WDIR' in columns:
+        conversion = StandardMeteorologicalDataConversionPost2006
+    else:
+        conversion = StandardMeteorologicalDataConversionPre2006
+    return FileLayout(tuple(date_columns), conversion, second_line.startswith('#'))
+
+
+def matches_year_layout(year: str, layout: FileLayout) -> bool:
+    # Whether guessing from the year would have gotten this file right. The
+    # ones that don't are what used to go through the retry-as-next-year path.
+    date_columns, conversion = get_year_specific_parsing(year)
+    return (
+        tuple(date_columns) == layout.date_columns
+        and conversion is layout.conversion
+        and (int(year) >= 2007) == layout.units_row
+    )
+
+
+class LayoutCache:
+    # Per station, the header we last saw and the layout decided for it.
+    # Stations keep the same layout for years at a time so most files are a
+    # string compare against the previous year's header.
+    def __init__(self):
+        self._layouts: Dict[str, Tuple[Tuple[str, bool], FileLayout]] = {}
+        self.hits = 0
+
+    def get_layout(self, station_id: str, header_line: str, second_line: str) -> FileLayout:
+        key = (header_line, second_line.startswith('#'))
+        cached = self._layouts.get(station_id)
+        if cached and cached[0] == key:
+            self.hits += 1
+            return cached[1]
+        layout = sniff_layout(header_line, second_line)
+        self._layouts[station_id] = (key, layout)
+        return layout
+
+
+class ParseStats:
+    # Totals for the run plus one record per station file. rows_in are the
+    # wide rows read, values_in the field values in them (rows x fields),
+    # rows_out the melted observations kept. The difference between the
+    # last two is what was dropped as null.
+    def __init__(self):
+        self.files = 0
+        self.fallback_files = 0
+        self.parse_seconds = 0.0
+        self.bytes_read = 0
+        self.rows_in = 0
+        self.values_in = 0
+        self.rows_out = 0
+        self.file_metrics: List[Dict[str, Any]] = []
+
+    def merge(self, other: 'ParseStats'):
+        self.files += other.files
+        self.fallback_files += other.fallback_files
+        self.parse_seconds += other.parse_seconds
+        self.bytes_read += other.bytes_read
+        self.rows_in += other.rows_in
+        self.values_in += other.values_in
+        self.rows_out += other.rows_out
+        self.file_metrics.extend(other.file_metrics)
+
+    def record_file(
+        self,
+        station_id: str,
+        year: str,
+        filepath: str,
+        seconds: float,
+        bytes_read: int,
+        rows_in: int,
+        values_in: int,
+        rows_out: int,
+        fallback: bool,
+    ):
+        self.parse_seconds += seconds
+        self.bytes_read += bytes_read
+        self.rows_in += rows_in
+        self.values_in += values_in
+        self.rows_out += rows_out
+        self.file_metrics.append({
+            'station_id': station_id,
+            'year': year,
+            'path': filepath,
+            'seconds': round(seconds, 4),
+            'bytes_read': bytes_read,
+            'rows_in': rows_in,
+            'rows_out': rows_out,
+            'nulls_dropped': values_in - rows_out,
+            'fallback': fallback,
+        })
+
+    @property
+    def nulls_dropped(self) -> int:
+        return self.values_in - self.rows_out
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'files': self.files,
+            'fallback_files': self.fallback_files,
+            'seconds': round(self.parse_seconds, 3),
+            'bytes_read': self.bytes_read,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'nulls_dropped': self.nulls_dropped,
+            'rows_per_second': round(self.rows_in / self.parse_seconds, 1) if self.parse_seconds else 0.0,
+        }
+
+    @property
+    def estimated_seconds_saved(self) -> float:
+        # Every file that missed the year guess cost at least one more full
+        # parse before it was sniffed.
+        if not self.files:
+            return 0.0
+        return self.fallback_files * self.parse_seconds / self.files
+
+    def summary(self) -> str:
+        return (
+            f'Parsed {self.files} files ({self.rows_in} rows, '
+            f'{self.rows_out} observations, {self.nulls_dropped} nulls dropped) '
+            f'in {self.parse_seconds:.1f}s, '
+            f'{self.fallback_files} did not match their year layout '
+            f'(~{self.estimated_seconds_saved:.1f}s of re-parsing saved)'
+        )
+
+def build_timestamps(
+    data_df: pd.DataFrame,
+    date_columns: List[str],
+) -> pd.Series:
+    # Assemble the UTC timestamp from the integer date columns in one
+    # vectorized pass instead of a strptime per row.
+    missing_columns = [c for c in date_columns if c not in data_df.columns]
+    if missing_columns:
+        raise ValueError(f'Missing date columns {missing_columns}')
+    year_column, month_column, day_column, hour_column = date_columns[:4]
+    years = data_df[year_column].astype('int64')
+    # Pre 1999 files only have a two digit year, they are all 19xx.
+    years = years.where(years >= 100, years + 1900)
+    date_parts = pd.DataFrame({
+        'year': years,
+        'month': data_df[month_column].astype('int64'),
+        'day': data_df[day_column].astype('int64'),
+        'hour': data_df[hour_column].astype('int64'),
+        'minute': data_df[date_columns[4]].astype('int64') if len(date_columns) > 4 else 0,
+    })
+    return pd.to_datetime(date_parts, utc=True).astype('datetime64[ns, UTC]')
+
+def typed_values(
+    data_df: pd.DataFrame,
+    value_columns: List[str],
+    Conversion: Dict[str, str],
+    null_values: Dict[str, float],
+) -> pd.DataFrame:
+    # The field columns renamed, float32, with each field's sentinel (and
+    # anything else that isn't a number) as NaN.
+    values = data_df.rename(columns=Conversion).reindex(columns=value_columns)
+    # MM is already NaN from read_csv, anything else non numeric becomes NaN
+    non_numeric = [c for c in value_columns if not pd.api.types.is_numeric_dtype(values[c])]
+    if non_numeric:
+        values[non_numeric] = values[non_numeric].apply(pd.to_numeric, errors='coerce')
+    sentinels = pd.Series({c: null_values[c] for c in value_columns})
+    return values.mask(values.eq(sentinels)).astype('float32')
+
+def add_observation_columns(
+    values: pd.DataFrame,
+    timestamps: pd.Series,
+    positions: Optional[StationPositions] = None,
+) -> List[str]:
+    # Adds datetime_utc (and the station's position at the time) to the
+    # wide frame, returns the names of the columns added.
+    values['datetime_utc'] = timestamps
+    id_columns = ['datetime_utc']
+    if positions is not None:
+        # Where the station was at each observation, looked up on the wide
+        # frame so it's one search per timestamp rather than per value.
+        values['latitude'], values['longitude'] = positions.positions_at(timestamps)
+        id_columns += ['latitude', 'longitude']
+    return id_columns
+
+def melt_observations(
+    data_df: pd.DataFrame,
+    name: str,
+    date_columns: List[str],
+    Conversion: Dict[str, str],
+    null_values: Dict[str, float],
+    positions: Optional[StationPositions] = None,
+) -> pd.DataFrame:
+    # Load in the station data rename columns/fields
+    # I want to pivot the data into a feild value system
+    # this will allow for a more dynamic table and more diverse amount
+    # of field value
+    # We also need to parse out null values
+    timestamps = build_timestamps(data_df, date_columns)
+    value_columns = list(Conversion.values())
+    # Null out each field's own sentinel on the wide frame, before the melt
+    # multiplies the rows by the number of fields.
+    values = typed_values(data_df, value_columns, Conversion, null_values)
+    id_columns = add_observation_columns(values, timestamps, positions)
+    data_df = values.melt(
+        id_vars=id_columns,
+        value_vars=value_columns,
+        var_name='field',
+        value_name='val',
+    ).dropna(subset=['val'])
+    # Only the station id is carried on the observations, the station
+    # dimensions are written once to their own table (or joined back on
+    # by the sink for consumers that still want them on every row).
+    data_df['station_id'] = pd.Series(name, index=data_df.index, dtype='category')
+    return data_df
+
+def wide_observations(
+    data_df: pd.DataFrame,
+    name: str,
+    date_columns: List[str],
+    Conversion: Dict[str, str],
+    null_values: Dict[str, float],
+    positions: Optional[StationPositions] = None,
+) -> pd.DataFrame:
+    # The StandardMeteorologicalData shape: one row per station timestamp
+    # and a float32 column per field, NaN where it wasn't reported. Every
+    # year gets every field column (tide is all NaN before 1999) so the
+    # schema doesn't change from file to file. Rows with nothing reported
+    # at all are dropped, same as the long format would.
+    timestamps = build_timestamps(data_df, date_columns)
+    value_columns = list(null_values)
+    values = typed_values(data_df, value_columns, Conversion, null_values)
+    id_columns = add_observation_columns(values, timestamps, positions)
+    data_df = values[id_columns + value_columns].dropna(how='all', subset=value_columns)
+    data_df = data_df.reset_index(drop=True)
+    data_df['station_id'] = pd.Series(name, index=data_df.index, dtype='category')
+    return data_df
+
+def iter_process_file(
     station: Tuple[str, str],
     i: int,
     year: str,
-    station_lookup: Dict[str, NDBCStation],
-    ignore_first_row: Dict[str, bool],
-    null_values: Set,
-    year_to_process_as: str,
+    null_values: Dict[str, float],
     total_stations: int,
     logger: Any,
-) -> pd.DataFrame:
+    chunksize: Optional[int] = None,
+    layout_cache: Optional[LayoutCache] = None,
+    parse_stats: Optional[ParseStats] = None,
+    positions: Optional[StationPositions] = None,
+    output_shape: str = 'long',
+) -> Iterator[pd.DataFrame]:
+    # Yields the melted (or with output_shape wide, the typed wide)
+    # observations for one station file. Without a
+    # chunksize that is a single frame for the whole file. With one, the
+    # file is read, melted and handed back chunksize rows at a time, so
+    # peak memory is bounded by the chunk and not by the file (some of the
+    # historical files are ~100mb uncompressed).
+    _, filepath = station
+    # Big files get decompressed in a pigz process alongside the parse
+    with open_reader(filepath) as input_file:
+        yield from iter_process_stream(
+            station,
+            input_file,
+            lambda: os.path.getsize(filepath),
+            i,
+            year,
+            null_values,
+            total_stations,
+            logger,
+            chunksize,
+            layout_cache,
+            parse_stats,
+            positions,
+            output_shape,
+        )
+
+
+def iter_process_stream(
+    station: Tuple[str, str],
+    input_file: IO[bytes],
+    source_bytes: Callable[[], int],
+    i: int,
+    year: str,
+    null_values: Dict[str, float],
+    total_stations: int,
+    logger: Any,
+    chunksize: Optional[int] = None,
+    layout_cache: Optional[LayoutCache] = None,
+    parse_stats: Optional[ParseStats] = None,
+    positions: Optional[StationPositions] = None,
+    output_shape: str = 'long',
+) -> Iterator[pd.DataFrame]:
+    # iter_process_file for a decompressed stream that is already open, a
+    # local file or a response being streamed (see iter_streamed_files).
+    # source_bytes gives the compressed size once it has all been read.
     name, filepath = station
-    parse_dates, date_parser, Conversion = get_year_specific_parsing(year_to_process_as)
-    dimensions = station_lookup[name]
+    layout_cache = layout_cache or LayoutCache()
+    parse_stats = parse_stats or ParseStats()
+    if output_shape not in OUTPUT_SHAPES:
+        raise ValueError(f'Unknown output shape {output_shape}, expected one of {OUTPUT_SHAPES}')
+    shape_observations = wide_observations if output_shape == 'wide' else melt_observations
+    logger.debug(f'Processing {name}---{filepath}: {i + 1}/{total_stations}')
+    start = time.perf_counter()
+    if not hasattr(input_file, 'peek'):
+        input_file = io.BufferedReader(input_file)
+    header_line, second_line = peek_header_lines(input_file)
+    if not header_line.strip():
+        logger.warning(f'Empty file found for {station}')
+        return
+    layout = layout_cache.get_layout(name, header_line, second_line)
+    parse_stats.files += 1
+    fallback = not matches_year_layout(year, layout)
+    if fallback:
+        parse_stats.fallback_files += 1
+        logger.warning(f'File {name}, {year} is not in its year format: {header_line.strip()}')
+    seconds = 0.0
+    rows_in = 0
+    values_in = 0
+    rows_out = 0
+    with contextlib.ExitStack() as stack:
+        # row 1 is the units.
+        reader = pd.read_csv(
+            input_file,
+            delimiter='\s+',
+            skiprows=[1] if layout.units_row else None,
+            na_values=['MM'],
+            chunksize=chunksize,
+        )
+        chunks = reader if chunksize else iter([reader])
+        if chunksize:
+            stack.enter_context(reader)
+        for chunk in chunks:
+            data_df = shape_observations(
+                chunk,
+                name,
+                list(layout.date_columns),
+                layout.conversion,
+                null_values,
+                positions,
+            )
+            seconds += time.perf_counter() - start
+            rows_in += len(chunk)
+            values_in += len(chunk) * len(layout.conversion)
+            # Counted in observations for both shapes so nulls dropped
+            # means the same thing
+            if output_shape == 'wide':
+                rows_out += int(data_df[list(null_values)].count().sum())
+            else:
+                rows_out += len(data_df)
+            yield data_df
+            start = time.perf_counter()
+    parse_stats.record_file(
+        name,
+        year,
+        filepath,
+        seconds,
+        source_bytes(),
+        rows_in,
+        values_in,
+        rows_out,
+        fallback,
+    )
 
-    print(f'processing {name}---{filepath}: {i + 1}/{total_stations}')
+def process_file(
+    station: Tuple[str, str],
+    i: int,
+    year: str,
+    null_values: Dict[str, float],
+    total_stations: int,
+    logger: Any,
+    chunksize: Optional[int] = None,
+    layout_cache: Optional[LayoutCache] = None,
+    parse_stats: Optional[ParseStats] = None,
+    positions: Optional[StationPositions] = None,
+    output_shape: str = 'long',
+) -> pd.DataFrame:
     # we need one dimension to join on.
     # I think most location dimenison are really lat/lon so that's what we will use
     # All of these files are relatively small ~10kb and can easily be loaded into a df
-    # row 1 is the units.
-    skip_rows = [1] if ignore_first_row[year_to_process_as] else None
-    try:
-        data_df = pd.read_csv(
-            filepath,
-            compression='gzip',
-            delimiter='\s+',
-            skiprows=skip_rows,
-            parse_dates=parse_dates,
-            date_parser=date_parser,
-        )
-        # Load in the station data rename columns/fields
-        # I want to pivot the data into a feild value system
-        # this will allow for a more dynamic table and more diverse amount
-        # of field value
-        # We also need to parse out null values
-        date_columns = set([
-            '#YY_MM_DD_hh_mm',
-            'YY_MM_DD_hh_mm',
-            'YYYY_MM_DD_hh_mm',
-            '#YY_MM_DD_hh',
-            'YY_MM_DD_hh',
-            'YYYY_MM_DD_hh',
-        ])
-        date_rename = {date_name: 'datetime_utc' for date_name in date_columns}
-        data_df = data_df.rename(columns=Conversion)
-        data_df = data_df.rename(columns=date_rename)
-        data_df = data_df.melt(
-            id_vars=['datetime_utc'],
-            value_vars=list(Conversion.values()),
-            var_name='field',
-            value_name='val',
-        )
-        # filter out null values
-        data_df = data_df[~data_df['val'].isin(null_values)]
-        # Add dimension data
-        for d in dimensions:
-            data_df[d] = str(dimensions[d])
-        return data_df
-    except ValueError as v_err:
-        print(v_err)
-        next_year = int(year_to_process_as) + 1
-        if next_year > 2009:
-            raise ValueError(v_err)
-        print(f'Issue with file {name}, {year}: trying as {next_year} format')
-        return process_file(
+    data_dfs = list(iter_process_file(
+        station,
+        i,
+        year,
+        null_values,
+        total_stations,
+        logger,
+        chunksize,
+        layout_cache,
+        parse_stats,
+        positions,
+        output_shape,
+    ))
+    if not data_dfs:
+        return pd.DataFrame([])
+    if len(data_dfs) == 1:
+        return data_dfs[0]
+    return pd.concat(data_dfs, ignore_index=True)
+
+# Each pool worker keeps its own per-station layout cache across the files
+# it is handed.
+_worker_layout_cache = LayoutCache()
+
+
+def _process_files_in_worker(
+    files: List[Tuple[int, Tuple[str, str], Optional[StationPositions]]],
+    year: str,
+    null_values: Dict[str, float],
+    total_stations: int,
+    chunksize: Optional[int],
+    output_shape: str,
+) -> List[Tuple[Optional[pd.DataFrame], ParseStats]]:
+    # A batch of (i, station, positions), the scheduler packs small files
+    # together. Prefect's logger doesn't survive the trip to another process.
+    # A file that yields no frames at all (an empty file) comes back as
+    # None, one with nothing but nulls still comes back as its empty frame,
+    # the same as the serial path.
+    results = []
+    for i, station, positions in files:
+        parse_stats = ParseStats()
+        data_dfs = list(iter_process_file(
             station,
             i,
             year,
-            station_lookup,
-            ignore_first_row,
             null_values,
-            str(next_year),
             total_stations,
-        )
-    except TypeError as t_err:
-        print(t_err)
-        next_year = int(year_to_process_as) + 1
-        if next_year > 2009:
-            raise TypeError(t_err)
-        print(f'Issue with file {name}, {year}: trying as {next_year} format')
-        return process_file(
-            station,
-            i,
+            logging.getLogger(__name__),
+            chunksize,
+            _worker_layout_cache,
+            parse_stats,
+            positions,
+            output_shape,
+        ))
+        data_df = None
+        if data_dfs:
+            data_df = data_dfs[0] if len(data_dfs) == 1 else pd.concat(data_dfs, ignore_index=True)
+        results.append((data_df, parse_stats))
+    return results
+
+
+def iter_streamed_files(
+    stations: List[Tuple[str, str]],
+    year: str,
+    null_values: Dict[str, float],
+    logger: Any,
+    max_streams: int = DEFAULT_MAX_WORKERS,
+    parse_stats: Optional[ParseStats] = None,
+    position_index: Optional[StationPositionIndex] = None,
+    output_shape: str = 'long',
+    archive_directory: Optional[str] = None,
+) -> Iterator[Tuple[Tuple[str, str], pd.DataFrame]]:
+    # iter_processed_files for stations whose paths are urls. Each file is
+    # fetched and parsed in one go on a thread: the response is inflated as
+    # it arrives and read_csv reads from the socket, nothing is written to
+    # disk and read back. With archive_directory the raw bytes are kept
+    # there too (in the download manifest as well). Up to max_streams files
+    # are in flight and they come back in the order given. A file that
+    # can't be fetched is logged and skipped, like a failed download.
+    parse_stats = parse_stats if parse_stats is not None else ParseStats()
+    session = build_session(max_streams)
+    rate_limiter = HostRateLimiter(DEFAULT_REQUESTS_PER_SECOND)
+    manifest = load_manifest(archive_directory) if archive_directory else None
+    total_stations = len(stations)
+
+    def fetch_and_process(i, station):
+        station_id, url = station
+        file_parse_stats = ParseStats()
+        archive_path = None
+        if archive_directory:
+            # Kept under the name a download would have given it, a monthly
+            # file's own name is the same every year
+            file_info = {'station_id': station_id, 'year': year, 'month': url_month(url)}
+            archive_path = os.path.join(archive_directory, feed_filename(url, file_info))
+        try:
+            with open_stream(session, url, rate_limiter, archive_path, manifest) as (input_file, tee):
+                data_dfs = list(iter_process_stream(
+                    station,
+                    input_file,
+                    lambda: tee.bytes_read,
+                    i,
+                    year,
+                    null_values,
+                    total_stations,
+                    logger,
+                    parse_stats=file_parse_stats,
+                    positions=position_index.get(station_id) if position_index is not None else None,
+                    output_shape=output_shape,
+                ))
+        except STREAM_ERRORS as e:
+            # Nothing of a file that broke off is kept, its stats included
+            logger.warning(f'Failed to stream {url}: {e}')
+            return [], ParseStats()
+        return data_dfs, file_parse_stats
+
+    with ThreadPoolExecutor(max_workers=max_streams) as executor:
+        pending = deque()
+
+        def collect():
+            station, future = pending.popleft()
+            data_dfs, file_parse_stats = future.result()
+            parse_stats.merge(file_parse_stats)
+            return station, data_dfs
+
+        for i, station in enumerate(stations):
+            pending.append((station, executor.submit(fetch_and_process, i, station)))
+            if len(pending) >= max_streams:
+                station, data_dfs = collect()
+                for data_df in data_dfs:
+                    yield station, data_df
+        while pending:
+            station, data_dfs = collect()
+            for data_df in data_dfs:
+                yield station, data_df
+
+
+def iter_processed_files(
+    stations: List[Tuple[str, str]],
+    year: str,
+    null_values: Dict[str, float],
+    logger: Any,
+    executor: Optional[ProcessPoolExecutor] = None,
+    max_pending: int = 1,
+    chunksize: Optional[int] = None,
+    layout_cache: Optional[LayoutCache] = None,
+    parse_stats: Optional[ParseStats] = None,
+    position_index: Optional[StationPositionIndex] = None,
+    output_shape: str = 'long',
+    ordered: bool = True,
+    max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES,
+    batch_bytes: int = DEFAULT_BATCH_BYTES,
+    archive_directory: Optional[str] = None,
+) -> Iterator[Tuple[Tuple[str, str], pd.DataFrame]]:
+    # Yields ((station_id, file path), frame) for each station file.
+    # Paths that are urls are streamed instead, see iter_streamed_files.
+    # Serially with a chunksize a file comes back as several frames as it is
+    # read, in the order given. With an executor the files are parsed in
+    # parallel by a SizeAwareScheduler: small files are batched, at most
+    # max_pending batches and max_inflight_bytes of files are in flight. If
+    # ordered they come back in the order given, so the writer sees exactly
+    # what the serial path would have produced. If not they run largest
+    # first and come back as they finish (fine for per file segments).
+    # Workers still read in chunks but return the whole file. Only the
+    # station's own positions are shipped to a worker, not the whole index.
+    if stations and is_url(stations[0][1]):
+        yield from iter_streamed_files(
+            stations,
             year,
-            station_lookup,
-            ignore_first_row,
             null_values,
-            str(next_year),
-            total_stations,
+            logger,
+            parse_stats=parse_stats,
+            position_index=position_index,
+            output_shape=output_shape,
+            archive_directory=archive_directory,
         )
-    except pd.errors.EmptyDataError:
-        logger.warning(f'Empty file found for {station}')
-        return pd.DataFrame([])
+        return
+    total_stations = len(stations)
+
+    def get_positions(station_id):
+        return position_index.get(station_id) if position_index is not None else None
+
+    parse_stats = parse_stats if parse_stats is not None else ParseStats()
+    if executor is None:
+        for i, station in enumerate(stations):
+            for data_df in iter_process_file(
+                station,
+                i,
+                year,
+                null_values,
+                total_stations,
+                logger,
+                chunksize,
+                layout_cache,
+                parse_stats,
+                get_positions(station[0]),
+                output_shape,
+            ):
+                yield station, data_df
+        return
+
+    scheduler = SizeAwareScheduler(executor, max_pending, max_inflight_bytes, batch_bytes)
+    batches = scheduler.map(
+        functools.partial(
+            _process_files_in_worker,
+            year=year,
+            null_values=null_values,
+            total_stations=total_stations,
+            chunksize=chunksize,
+            output_shape=output_shape,
+        ),
+        [(i, station, get_positions(station[0])) for i, station in enumerate(stations)],
+        [file_size(filepath) for _, filepath in stations],
+        ordered,
+    )
+    for files, results in batches:
+        for (_, station, _), (data_df, file_parse_stats) in zip(files, results):
+            parse_stats.merge(file_parse_stats)
+            if data_df is not None:
+                yield station, data_df
+
+
+def write_year_segments(
+    year: str,
+    frames: Iterator[Tuple[Tuple[str, str], pd.DataFrame]],
+    ledger: SegmentLedger,
+    output_directory: str,
+    station_lookup: Optional[Dict[str, NDBCStation]],
+    compression: CompressionOptions,
+    stations: Iterable[Tuple[str, str]] = (),
+):
+    # One segment per station file, written to a .part and renamed into
+    # place (and into the ledger) only once the whole file is processed.
+    # A run that dies part way loses at most the file it was on. Files in
+    # stations that never came through frames were empty, they go in the
+    # ledger without a segment.
+    written = set()
+    for station, station_frames in itertools.groupby(frames, key=lambda item: item[0]):
+        written.add(station)
+        station_id, filepath = station
+        path = segment_path(output_directory, year, filepath, compression)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = path + '.part'
+        with JsonRecordsSink(
+            output_directory,
+            year,
+            station_lookup,
+            compression,
+            path=partial_path,
+        ) as sink:
+            for _, data_df in station_frames:
+                sink.write(station_id, data_df)
+        complete_segment(ledger, year, station_id, filepath, partial_path, path)
+    for station_id, filepath in stations:
+        if (station_id, filepath) not in written:
+            record_segment(ledger, year, station_id, filepath)
+
 
 def process_and_write_files(
-    stations_by_year: Dict[str, Tuple[str, str]],
+    stations_by_year: Dict[str, Set[Tuple[str, str]]],
     station_lookup: Dict[str, NDBCStation],
     output_directory: str,
     logger: Any,
+    workers: int = 1,
+    output_format: str = 'json',
+    join_station_dimensions: bool = False,
+    chunksize: Optional[int] = None,
+    compression: CompressionOptions = CompressionOptions(),
+    position_index: Optional[StationPositionIndex] = None,
+    parse_stats: Optional[ParseStats] = None,
+    checkpoint: bool = False,
+    compact: bool = True,
+    output_shape: str = 'long',
+    max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES,
+    batch_bytes: int = DEFAULT_BATCH_BYTES,
+    archive_directory: Optional[str] = None,
 ) -> Dict[str,str]:
-    ignore_first_row = { str(i): i >= 2007 for i in range(1970, 2022)}
-    null_values = set([99, 99.0, 99.00, 999, 999.0, 999.00, 9999.0,])
+    # With a position_index every observation carries the latitude and
+    # longitude the station had at the time (from stationmetadata.xml).
+    # Pass in parse_stats to get the per file numbers back.
+    # With checkpoint set (json output only) each station file is written
+    # as its own segment and recorded in a ledger, and a rerun picks up
+    # with the files that aren't done yet. compact then stitches a year's
+    # segments into the usual processed_rows.{year} file.
+    # Station file paths can also be urls, those are streamed and parsed
+    # without being downloaded first (kept in archive_directory if set).
+    if checkpoint and output_format != 'json':
+        raise ValueError(f'Checkpointing is only supported for json output, not {output_format}')
+    null_values = StandardMeteorologicalDataNullValues
     # print(f'Starting row processing: {stations_by_year.keys()}')
     output_files = {}
-    for year in stations_by_year:
-        total_stations = len(stations_by_year[year])
-        logger.info(f'Processing year {year}, {total_stations}')
-        # print(f'Processing year {year}, {total_stations}')
-        output_file_path = os.path.join(
-            output_directory,
-            f'processed_rows.{year}.json.gz',
+    layout_cache = LayoutCache()
+    parse_stats = parse_stats if parse_stats is not None else ParseStats()
+    ledger = load_ledger(output_directory) if checkpoint else None
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        for year in stations_by_year:
+            # Sorted so the serial and parallel paths write stations in the
+            # same order and produce identical output.
+            stations = sorted(stations_by_year[year])
+            total_stations = len(stations)
+            logger.info(f'Processing year {year}, {total_stations}')
+            # print(f'Processing year {year}, {total_stations}')
+            sink = get_output_sink(
+                output_format,
+                output_directory,
+                year,
+                station_lookup if join_station_dimensions else None,
+                compression,
+            )
+            output_files[year] = sink.path
+            pending = pending_stations(ledger, year, stations) if checkpoint else stations
+            frames = iter_processed_files(
+                pending,
+                year,
+                null_values,
+                logger,
+                executor,
+                max_pending=workers * 2,
+                chunksize=chunksize,
+                layout_cache=layout_cache,
+                parse_stats=parse_stats,
+                position_index=position_index,
+                output_shape=output_shape,
+                # Segments are per file, so a checkpointed year doesn't need
+                # them in order and can run the biggest files first.
+                ordered=not checkpoint,
+                max_inflight_bytes=max_inflight_bytes,
+                batch_bytes=batch_bytes,
+                archive_directory=archive_directory,
+            )
+            if not checkpoint:
+                with sink:
+                    for station, data_df in frames:
+                        sink.write(station[0], data_df)
+                continue
+            if len(pending) < total_stations:
+                logger.info(f'Year {year}: {total_stations - len(pending)} station files already done')
+            write_year_segments(
+                year,
+                frames,
+                ledger,
+                output_directory,
+                station_lookup if join_station_dimensions else None,
+                compression,
+                pending,
+            )
+            segments = ledger.segment_paths(year, [filepath for _, filepath in stations])
+            if compact:
+                compact_segments(segments, sink.path)
+            else:
+                output_files[year] = segment_directory(output_directory, year)
+    finally:
+        if executor:
+            executor.shutdown()
+    logger.info(parse_stats.summary())
+    return output_files
+
+
+class WorkUnit(NamedTuple):
+    # A shard of one year's station files, the unit the flow maps over.
+    # size is the bytes of its files on disk.
+    year: str
+    shard: int
+    stations: Tuple[Tuple[str, str], ...]
+    size: int = 0
+
+    @property
+    def name(self) -> str:
+        return f'{self.year}-{self.shard:05d}'
+
+
+def plan_work_units(
+    stations_by_year: Dict[str, Set[Tuple[str, str]]],
+    shard_size: int,
+) -> List[WorkUnit]:
+    # Up to shard_size stations per unit, in the same sorted order the
+    # serial path writes them. A station's files (one per month for recent
+    # data) always land in the same unit so two units never write the same
+    # station's output. Units come back largest first so the long ones
+    # start early instead of holding up the end of the run, shard numbers
+    # keep the station order for compacting.
+    work_units = []
+    for year in sorted(stations_by_year):
+        files_by_station = defaultdict(list)
+        for station in sorted(stations_by_year[year]):
+            files_by_station[station[0]].append(station)
+        station_ids = sorted(files_by_station)
+        for shard, start in enumerate(range(0, len(station_ids), shard_size)):
+            stations = tuple(
+                station
+                for station_id in station_ids[start:start + shard_size]
+                for station in files_by_station[station_id]
+            )
+            work_units.append(WorkUnit(
+                year,
+                shard,
+                stations,
+                sum(file_size(path) for _, path in stations),
+            ))
+    return sorted(work_units, key=lambda work_unit: (-work_unit.size, work_unit.year, work_unit.shard))
+
+
+def process_work_unit(
+    work_unit: WorkUnit,
+    station_lookup: Dict[str, NDBCStation],
+    output_directory: str,
+    logger: Any,
+    output_format: str = 'json',
+    join_station_dimensions: bool = False,
+    chunksize: Optional[int] = None,
+    compression: CompressionOptions = CompressionOptions(),
+    position_index: Optional[StationPositionIndex] = None,
+    output_shape: str = 'long',
+    workers: int = 1,
+    max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES,
+    batch_bytes: int = DEFAULT_BATCH_BYTES,
+    archive_directory: Optional[str] = None,
+) -> Tuple[List[str], ParseStats]:
+    # Json output goes to checkpointed segments (retried or rerun units skip
+    # what they already finished) and the segment paths come back, in
+    # station order, for compact_work_units. Parquet is already written per
+    # station so the unit writes it straight into the year's partition.
+    # With workers the unit's files are parsed in a local process pool,
+    # biggest first for json since the segments don't care about order.
+    year = work_unit.year
+    stations = list(work_unit.stations)
+    parse_stats = ParseStats()
+    station_lookup = station_lookup if join_station_dimensions else None
+    if output_format == 'json':
+        ledger = load_ledger(output_directory, work_unit.name)
+        pending = pending_stations(ledger, year, stations)
+    else:
+        pending = stations
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+        frames = iter_processed_files(
+            pending,
+            year,
+            StandardMeteorologicalDataNullValues,
+            logger,
+            executor,
+            max_pending=workers * 2,
+            chunksize=chunksize,
+            parse_stats=parse_stats,
+            position_index=position_index,
+            output_shape=output_shape,
+            ordered=output_format != 'json',
+            max_inflight_bytes=max_inflight_bytes,
+            batch_bytes=batch_bytes,
+            archive_directory=archive_directory,
         )
-        output_files[year] = output_file_path
-        with PigzWriter(output_file_path) as output_file:
-            for i, station in enumerate(stations_by_year[year]):
-                data_df = process_file(
-                    station,
-                    i,
-                    year,
-                    station_lookup,
-                    ignore_first_row,
-                    null_values,
-                    year,
-                    total_stations,
-                    logger,
-                )
-                data_df.to_json(output_file, orient='records', date_format='iso')
+        if output_format != 'json':
+            with get_output_sink(output_format, output_directory, year, station_lookup, compression) as sink:
+                for station, data_df in frames:
+                    sink.write(station[0], data_df)
+            return [sink.path], parse_stats
+        write_year_segments(year, frames, ledger, output_directory, station_lookup, compression, pending)
+    segments = ledger.segment_paths(year, [filepath for _, filepath in stations])
+    return segments, parse_stats
+
+
+def compact_work_units(
+    work_unit_segments: List[Tuple[WorkUnit, List[str]]],
+    output_directory: str,
+    output_format: str = 'json',
+    compression: CompressionOptions = CompressionOptions(),
+    compact: bool = True,
+) -> Dict[str, str]:
+    # Puts each year back together from its units, in shard order, which is
+    # the order the serial path writes.
+    output_files = {}
+    segments_by_year = defaultdict(list)
+    for work_unit, segments in sorted(work_unit_segments, key=lambda item: item[0][:2]):
+        segments_by_year[work_unit.year].extend(segments)
+    for year, segments in segments_by_year.items():
+        sink = get_output_sink(output_format, output_directory, year, None, compression)
+        if output_format != 'json':
+            output_files[year] = sink.path
+        elif compact:
+            output_files[year] = compact_segments(segments, sink.path)
+        else:
+            output_files[year] = segment_directory(output_directory, year)
     return output_files
 
 
@@ -205,17 +1009,8 @@ def group_files(
     station_lookup: Dict[str, NDBCStation],
     logger: Any,
 ) -> Dict[str, Set[Tuple[str, str]]]:
-    stations_by_year = defaultdict(set)
-    for file_path, file_info in files.items():
-        # Extract the station id and year from the title
-        station_id = file_info['station_id']
-        year = file_info['year']
-        month = file_info['month']
-        if station_id in station_lookup:
-            # Filter out stations we have no station metadata for.
-            # A half data point isn't useful. without a location its just non-sense
-            stations_by_year[year].add((station_id, file_path))
-        else:
-            logger.warning(f'Station not found: {station_id} {year} -- {file_path}')
-    return dict(stations_by_year)
+    # files is {path: {station_id, year, month}} from the download tasks.
+    # Files for stations with no station metadata are filtered out.
+    catalog = select_known_stations(catalog_from_files(files), station_lookup, logger)
+    return group_catalog(catalog)
 
@@ -0,0 +1,286 @@
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from prefect_pipeline.noaa_ndbc.checkpoint import output_paths
+from prefect_pipeline.noaa_ndbc.merge import iter_json_arrays
+from prefect_pipeline.noaa_ndbc.models import StandardMeteorologicalDataNullValues
+
+# index/year={year}/ next to the processed output holds
+#   timestamps.i8  int64 nanoseconds since the epoch (utc)
+#   values.f4      float32
+#   index.json     (station, field) -> [start, stop) into both arrays
+# Observations are sorted by station, field then time, so one station/field
+# is a contiguous slice and a time range within it is two binary searches.
+# Station ids are kept lower case, like everywhere else in the pipeline.
+INDEX_DIRNAME = 'index'
+INDEX_FILENAME = 'index.json'
+TIMESTAMPS_FILENAME = 'timestamps.i8'
+VALUES_FILENAME = 'values.f4'
+FIELDS = list(StandardMeteorologicalDataNullValues)
+
+
+def index_directory(output_directory: str, year: str) -> str:
+    return os.path.join(output_directory, INDEX_DIRNAME, f'year={year}')
+
+
+def long_observations(data_df: pd.DataFrame) -> pd.DataFrame:
+    # (datetime_utc, field, val) whichever shape the output was written in
+    if 'field' not in data_df.columns:
+        value_columns = [c for c in FIELDS if c in data_df.columns]
+        data_df = data_df.melt(
+            id_vars=['datetime_utc'],
+            value_vars=value_columns,
+            var_name='field',
+            value_name='val',
+        ).dropna(subset=['val'])
+    return data_df[['datetime_utc', 'field', 'val']]
+
+
+def iter_json_frames(path: str) -> Iterator[Tuple[str, pd.DataFrame]]:
+    # (station_id, frame) per json array in a processed year file, or in
+    # each of its segments when it was left uncompacted. Rows with the
+    # station dimensions joined on carry id instead of station_id.
+    for file_path in output_paths(path):
+        for records in iter_json_arrays(file_path):
+            if not records:
+                continue
+            data_df = pd.DataFrame.from_records(records)
+            station_column = 'station_id' if 'station_id' in data_df.columns else 'id'
+            yield str(records[0][station_column]).lower(), long_observations(data_df)
+
+
+def iter_parquet_frames(path: str) -> Iterator[Tuple[str, pd.DataFrame]]:
+    # parquet/year={year}/station_id={station_id}/part-*.parquet as a hive
+    # partitioned dataset, a station at a time. station_id is read as a
+    # string, left to itself arrow infers int for all digit ids.
+    import pyarrow
+    import pyarrow.dataset
+    dataset = pyarrow.dataset.dataset(
+        path,
+        format='parquet',
+        partitioning=pyarrow.dataset.partitioning(
+            pyarrow.schema([('station_id', pyarrow.string())]),
+            flavor='hive',
+        ),
+    )
+    for station_directory in sorted(glob.glob(os.path.join(path, 'station_id=*'))):
+        station_id = os.path.basename(station_directory)[len('station_id='):]
+        data_df = dataset.to_table(filter=pyarrow.dataset.field('station_id') == station_id).to_pandas()
+        yield station_id.lower(), long_observations(data_df)
+
+
+def iter_output_frames(path: str, output_format: str = 'json') -> Iterator[Tuple[str, pd.DataFrame]]:
+    if output_format == 'parquet':
+        return iter_parquet_frames(path)
+    if output_format == 'json':
+        return iter_json_frames(path)
+    raise ValueError(f'Unknown output format {output_format}, expected json or parquet')
+
+
+def write_station(
+    station_id: str,
+    frames: List[pd.DataFrame],
+    timestamps_file,
+    values_file,
+    offset: int,
+    stations: Dict[str, Dict[str, List[int]]],
+) -> int:
+    data_df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    timestamps = np.asarray(
+        pd.to_datetime(data_df['datetime_utc'], utc=True).dt.tz_convert(None),
+        dtype='datetime64[ns]',
+    ).view('int64')
+    fields = data_df['field'].to_numpy().astype(str)
+    values = data_df['val'].to_numpy(dtype='float32')
+    order = np.lexsort((timestamps, fields))
+    fields = fields[order]
+    timestamps_file.write(np.ascontiguousarray(timestamps[order]).tobytes())
+    values_file.write(np.ascontiguousarray(values[order]).tobytes())
+    # Boundaries between the fields in the sorted block
+    field_names, starts = np.unique(fields, return_index=True)
+    stops = np.append(starts[1:], len(fields))
+    stations[station_id] = {
+        field: [offset + int(start), offset + int(stop)]
+        for field, start, stop in zip(field_names, starts, stops)
+    }
+    return offset + len(fields)
+
+
+def build_year_index(
+    source_path: str,
+    output_directory: str,
+    year: str,
+    output_format: str = 'json',
+) -> Dict[str, int]:
+    # One pass over a processed year (json file, or segment directory, or
+    # parquet year directory).
+    # Only one station is held in memory at a time: the outputs keep a
+    # station's rows together (the merged and compacted files have one
+    # array per station, monthly data has one per station per month, back
+    # to back).
+    directory = index_directory(output_directory, year)
+    partial_directory = directory + '.part'
+    shutil.rmtree(partial_directory, ignore_errors=True)
+    os.makedirs(partial_directory)
+    stations: Dict[str, Dict[str, List[int]]] = {}
+    offset = 0
+    station_id = None
+    frames = []
+    with open(os.path.join(partial_directory, TIMESTAMPS_FILENAME), 'wb') as timestamps_file, \
+            open(os.path.join(partial_directory, VALUES_FILENAME), 'wb') as values_file:
+        for frame_station_id, data_df in iter_output_frames(source_path, output_format):
+            if frame_station_id != station_id:
+                if frames:
+                    offset = write_station(station_id, frames, timestamps_file, values_file, offset, stations)
+                if frame_station_id in stations:
+                    raise ValueError(f'Station {frame_station_id} is not contiguous in {source_path}')
+                station_id = frame_station_id
+                frames = []
+            if not data_df.empty:
+                frames.append(data_df)
+        if frames:
+            offset = write_station(station_id, frames, timestamps_file, values_file, offset, stations)
+    with open(os.path.join(partial_directory, INDEX_FILENAME), 'w') as index_file:
+        json.dump({
+            'year': year,
+            'source': source_path,
+            'count': offset,
+            'built_at': datetime.now(timezone.utc).isoformat(),
+            'stations': stations,
+        }, index_file)
+    # Readers never see half an index
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(partial_directory, directory)
+    return {'stations': len(stations), 'observations': offset}
+
+
+def build_query_index(
+    output_files: Dict[str, str],
+    output_directory: str,
+    logger=None,
+    output_format: str = 'json',
+) -> Dict[str, str]:
+    # output_files is year -> processed output, as returned by
+    # process_and_write_files or merge_outputs
+    index_directories = {}
+    for year, source_path in sorted(output_files.items()):
+        counts = build_year_index(source_path, output_directory, year, output_format)
+        if logger:
+            logger.info(
+                f'Indexed {year}: {counts["observations"]} observations '
+                f'for {counts["stations"]} stations'
+            )
+        index_directories[year] = index_directory(output_directory, year)
+    return index_directories
+
+
+class YearIndex:
+    # One year's arrays memory mapped, nothing is read until it is queried
+    # and then only the pages the slice lands on.
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILENAME), 'r') as index_file:
+            index = json.load(index_file)
+        self.year = index['year']
+        self.count = index['count']
+        self.stations: Dict[str, Dict[str, List[int]]] = index['stations']
+        self._timestamps = None
+        self._values = None
+
+    def _arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._timestamps is None:
+            if self.count == 0:
+                self._timestamps = np.empty(0, dtype='int64')
+                self._values = np.empty(0, dtype='float32')
+            else:
+                self._timestamps = np.memmap(
+                    os.path.join(self.directory, TIMESTAMPS_FILENAME),
+                    dtype='int64', mode='r', shape=(self.count,),
+                )
+                self._values = np.memmap(
+                    os.path.join(self.directory, VALUES_FILENAME),
+                    dtype='float32', mode='r', shape=(self.count,),
+                )
+        return self._timestamps, self._values
+
+    def query(
+        self,
+        station_id: str,
+        field: str,
+        start: Optional[pd.Timestamp] = None,
+        end: Optional[pd.Timestamp] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # (timestamps, values) copies for start <= t < end
+        bounds = self.stations.get(station_id, {}).get(field)
+        if not bounds:
+            return np.empty(0, dtype='int64'), np.empty(0, dtype='float32')
+        timestamps, values = self._arrays()
+        timestamps = timestamps[bounds[0]:bounds[1]]
+        values = values[bounds[0]:bounds[1]]
+        lower = 0 if start is None else int(np.searchsorted(timestamps, start.value, 'left'))
+        upper = len(timestamps) if end is None else int(np.searchsorted(timestamps, end.value, 'left'))
+        return np.array(timestamps[lower:upper]), np.array(values[lower:upper])
+
+
+def to_utc(timestamp) -> Optional[pd.Timestamp]:
+    if timestamp is None:
+        return None
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_localize('UTC') if timestamp.tzinfo is None else timestamp.tz_convert('UTC')
+
+
+class QueryIndex:
+    # Every year indexed under output_directory/index
+    #   index = QueryIndex('/tmp/ndbc/merged')
+    #   index.query('41001', 'wind_speed', '2010-03-01', '2010-04-01')
+    def __init__(self, output_directory: str):
+        self.years: Dict[str, YearIndex] = {}
+        for directory in sorted(glob.glob(os.path.join(output_directory, INDEX_DIRNAME, 'year=*'))):
+            if directory.endswith('.part'):
+                continue
+            year_index = YearIndex(directory)
+            self.years[year_index.year] = year_index
+
+    def stations(self) -> List[str]:
+        return sorted(set(
+            station_id
+            for year_index in self.years.values()
+            for station_id in year_index.stations
+        ))
+
+    def query(
+        self,
+        station_id: str,
+        field: str,
+        start=None,
+        end=None,
+    ) -> pd.Series:
+        # field's values for the station over [start, end), naive times are
+        # taken as utc. Only years overlapping the range are touched.
+        start = to_utc(start)
+        end = to_utc(end)
+        timestamps = []
+        values = []
+        for year, year_index in sorted(self.years.items()):
+            if start is not None and int(year) < start.year:
+                continue
+            if end is not None and int(year) > end.year:
+                continue
+            year_timestamps, year_values = year_index.query(station_id.lower(), field, start, end)
+            timestamps.append(year_timestamps)
+            values.append(year_values)
+        if not timestamps:
+            return pd.Series([], index=pd.DatetimeIndex([], tz='UTC'), dtype='float32', name=field)
+        return pd.Series(
+            np.concatenate(values),
+            index=pd.DatetimeIndex(pd.to_datetime(np.concatenate(timestamps), utc=True), name='datetime_utc'),
+            name=field,
+        )
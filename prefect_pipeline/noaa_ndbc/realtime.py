@@ -0,0 +1,301 @@
+import glob
+import json
+import logging
+import os
+import shutil
+import time
+
+import pandas as pd
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from compression import CompressionOptions, get_extension
+from prefect_pipeline.noaa_ndbc.download import (
+    DEFAULT_REQUESTS_PER_SECOND,
+    STREAM_ERRORS,
+    HostRateLimiter,
+    build_session,
+    open_stream,
+)
+from prefect_pipeline.noaa_ndbc.models import StandardMeteorologicalDataNullValues
+from prefect_pipeline.noaa_ndbc.process_historical_data import (
+    LayoutCache,
+    ParseStats,
+    iter_process_stream,
+)
+from prefect_pipeline.noaa_ndbc.sinks import JsonRecordsSink
+from prefect_pipeline.noaa_ndbc.stations import StationPositionIndex
+
+# NDBC's realtime2 directory has a plain text file per station with the
+# last 45 days of observations, newest first, in the 2007+ stdmet layout
+# (plus a PTDY column we don't keep). They are updated as observations
+# come in, so polling them every few minutes gets data hours old instead
+# of weeks.
+REALTIME_BASE_URL = 'https://www.ndbc.noaa.gov/data/realtime2'
+STATE_FILENAME = 'realtime_state.json'
+DEFAULT_REALTIME_WORKERS = 16
+
+
+def realtime_url(base_url: str, station_id: str) -> str:
+    # The files are named with the upper case id, 41001.txt, KYWF1.txt
+    return f'{base_url}/{station_id.upper()}.txt'
+
+
+class RealtimeState:
+    # What has been emitted so far: per station the newest observation time
+    # (the high water mark, only rows after it are new) and per output file
+    # (by name, the directory can be moved) the size it had once that was
+    # written. Saved after each refresh's output is on disk, so a run killed
+    # part way through an append is truncated back to the last committed
+    # size on load and its rows, still past the high water marks, are
+    # emitted again.
+    def __init__(self, path: str):
+        self.path = path
+        self.high_water_marks: Dict[str, pd.Timestamp] = {}
+        self.file_sizes: Dict[str, int] = {}
+        if os.path.exists(path):
+            with open(path, 'r') as state_file:
+                state = json.load(state_file)
+            self.high_water_marks = {
+                station_id: pd.Timestamp(timestamp)
+                for station_id, timestamp in state['high_water_marks'].items()
+            }
+            # Older states were keyed by the full path
+            self.file_sizes = {
+                os.path.basename(path): size
+                for path, size in state['file_sizes'].items()
+            }
+
+    def recover(self, output_directory: str):
+        # Only files the state has a size for are truncated, anything else
+        # in the directory is left as it is (see commit_new_files).
+        for path in glob.glob(os.path.join(output_directory, 'processed_rows.*')):
+            if path.endswith('.append'):
+                os.remove(path)
+                continue
+            size = self.file_sizes.get(os.path.basename(path))
+            if size is not None and os.path.getsize(path) > size:
+                with open(path, 'r+b') as output_file:
+                    output_file.truncate(size)
+
+    def commit_new_files(self, paths: Iterable[str]):
+        # Files about to be appended to that the state doesn't know yet are
+        # recorded at their size now (0 for a new one) before anything is
+        # written, so an append to them that's cut short can be undone too.
+        new_files = False
+        for path in paths:
+            if os.path.basename(path) not in self.file_sizes:
+                self.file_sizes[os.path.basename(path)] = os.path.getsize(path) if os.path.exists(path) else 0
+                new_files = True
+        if new_files:
+            self.save()
+
+    def save(self):
+        partial_path = self.path + '.part'
+        with open(partial_path, 'w') as state_file:
+            json.dump({
+                'high_water_marks': {
+                    station_id: timestamp.isoformat()
+                    for station_id, timestamp in sorted(self.high_water_marks.items())
+                },
+                'file_sizes': self.file_sizes,
+                'saved_at': datetime.now(timezone.utc).isoformat(),
+            }, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(partial_path, self.path)
+
+
+class RealtimeStats:
+    def __init__(self):
+        self.stations = 0
+        self.updated = 0
+        self.missing: List[str] = []
+        self.failed: Dict[str, str] = {}
+        self.observations = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'stations': self.stations,
+            'updated': self.updated,
+            'missing': len(self.missing),
+            'failed': len(self.failed),
+            'observations': self.observations,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 3),
+        }
+
+    def summary(self) -> str:
+        return (
+            f'Refreshed {self.stations} stations in {self.seconds:.1f}s: '
+            f'{self.updated} with new data, {self.observations} new observations, '
+            f'{len(self.missing)} without a realtime file, {len(self.failed)} failed'
+        )
+
+
+def fetch_station(
+    session: requests.Session,
+    rate_limiter: HostRateLimiter,
+    base_url: str,
+    station_id: str,
+    since: Optional[pd.Timestamp],
+    parse_stats: ParseStats,
+    position_index: Optional[StationPositionIndex] = None,
+    output_shape: str = 'long',
+) -> Tuple[pd.DataFrame, int]:
+    # Streams one station's realtime file through the regular parser and
+    # returns the observations after since, oldest first, with the number
+    # of bytes fetched.
+    url = realtime_url(base_url, station_id)
+    with open_stream(session, url, rate_limiter) as (input_file, tee):
+        data_dfs = list(iter_process_stream(
+            (station_id, url),
+            input_file,
+            lambda: tee.bytes_read,
+            0,
+            str(datetime.now(timezone.utc).year),
+            StandardMeteorologicalDataNullValues,
+            1,
+            logging.getLogger(__name__),
+            layout_cache=LayoutCache(),
+            parse_stats=parse_stats,
+            positions=position_index.get(station_id) if position_index is not None else None,
+            output_shape=output_shape,
+        ))
+    if not data_dfs:
+        return pd.DataFrame([]), tee.bytes_read
+    data_df = pd.concat(data_dfs, ignore_index=True) if len(data_dfs) > 1 else data_dfs[0]
+    if since is not None:
+        data_df = data_df[data_df['datetime_utc'] > since]
+    return data_df.sort_values('datetime_utc', kind='stable', ignore_index=True), tee.bytes_read
+
+
+def realtime_path(output_directory: str, year: str, compression: CompressionOptions = CompressionOptions()) -> str:
+    return os.path.join(output_directory, f'processed_rows.{year}.json{get_extension(compression)}')
+
+
+def frame_years(data_df: pd.DataFrame) -> pd.Series:
+    return data_df['datetime_utc'].dt.year.astype(str)
+
+
+def append_observations(
+    frames: List[Tuple[str, pd.DataFrame]],
+    output_directory: str,
+    compression: CompressionOptions = CompressionOptions(),
+) -> Dict[str, str]:
+    # (station_id, frame) in station order, appended per year (a refresh
+    # can straddle new year) to realtime/processed_rows.{year}.json.gz as
+    # new gzip members (or zstd frames), one json array per station, the
+    # same as every other output. Each year's batch is written out in full
+    # before any of it is appended.
+    by_year: Dict[str, List[Tuple[str, pd.DataFrame]]] = {}
+    for station_id, data_df in frames:
+        for year, year_df in data_df.groupby(frame_years(data_df), sort=True):
+            by_year.setdefault(year, []).append((station_id, year_df))
+    output_files = {}
+    for year, year_frames in sorted(by_year.items()):
+        path = realtime_path(output_directory, year, compression)
+        partial_path = path + '.append'
+        with JsonRecordsSink(output_directory, year, None, compression, path=partial_path) as sink:
+            for station_id, year_df in year_frames:
+                sink.write(station_id, year_df)
+        with open(partial_path, 'rb') as batch_file, open(path, 'ab') as output_file:
+            shutil.copyfileobj(batch_file, output_file, 1024 * 1024)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        os.remove(partial_path)
+        output_files[year] = path
+    return output_files
+
+
+def refresh_realtime(
+    station_ids: Iterable[str],
+    output_directory: str,
+    logger: Any = None,
+    base_url: str = REALTIME_BASE_URL,
+    max_workers: int = DEFAULT_REALTIME_WORKERS,
+    requests_per_second: Optional[float] = DEFAULT_REQUESTS_PER_SECOND,
+    position_index: Optional[StationPositionIndex] = None,
+    output_shape: str = 'long',
+    compression: CompressionOptions = CompressionOptions(),
+) -> RealtimeStats:
+    # One pass over every station: fetch and parse the realtime files
+    # max_workers at a time, keep what is newer than each station's high
+    # water mark, append it and move the marks forward. A station's first
+    # refresh emits its whole 45 days. Stations NDBC has no realtime file
+    # for (404) are counted, not logged one by one.
+    os.makedirs(output_directory, exist_ok=True)
+    state = RealtimeState(os.path.join(output_directory, STATE_FILENAME))
+    state.recover(output_directory)
+    station_ids = sorted(set(station_ids))
+    stats = RealtimeStats()
+    stats.stations = len(station_ids)
+    parse_stats = ParseStats()
+    session = build_session(max_workers)
+    rate_limiter = HostRateLimiter(requests_per_second)
+
+    def fetch(station_id):
+        station_parse_stats = ParseStats()
+        data_df, num_bytes = fetch_station(
+            session,
+            rate_limiter,
+            base_url,
+            station_id,
+            state.high_water_marks.get(station_id),
+            station_parse_stats,
+            position_index,
+            output_shape,
+        )
+        return data_df, num_bytes, station_parse_stats
+
+    start = time.monotonic()
+    frames = []
+    high_water_marks = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(station_id, executor.submit(fetch, station_id)) for station_id in station_ids]
+        for station_id, future in futures:
+            try:
+                data_df, num_bytes, station_parse_stats = future.result()
+            except requests.exceptions.HTTPError as e:
+                if e.response is not None and e.response.status_code == 404:
+                    stats.missing.append(station_id)
+                else:
+                    stats.failed[station_id] = str(e)
+                continue
+            except STREAM_ERRORS + (ValueError, OSError) as e:
+                # A connection dropped part way through (urllib3's errors
+                # come out of open_stream as requests' ones), or ValueError
+                # for a file that isn't a stdmet file at all
+                stats.failed[station_id] = str(e)
+                continue
+            stats.bytes += num_bytes
+            parse_stats.merge(station_parse_stats)
+            if data_df.empty:
+                continue
+            stats.updated += 1
+            stats.observations += len(data_df)
+            frames.append((station_id, data_df))
+            high_water_marks[station_id] = data_df['datetime_utc'].max()
+    state.commit_new_files(
+        realtime_path(output_directory, year, compression)
+        for year in set(year for _, data_df in frames for year in frame_years(data_df).unique())
+    )
+    output_files = append_observations(frames, output_directory, compression)
+    for path in output_files.values():
+        state.file_sizes[os.path.basename(path)] = os.path.getsize(path)
+    state.high_water_marks.update(high_water_marks)
+    state.save()
+    stats.seconds = time.monotonic() - start
+    if logger:
+        if stats.failed:
+            logger.warning(
+                f'Realtime fetch failed for {len(stats.failed)} stations: '
+                f'{", ".join(sorted(stats.failed)[:20])}'
+            )
+        logger.info(stats.summary())
+    return stats
@@ -0,0 +1,120 @@
+import os
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from typing import Any, Callable, Iterator, List, NamedTuple, Sequence, Tuple
+
+# Station files run from 10KB to 100MB. Files under BATCH_BYTES are packed
+# together into one task up to that many bytes, so the little ones don't
+# pay a process round trip each. MAX_INFLIGHT_BYTES caps the (compressed)
+# bytes submitted and not yet handed back, parsed frames are a fairly
+# steady multiple of that so it bounds memory too.
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_INFLIGHT_BYTES = 512 * 1024 * 1024
+
+
+def file_size(path: str) -> int:
+    # On disk by the time anything is processed, the download manifest
+    # recorded the same size (Content-Length) when it fetched it.
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class Batch(NamedTuple):
+    # Positions into the list of items that was planned, and their bytes
+    indexes: Tuple[int, ...]
+    size: int
+
+
+def plan_batches(
+    sizes: Sequence[int],
+    batch_bytes: int = DEFAULT_BATCH_BYTES,
+    largest_first: bool = True,
+) -> List[Batch]:
+    # largest_first puts the big files at the front, one to a batch, with
+    # the small ones packed behind them, so nothing long starts last and
+    # leaves one worker going while the rest sit idle. Otherwise batches
+    # keep the items' order (a batch is a run of neighbouring small items).
+    indexes = range(len(sizes))
+    if largest_first:
+        indexes = sorted(indexes, key=lambda i: -sizes[i])
+    batches = []
+    current = []
+    current_size = 0
+    for i in indexes:
+        if current and (sizes[i] >= batch_bytes or current_size + sizes[i] > batch_bytes):
+            batches.append(Batch(tuple(current), current_size))
+            current = []
+            current_size = 0
+        if sizes[i] >= batch_bytes:
+            batches.append(Batch((i,), sizes[i]))
+            continue
+        current.append(i)
+        current_size += sizes[i]
+    if current:
+        batches.append(Batch(tuple(current), current_size))
+    return batches
+
+
+class SizeAwareScheduler:
+    # Runs function(items) for batches of items on executor, keeping at
+    # most max_pending batches and max_inflight_bytes in flight (a batch
+    # bigger than that on its own still runs, by itself). ordered hands the
+    # results back in the items' order, for writers that need the serial
+    # order; otherwise largest first and as they finish.
+    def __init__(
+        self,
+        executor: Executor,
+        max_pending: int,
+        max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES,
+        batch_bytes: int = DEFAULT_BATCH_BYTES,
+    ):
+        self.executor = executor
+        self.max_pending = max(1, max_pending)
+        self.max_inflight_bytes = max_inflight_bytes
+        self.batch_bytes = batch_bytes
+
+    def map(
+        self,
+        function: Callable[[List[Any]], Any],
+        items: Sequence[Any],
+        sizes: Sequence[int],
+        ordered: bool = False,
+    ) -> Iterator[Tuple[List[Any], Any]]:
+        # Yields (batch items, function's result) per batch
+        batches = deque(plan_batches(sizes, self.batch_bytes, largest_first=not ordered))
+        pending = deque() if ordered else {}
+        inflight_bytes = 0
+
+        def can_submit():
+            if not batches:
+                return False
+            if not pending:
+                return True
+            return (
+                len(pending) < self.max_pending
+                and inflight_bytes + batches[0].size <= self.max_inflight_bytes
+            )
+
+        while batches or pending:
+            while can_submit():
+                batch = batches.popleft()
+                batch_items = [items[i] for i in batch.indexes]
+                future = self.executor.submit(function, batch_items)
+                if ordered:
+                    pending.append((future, batch, batch_items))
+                else:
+                    pending[future] = (batch, batch_items)
+                inflight_bytes += batch.size
+            if ordered:
+                future, batch, batch_items = pending.popleft()
+                done = [(future, batch, batch_items)]
+            else:
+                finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                done = [(future, *pending.pop(future)) for future in finished]
+            for future, batch, batch_items in done:
+                result = future.result()
+                inflight_bytes -= batch.size
+                yield batch_items, result
@@ -0,0 +1,239 @@
+import os
+import numpy as np
+import pandas as pd
+
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from compression import CompressionOptions, get_extension, open_writer
+from prefect_pipeline.noaa_ndbc.models import NDBCStation
+
+OUTPUT_FORMATS = ('json', 'parquet')
+# NDBC reports every stdmet field with at most 2 decimals. Values are
+# float32 in the pipeline, rounding them on the way to json keeps 1012.3
+# from coming out as 1012.299987793.
+JSON_VALUE_DECIMALS = 2
+# to_json builds the whole text of a frame in memory before writing any of
+# it, a station's array is serialised this many rows at a time instead.
+JSON_WRITE_ROWS = 250000
+STATION_DIMENSIONS = list(NDBCStation.__annotations__)
+
+
+def iso_timestamps(timestamps: pd.Series) -> np.ndarray:
+    # Exactly what to_json(date_format='iso') writes for a datetime column,
+    # millisecond precision with a Z when it has a timezone (converted to
+    # utc) and null for NaT, but formatted by numpy in one go. to_json
+    # formats them one at a time and that was most of a write. Each
+    # distinct time is formatted once and its string shared, in the long
+    # shape every timestamp is repeated for each of its fields.
+    codes, uniques = pd.factorize(timestamps)
+    suffix = ''
+    if uniques.tz is not None:
+        uniques = uniques.tz_convert('UTC').tz_localize(None)
+        suffix = 'Z'
+    formatted = np.char.add(np.datetime_as_string(uniques.to_numpy(), unit='ms'), suffix).astype(object)[codes]
+    formatted[codes == -1] = None
+    return formatted
+
+
+def join_station_dimensions(
+    data_df: pd.DataFrame,
+    station: NDBCStation,
+) -> pd.DataFrame:
+    # Legacy row shape: every dimension on every observation in place of
+    # the station_id (which is just the dimensions' id). A position already
+    # on the rows (as of the observation time) wins over the current one.
+    if data_df.empty:
+        return data_df
+    data_df = data_df.drop(columns=['station_id'])
+    for d in STATION_DIMENSIONS:
+        if d in data_df.columns:
+            data_df[d] = data_df[d].fillna(station[d])
+        else:
+            data_df[d] = station[d]
+    return data_df
+
+
+class JsonRecordsSink:
+    # The original output: processed_rows.{year}.json.gz holding one json
+    # array of records per station file. When station_lookup is given the
+    # dimensions are joined back on as strings, like they always were.
+    # path overrides the file name (checkpointed segments).
+    def __init__(
+        self,
+        output_directory: str,
+        year: str,
+        station_lookup: Optional[Dict[str, NDBCStation]] = None,
+        compression: CompressionOptions = CompressionOptions(),
+        path: Optional[str] = None,
+    ):
+        self.path = path or os.path.join(
+            output_directory,
+            f'processed_rows.{year}.json{get_extension(compression)}',
+        )
+        self.station_lookup = station_lookup
+        self.compression = compression
+        self._output_file = None
+
+    def __enter__(self):
+        self._output_file = open_writer(self.path, self.compression)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._output_file.close()
+        return False
+
+    def write(self, station_id: str, data_df: pd.DataFrame):
+        if self.station_lookup is not None:
+            data_df = join_station_dimensions(data_df, self.station_lookup[station_id])
+            dimension_columns = [d for d in STATION_DIMENSIONS if d in data_df.columns]
+            data_df = data_df.astype({d: str for d in dimension_columns})
+        # val in the long shape, every field column in the wide one
+        value_columns = [c for c in data_df.columns if data_df[c].dtype == 'float32']
+        if value_columns:
+            data_df = data_df.assign(**{
+                c: data_df[c].astype('float64').round(JSON_VALUE_DECIMALS)
+                for c in value_columns
+            })
+        datetime_columns = [c for c in data_df.columns if pd.api.types.is_datetime64_any_dtype(data_df[c])]
+        if len(data_df) <= JSON_WRITE_ROWS:
+            self._write_records(data_df, datetime_columns)
+            return
+        # Still the one array, each batch's brackets are dropped and the
+        # batches joined with a comma
+        for start in range(0, len(data_df), JSON_WRITE_ROWS):
+            self._output_file.write('[' if start == 0 else ',')
+            self._write_records(data_df.iloc[start:start + JSON_WRITE_ROWS], datetime_columns, inner=True)
+        self._output_file.write(']')
+
+    def _write_records(self, data_df: pd.DataFrame, datetime_columns: List[str], inner: bool = False):
+        if datetime_columns:
+            data_df = data_df.assign(**{c: iso_timestamps(data_df[c]) for c in datetime_columns})
+        if not inner:
+            data_df.to_json(self._output_file, orient='records', date_format='iso')
+            return
+        self._output_file.write(data_df.to_json(orient='records', date_format='iso')[1:-1])
+
+
+class ParquetSink:
+    # parquet/year={year}/station_id={station_id}/part-{n}.parquet
+    # station_id only lives in the partition directory, a column of it in
+    # the files as well clashes with the partition key when the directory
+    # is read as a dataset.
+    # Dimension columns are written dictionary encoded so a station's name,
+    # owner etc are stored once per row group instead of once per row, and
+    # the values/timestamps keep their real types.
+    def __init__(
+        self,
+        output_directory: str,
+        year: str,
+        station_lookup: Optional[Dict[str, NDBCStation]] = None,
+        compression: CompressionOptions = CompressionOptions(),
+    ):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError('pyarrow is required for parquet output') from e
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = os.path.join(output_directory, 'parquet', f'year={year}')
+        self._parts = defaultdict(int)
+        self.station_lookup = station_lookup
+        self._writer = None
+        self._writer_station_id = None
+        # parquet compresses per column chunk itself, we just pick the codec
+        self._codec = 'zstd' if compression.backend == 'zstd' else 'snappy'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._close_writer()
+        return False
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        self._writer_station_id = None
+
+    def _open_writer(self, station_id: str, schema: Any):
+        self._close_writer()
+        station_directory = os.path.join(self.path, f'station_id={station_id}')
+        os.makedirs(station_directory, exist_ok=True)
+        # Recent data has one file per station per month, so a station can
+        # come around more than once per year and gets a new part each time.
+        part = self._parts[station_id]
+        self._parts[station_id] += 1
+        self._writer = self._pq.ParquetWriter(
+            os.path.join(station_directory, f'part-{part:05d}.parquet'),
+            schema,
+            compression=self._codec,
+        )
+        self._writer_station_id = station_id
+
+    def write(self, station_id: str, data_df: pd.DataFrame):
+        # Chunks of the same station file arrive back to back, they are
+        # appended to the open part as row groups.
+        if data_df.empty:
+            return
+        if self.station_lookup is not None:
+            data_df = join_station_dimensions(data_df, self.station_lookup[station_id])
+        elif 'station_id' in data_df.columns:
+            data_df = data_df.drop(columns=['station_id'])
+        # field only exists in the long shape
+        categorical_columns = [c for c in ['field'] if c in data_df.columns] + [
+            d for d in STATION_DIMENSIONS
+            if d in data_df.columns and pd.api.types.is_string_dtype(data_df[d])
+        ]
+        data_df = data_df.astype({c: 'category' for c in categorical_columns})
+        table = self._pa.Table.from_pandas(data_df, preserve_index=False)
+        if station_id != self._writer_station_id:
+            self._open_writer(station_id, table.schema)
+        self._writer.write_table(table)
+
+
+def get_output_sink(
+    output_format: str,
+    output_directory: str,
+    year: str,
+    station_lookup: Optional[Dict[str, NDBCStation]] = None,
+    compression: CompressionOptions = CompressionOptions(),
+) -> Any:
+    if output_format == 'json':
+        return JsonRecordsSink(output_directory, year, station_lookup, compression)
+    if output_format == 'parquet':
+        return ParquetSink(output_directory, year, station_lookup, compression)
+    raise ValueError(f'Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}')
+
+
+def write_station_dimensions(
+    station_lookup: Dict[str, NDBCStation],
+    output_directory: str,
+    output_format: str = 'json',
+    compression: CompressionOptions = CompressionOptions(),
+) -> str:
+    # The station dimension table, written once per run. Observation rows
+    # only carry station_id which joins to id here.
+    stations_df = pd.DataFrame(
+        sorted(station_lookup.values(), key=lambda station: station['id']),
+        columns=STATION_DIMENSIONS,
+    )
+    os.makedirs(output_directory, exist_ok=True)
+    if output_format == 'json':
+        output_path = os.path.join(output_directory, f'stations.json{get_extension(compression)}')
+        with open_writer(output_path, compression) as output_file:
+            stations_df.to_json(output_file, orient='records')
+        return output_path
+    if output_format == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+        output_path = os.path.join(output_directory, 'parquet', 'stations.parquet')
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        pyarrow.parquet.write_table(
+            pyarrow.Table.from_pandas(stations_df, preserve_index=False),
+            output_path,
+        )
+        return output_path
+    raise ValueError(f'Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}')
@@ -0,0 +1,310 @@
+import json
+import math
+import os
+import time
+import numpy as np
+import pandas as pd
+import xml.etree.ElementTree as ElementTree
+
+from array import array
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from prefect_pipeline.noaa_ndbc.download import download_files
+from prefect_pipeline.noaa_ndbc.manifest import load_manifest
+from prefect_pipeline.noaa_ndbc.models import (
+    NDBCSourceStation,
+    NDBCStation,
+    SourceStationConversion,
+)
+
+ACTIVE_STATIONS_URL = 'https://www.ndbc.noaa.gov/activestations.xml'
+STATION_METADATA_URL = 'https://www.ndbc.noaa.gov/metadata/stationmetadata.xml'
+STATION_TABLE_FILENAME = 'activestations.json'
+DEFAULT_STATION_TTL = 24 * 60 * 60
+
+
+def _to_bool(value: Any) -> bool:
+    # 'y'/'n' in the xml, but the csv lookup files have True/False
+    return value is True or value in ('y', 'True', 'true')
+
+
+def _to_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _converter(output_type: Any) -> Callable[[Any], Any]:
+    if output_type is bool:
+        return _to_bool
+    if output_type is float:
+        return _to_float
+    return output_type
+
+
+# (source field, NDBCStation field, converter), worked out once instead of
+# an __annotations__ lookup for every value of every station.
+STATION_FIELD_CONVERTERS = [
+    (source_field, output_field, _converter(NDBCStation.__annotations__[output_field]))
+    for source_field, output_field in SourceStationConversion.items()
+]
+# Same thing keyed on our own field names, for station lookups read back in
+# from a csv or json file.
+STATION_COLUMN_CONVERTERS = {
+    output_field: convert for _, output_field, convert in STATION_FIELD_CONVERTERS
+}
+
+
+def convert_row_model(row: NDBCSourceStation) -> NDBCStation:
+    output_row = {}
+    for source_field, output_field, convert in STATION_FIELD_CONVERTERS:
+        value = row.get(source_field)
+        if value is not None:
+            output_row[output_field] = convert(value)
+    return output_row
+
+
+class StationTable(Mapping):
+    # Station id -> NDBCStation lookup stored a column per field: floats and
+    # flags in typed arrays, strings in lists, plus an id -> row index. It is
+    # a drop in for the Dict[str, NDBCStation] the pipeline passes around,
+    # the dict for a station is only built when it is looked up.
+    __slots__ = ('_index', '_columns')
+
+    def __init__(self, columns: Dict[str, Any]):
+        self._columns = {}
+        for field, output_type in NDBCStation.__annotations__.items():
+            values = columns.get(field) or []
+            if output_type is float:
+                self._columns[field] = array('d', values)
+            elif output_type is bool:
+                self._columns[field] = array('b', values)
+            else:
+                self._columns[field] = list(values)
+        self._index = {station_id: i for i, station_id in enumerate(self._columns['id'])}
+
+    @classmethod
+    def from_records(cls, stations: Iterable[Dict[str, Any]]) -> 'StationTable':
+        # Missing fields fill in as nan/''/False so every station has every
+        # dimension.
+        stations = sorted(stations, key=lambda station: station['id'])
+        columns = {}
+        for field, output_type in NDBCStation.__annotations__.items():
+            convert = STATION_COLUMN_CONVERTERS.get(field, output_type)
+            default = {float: math.nan, bool: False}.get(output_type, '')
+            columns[field] = [
+                convert(station[field]) if station.get(field) is not None else default
+                for station in stations
+            ]
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path: str) -> 'StationTable':
+        with open(path, 'r') as table_file:
+            return cls(json.load(table_file)['columns'])
+
+    def save(self, path: str, **metadata):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w') as table_file:
+            json.dump({
+                **metadata,
+                'columns': {field: list(values) for field, values in self._columns.items()},
+            }, table_file)
+        os.replace(path + '.tmp', path)
+
+    def __getitem__(self, station_id: str) -> NDBCStation:
+        i = self._index[station_id]
+        station = {}
+        for field, values in self._columns.items():
+            value = values[i]
+            station[field] = bool(value) if values.__class__ is array and values.typecode == 'b' else value
+        return station
+
+    def __contains__(self, station_id: object) -> bool:
+        return station_id in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._columns['id'])
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+def iter_xml_stations(path: str) -> Iterator[Dict[str, Any]]:
+    # Streams <station> elements out of activestations.xml or
+    # stationmetadata.xml without building the whole document. Attributes
+    # are keyed like xmltodict would ('@id', '@lat', ...) so they line up
+    # with SourceStationConversion. Metadata stations get their <history>
+    # entries as a list under 'history'.
+    for _, element in ElementTree.iterparse(path, events=('end',)):
+        if element.tag != 'station':
+            continue
+        station = {f'@{key}': value for key, value in element.attrib.items()}
+        history = element.findall('history')
+        if history:
+            station['history'] = [
+                {f'@{key}': value for key, value in entry.attrib.items()}
+                for entry in history
+            ]
+        yield station
+        element.clear()
+
+
+def refresh_xml(
+    url: str,
+    cache_dir: str,
+    ttl: float,
+    logger: Any = None,
+    offline: bool = False,
+) -> Tuple[str, str]:
+    # Keeps a local copy of one of NDBC's station xml files. Within ttl of the
+    # last fetch the copy is used as is, after that it is re-requested
+    # conditionally and only downloaded again if it changed. Returns the
+    # local path and the sha256 of its contents. offline uses the copy
+    # however old it is and never requests anything.
+    path = os.path.join(cache_dir, os.path.basename(url))
+    manifest = load_manifest(cache_dir)
+    entry = manifest.get(url)
+    if entry and manifest.is_current(url):
+        fetched_at = datetime.fromisoformat(entry['fetched_at']).timestamp()
+        if time.time() - fetched_at < ttl:
+            return path, entry['sha256']
+        if offline:
+            if logger:
+                logger.warning(f'Using stale copy of {url}')
+            return path, entry['sha256']
+    if offline:
+        raise FileNotFoundError(f'No cached copy of {url} in {cache_dir}')
+    stats = download_files(
+        {url: path},
+        max_workers=1,
+        logger=logger,
+        manifest=manifest,
+        conditional=True,
+    )
+    if stats.failed:
+        if not manifest.is_current(url):
+            raise SystemExit(f'Unable to fetch {url}: {stats.failed[url]}')
+        # NDBC being down shouldn't stop a run we have a copy for
+        if logger:
+            logger.warning(f'Using stale copy of {url}')
+    elif stats.unchanged:
+        # A 304 still counts as a fresh fetch for the ttl
+        manifest.record({**entry, 'fetched_at': datetime.now(timezone.utc).isoformat()})
+    return path, manifest.get(url)['sha256']
+
+
+def load_station_table(
+    cache_dir: str,
+    ttl: float = DEFAULT_STATION_TTL,
+    logger: Any = None,
+    offline: bool = False,
+) -> StationTable:
+    # The active station lookup, from the compact table next to the xml when
+    # it was built from the current copy of the xml, otherwise parsed out of
+    # the xml (and saved for next time).
+    xml_path, xml_sha256 = refresh_xml(ACTIVE_STATIONS_URL, cache_dir, ttl, logger, offline)
+    table_path = os.path.join(cache_dir, STATION_TABLE_FILENAME)
+    try:
+        with open(table_path, 'r') as table_file:
+            cached = json.load(table_file)
+        if cached.get('source_sha256') == xml_sha256:
+            return StationTable(cached['columns'])
+    except (OSError, ValueError):
+        pass
+    station_table = StationTable.from_records(
+        convert_row_model(station) for station in iter_xml_stations(xml_path)
+    )
+    station_table.save(table_path, source_sha256=xml_sha256)
+    return station_table
+
+
+def load_station_metadata(
+    cache_dir: str,
+    ttl: float = DEFAULT_STATION_TTL,
+    logger: Any = None,
+) -> List[Dict[str, Any]]:
+    xml_path, _ = refresh_xml(STATION_METADATA_URL, cache_dir, ttl, logger)
+    return list(iter_xml_stations(xml_path))
+
+
+# Open ended history entries (the station's current deployment) run until
+# the end of time.
+OPEN_STOP = np.datetime64('2262-01-01', 'ns')
+ONE_DAY = np.timedelta64(1, 'D')
+
+
+class StationPositions(NamedTuple):
+    # One station's deployments from stationmetadata.xml, sorted by start.
+    # stops are exclusive (the day after the history's stop date).
+    starts: np.ndarray
+    stops: np.ndarray
+    latitudes: np.ndarray
+    longitudes: np.ndarray
+
+    def positions_at(self, timestamps: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+        # As-of lookup for a whole column of UTC timestamps: binary search
+        # each timestamp for the last deployment that started at or before
+        # it, then drop the ones past that deployment's stop. Anything not
+        # covered by the history comes back NaN.
+        times = timestamps.dt.tz_convert(None).to_numpy(dtype='datetime64[ns]')
+        i = np.searchsorted(self.starts, times, side='right') - 1
+        clipped = np.clip(i, 0, None)
+        covered = (i >= 0) & (times < self.stops[clipped])
+        latitudes = np.where(covered, self.latitudes[clipped], np.nan)
+        longitudes = np.where(covered, self.longitudes[clipped], np.nan)
+        return latitudes, longitudes
+
+
+def _history_date(value: Optional[str], default: np.datetime64) -> np.datetime64:
+    if not value:
+        return default
+    try:
+        return np.datetime64(value[:10], 'ns')
+    except ValueError:
+        return default
+
+
+class StationPositionIndex:
+    # Station id -> StationPositions, so observations get stamped with where
+    # the buoy actually was at the time and not where it is today.
+    def __init__(self, positions: Dict[str, StationPositions]):
+        self._positions = positions
+
+    @classmethod
+    def from_metadata(cls, metadata_stations: Iterable[Dict[str, Any]]) -> 'StationPositionIndex':
+        positions = {}
+        for station in metadata_stations:
+            history = sorted(
+                (
+                    _history_date(entry.get('@start'), OPEN_STOP),
+                    _history_date(entry.get('@stop'), OPEN_STOP - ONE_DAY) + ONE_DAY,
+                    _to_float(entry.get('@lat')),
+                    _to_float(entry.get('@lng')),
+                )
+                for entry in station.get('history', [])
+            )
+            history = [entry for entry in history if entry[0] < OPEN_STOP]
+            if not history:
+                continue
+            starts, stops, latitudes, longitudes = zip(*history)
+            positions[station['@id'].lower()] = StationPositions(
+                np.array(starts, dtype='datetime64[ns]'),
+                np.array(stops, dtype='datetime64[ns]'),
+                np.array(latitudes, dtype='float64'),
+                np.array(longitudes, dtype='float64'),
+            )
+        return cls(positions)
+
+    # The metadata and the file names don't agree on case
+    def get(self, station_id: str) -> Optional[StationPositions]:
+        return self._positions.get(station_id.lower())
+
+    def __contains__(self, station_id: object) -> bool:
+        return isinstance(station_id, str) and station_id.lower() in self._positions
+
+    def __len__(self) -> int:
+        return len(self._positions)